@@ -14,12 +14,18 @@ from imes_libs import rhmeter  # RH / temp meter
 from imes_libs import sark  # SARK-110 antenna analyzer for QCM measurements
 from imes_libs import rh200  # RH-200 relative humidity generator
 from imes_libs import eis  # Solartron 1260 vector impedance analyzer
+from imes_libs import eisfit  # equivalent circuit fitting of impedance
 from imes_libs import vac  # insruments for controlling vacuum chamber
 from imes_libs import realtimeplot  # module for realtime plots in pyqtgraph
+from imes_libs import storage  # append-only data files and buffers
+from imes_libs import workers  # persistent instrument worker threads
+from imes_libs import uibridge  # thread-safe widget updates
+from imes_libs import seqmodel  # parsed models of sequence tables
+from imes_libs import engine  # instrument control shared with the engine
 
 # core GUI libraries
 from PyQt5 import QtCore, QtWidgets, uic, QtGui
-from PyQt5.QtWidgets import QMainWindow, QFileDialog
+from PyQt5.QtWidgets import QMainWindow, QFileDialog, QInputDialog
 import ornl_cnms_logo
 
 # to create new logo, create qrc file in Qt desinger, then use
@@ -27,7 +33,6 @@ import ornl_cnms_logo
 
 from threading import Thread
 import pandas as pd
-import numpy as np
 import sys
 import time
 
@@ -88,6 +93,11 @@ class App(QMainWindow):  # create the main window
         self.ui.clear_rh_seq.triggered.connect(self.clear_rh_seq)
         self.ui.export_rh_seq.triggered.connect(self.export_rh_seq)
         self.ui.import_rh_seq.triggered.connect(self.import_rh_seq)
+        self.ui.rh_continuous_daq.triggered.connect(
+                self.rh_continuous_daq_checked)
+        self.ui.rh_closed_loop.triggered.connect(self.rh_closed_loop_checked)
+        self.ui.refit_rh_calibration.triggered.connect(
+                self.refit_rh_calibration)
         # DC electrical menu items
         self.ui.plot_current.triggered.connect(self.plot_current)
         self.ui.measure_iv_now.triggered.connect(self.measure_iv)
@@ -104,6 +114,7 @@ class App(QMainWindow):  # create the main window
         self.ui.preview_cv_biases.triggered.connect(self.print_cv_biases)
         self.ui.measure_current_now.triggered.connect(self.measure_current)
         self.ui.measure_bias_seq_now.triggered.connect(self.measure_bias_seq)
+        self.ui.set_current_stream.triggered.connect(self.set_current_stream)
         # AC electrical menu items
         self.ui.plot_z.triggered.connect(self.plot_z)
         self.ui.plot_phase.triggered.connect(self.plot_phase)
@@ -112,6 +123,9 @@ class App(QMainWindow):  # create the main window
         self.ui.clear_ac_data.triggered.connect(self.clear_ac_data)
         self.ui.plot_low_freq_z.triggered.connect(self.plot_low_freq_z)
         self.ui.preview_eis_freqs.triggered.connect(self.preview_eis_freqs)
+        self.ui.set_eis_tolerance.triggered.connect(self.set_eis_tolerance)
+        self.ui.fit_eis.triggered.connect(self.fit_eis)
+        self.ui.plot_eis_fit.triggered.connect(self.plot_eis_fit)
         # qcm menu items
         self.ui.plot_deltaf.triggered.connect(self.plot_deltaf)
         self.ui.plot_deltad.triggered.connect(self.plot_deltad)
@@ -157,17 +171,19 @@ class App(QMainWindow):  # create the main window
         self.ui.start_eis_freq.setCurrentIndex(0)
         self.ui.end_eis_freq.setCurrentIndex(6)
 
-        # master dataframe to hold all pressure data
-        self.df = pd.DataFrame(
+        # master buffer to hold all main-loop data. it grows in chunks as
+        # the experiment runs, and rows older than 'max_rows' are dropped
+        # from memory (they have already been appended to the data file).
+        self.df = storage.MasterBuffer(
                 columns=['date', 'time', 'pressure', 'pressure_setpoint',
                          'mfc1', 'mfc2', 'rh', 'rh_setpoint',
                          'temp', 'bias', 'current', 'max_iv_current',
                          'max_cv_current', 'cv_area', 'low_freq_z',
                          'note', 'save'],
-                data=np.full((100000, 17), '', dtype=str))
+                chunk_rows=10000, max_rows=500000)
 
         # initialize file-saving variables
-        self.df_i = 0
+        self.df_i = self.df.new_row()
         self.save_file_dir = None
         self.start_time = time.time()
         self.start_date = time.strftime('%Y-%m-%d_%H-%M_')
@@ -176,16 +192,9 @@ class App(QMainWindow):  # create the main window
         # initialize dataframes for holding saved data
         self.iv_df = pd.DataFrame()
         self.cv_df = pd.DataFrame()
-        self.bs_df = pd.DataFrame()
         self.eis_df = pd.DataFrame()
         self.optical_df = pd.DataFrame()
-        self.qcm_data = {str(i): pd.DataFrame() for i in range(1, 19, 2)}
-        self.qcm_data['params'] = pd.DataFrame(
-                data=np.full((10000, 19), ''),
-                columns=['time', 'f_1', 'f_3', 'f_5', 'f_7', 'f_9',
-                         'f_11', 'f_13', 'f_15', 'f_17',
-                         'd_1', 'd_3', 'd_5', 'd_7', 'd_9',
-                         'd_11', 'd_13', 'd_15', 'd_17'])
+        self.qcm_data = sark.new_qcm_data()
 
         # dictionary to hold GUI operation-related items
         self.ops_dict = {
@@ -194,7 +203,11 @@ class App(QMainWindow):  # create the main window
                 'timer': self.timer,
                 'gas1': self.ui.gas1,
                 'gas2': self.ui.gas2,
+                'saved_rows': 0,
+                'fsync_every': 10,
                 'app_settings': None,
+                'main_df_saved_i': 0,
+                'main_df_writer': None,
                 'start_time': self.start_time,
                 'start_date': self.start_date,
                 'output_box': self.ui.output_box,
@@ -212,6 +225,7 @@ class App(QMainWindow):  # create the main window
                 'mfc2_dev': None,
                 'mfc3_dev': None,
                 'turbo_dev': None,
+                'workers': {},
                 'gas1': self.ui.gas1,
                 'gas2': self.ui.gas2,
                 'mks_on': self.ui.mks_on,
@@ -244,6 +258,7 @@ class App(QMainWindow):  # create the main window
                 'turbo_auto_on': self.ui.turbo_auto_on,
                 'turbo_address': self.ui.turbo_address,
                 'vac_seq_running': self.vac_seq_running,
+                'vac_seq_runner': None,
                 'pressure_display': self.ui.pressure_display,
                 'tot_vac_seq_time': self.ui.tot_vac_seq_time,
                 'valve_pos_display': self.ui.valve_pos_display,
@@ -252,6 +267,7 @@ class App(QMainWindow):  # create the main window
 
         # dictionary to hold RH-200 generator related items
         self.rh_dict = {
+                'workers': {},
                 'current_rh': None,
                 'set_rh': self.ui.set_rh,
                 'menu_rh': self.ui.menu_rh,
@@ -262,8 +278,14 @@ class App(QMainWindow):  # create the main window
                 'rh_display': self.ui.rh_display,
                 'run_rh_seq': self.ui.run_rh_seq,
                 'rh_task_dict': self.rh_task_dict,
+                'rh_daq': None,
+                'continuous_daq': self.ui.rh_continuous_daq,
+                'rh_controller': None,
+                'rh_history': None,
+                'closed_loop': self.ui.rh_closed_loop,
                 'rh_seq_step': self.ui.rh_seq_step,
                 'rh_seq_running': self.rh_seq_running,
+                'rh_seq_runner': None,
                 'save_data_now': self.ui.save_data_now,
                 'tot_rh_seq_time': self.ui.tot_rh_seq_time,
                 'elapsed_rh_seq_time': self.ui.elapsed_rh_seq_time,
@@ -276,6 +298,8 @@ class App(QMainWindow):  # create the main window
                 'eis_df': self.eis_df,
                 'eis_on': self.ui.eis_on,
                 'eis_busy': self.eis_busy,
+                'eis_config': None,
+                'eis_tolerance': 0.5,
                 'ac_bias': self.ui.ac_bias,
                 'eis_time': self.ui.eis_time,
                 'start_date': self.start_date,
@@ -292,6 +316,7 @@ class App(QMainWindow):  # create the main window
                 'actual_freq': self.ui.actual_eis_freq,
                 'actual_phase': self.ui.actual_eis_phase,
                 'pause_after_eis': self.ui.pause_after_eis,
+                'adaptive_averaging': self.ui.eis_adaptive_averaging,
                 'solartron_address': self.ui.solartron_address}
 
         # dictionary to hold Ocean Optics USB4000 spectrometer related items
@@ -318,8 +343,13 @@ class App(QMainWindow):  # create the main window
                 'keith_dev': None,
                 'iv_df': self.iv_df,
                 'cv_df': self.cv_df,
-                'bs_df': self.bs_df,
+                'bs_writer': None,
                 'keith_seq_running': False,
+                'list_sweep': self.ui.keith_list_sweep,
+                'current_stream': None,
+                'stream_rate': 10.0,
+                'stream_nplc': 1.0,
+                'stream_current': self.ui.keith_stream_current,
                 'set_bias': self.ui.set_bias,
                 'max_bias': self.ui.max_bias,
                 'keith_busy': self.keith_busy,
@@ -352,6 +382,7 @@ class App(QMainWindow):  # create the main window
                 'new_data': None,
                 'sark_dev': None,
                 'nth_qcm_loop': 0,
+                'bvd_fitter': sark.BvdFitter(),
                 'qcm_rs': self.ui.qcm_rs,
                 'qcm_xs': self.ui.qcm_xs,
                 'set_f0': self.ui.set_f0,
@@ -365,6 +396,7 @@ class App(QMainWindow):  # create the main window
                 'save_file_dir': self.save_file_dir,
                 'sec_per_band': self.ui.sec_per_band,
                 'measure_bands': self.ui.measure_bands,
+                'adaptive_sweep': self.ui.adaptive_sweep,
                 'find_resonances': self.ui.find_resonances,
                 'set_band_points': self.ui.set_band_points,
                 'actual_frequency': self.ui.actual_frequency,
@@ -394,6 +426,26 @@ class App(QMainWindow):  # create the main window
                         '13': self.ui.realf0_n13, '15': self.ui.realf0_n15,
                         '17': self.ui.realf0_n17}}
 
+        # sequence tables are parsed only when they are edited
+        self.rh_dict['rh_seq_model'] = seqmodel.SequenceTableModel(
+                self.ui.rh_table, ['time', 'rh'], self)
+        self.vac_dict['vac_seq_model'] = seqmodel.SequenceTableModel(
+                self.ui.vac_table, ['time', 'pressure', 'mfc1', 'mfc2'], self)
+
+        # route widget updates made from worker threads through the GUI
+        # thread, coalesced to one update per widget every 50 ms
+        self.ui_bridge = uibridge.UiDispatcher(self, interval_ms=50)
+        for widget_dict in [self.ops_dict, self.vac_dict, self.rh_dict,
+                            self.eis_dict, self.spec_dict, self.keith_dict,
+                            self.sark_dict]:
+            uibridge.wrap_dict(widget_dict, self.ui_bridge)
+        self.rh_dict['rh_seq_model'].changed.connect(
+                lambda: rh200.show_rh_seq_total(self.rh_dict))
+        self.vac_dict['vac_seq_model'].changed.connect(
+                lambda: vac.show_vac_seq_total(self.vac_dict))
+        rh200.show_rh_seq_total(self.rh_dict)
+        vac.show_vac_seq_total(self.vac_dict)
+
         # set up real-time graphs
         self.press_graph = realtimeplot.MakeGraph(
                 title='Pressure', xlabel='Time (min)', ylabel='Press. (Torr)')
@@ -428,8 +480,12 @@ class App(QMainWindow):  # create the main window
             # auto scroll to bottom of output box at each main loop iteration
             self.ui.output_box.moveCursor(QtGui.QTextCursor.End)
 
-            # set and measure RH
-            self.set_rh()
+            # set and measure RH and pressure, and measure current. this
+            # is the same instrument control as in the headless engine.
+            engine.update_instruments(self.rh_dict, self.vac_dict,
+                                      self.keith_dict, self.df, self.df_i)
+
+            # plot RH
             if self.rh_dict['rh200_on'].isChecked():
                 if self.rh_dict['current_rh'] is not None:
                     self.rh_graph.append_data([
@@ -437,8 +493,7 @@ class App(QMainWindow):  # create the main window
                             self.rh_dict['current_rh']])
                     self.rh_graph.show()
 
-            # control and measure vacuum chamber pressure and plot pressure
-            self.vac_main()
+            # plot vacuum chamber pressure
             if self.vac_dict['mks_on'].isChecked():
                 if self.vac_dict['current_pressure'] is not None:
                     self.press_graph.append_data([
@@ -446,10 +501,8 @@ class App(QMainWindow):  # create the main window
                             self.vac_dict['current_pressure']])
                     self.press_graph.show()
 
-            # measure and plot electrical current
+            # plot electrical current
             if self.ui.keithley_on.isChecked():
-                if self.ui.measure_current_now.isChecked():
-                    self.measure_current()
                 if self.keith_dict['keith_busy']:
                     if self.keith_dict['new_data'] is not None:
                         self.keith_graph_cv.add_data(
@@ -484,6 +537,9 @@ class App(QMainWindow):  # create the main window
             # ################################################################
             if self.vac_dict['vac_seq_running']:
 
+                # show elapsed sequence time
+                vac.show_vac_seq_time(self.vac_dict)
+
                 # run Keithley functions for RH sequence
                 self.keith_vac_seq()
 
@@ -505,6 +561,9 @@ class App(QMainWindow):  # create the main window
             # ################################################################
             if self.rh_dict['rh_seq_running']:
 
+                # show elapsed sequence time
+                rh200.show_rh_seq_time(self.rh_dict)
+
                 # run Keithley functions for RH sequence
                 self.keith_rh_seq()
 
@@ -554,6 +613,10 @@ class App(QMainWindow):  # create the main window
         # quit the application
 
         self.ui.measure_current_now.setChecked(False)
+        keith.stop_current_stream(self.keith_dict)
+        # stop instrument worker threads before closing instruments
+        workers.stop_all(self.vac_dict['workers'])
+        workers.stop_all(self.rh_dict['workers'])
         # close instruments
         if self.ui.keithley_on.isChecked():
             keith.close(self.keith_dict['keith_dev'])
@@ -562,7 +625,7 @@ class App(QMainWindow):  # create the main window
         if self.ui.rhmeter_on.isChecked():
             rhmeter.close(self.rhmeter_dev)
         if self.ui.rh200_on.isChecked():
-            rh200.close(self.rh_dict['rh_task_dict'])
+            rh200.disconnect(self.rh_dict)
         if self.ui.eis_on.isChecked():
             self.eis_dict['eis_dev'].close()
         if self.ui.mks_on.isChecked():
@@ -573,6 +636,10 @@ class App(QMainWindow):  # create the main window
             self.vac_dict['mfc2_dev'].close()
         if self.ui.turbo_on.isChecked():
             self.vac_dict['turbo_dev'].close()
+        # close data files
+        sark.close_qcm_data(self.sark_dict['qcm_data'])
+        keith.close_bs_writer(self.keith_dict)
+        ops.close_main_df(self.ops_dict, self.df, self.df_i)
 
         if self.ui.create_report_on_quit.isChecked():
             try:
@@ -618,18 +685,13 @@ class App(QMainWindow):  # create the main window
         # run this function when the MKS-651 pressure controller box is checked
         vac.mks_checked(self.vac_dict)
 
-    def vac_main(self):
-        # set pressure and flow rates in vacuum chamber
-        Thread(target=vac.vac_main, args=(self.vac_dict,
-                                          self.df, self.df_i)).start()
-
     def stop_vac_seq(self):
         # Stop vacuum sequence
-        self.vac_dict['vac_seq_running'] = False
+        vac.stop_vac_seq(self.vac_dict)
 
     def run_vac_seq(self):
         # Run the vacuum sequence
-        Thread(target=vac.run_vac_seq, args=(self.vac_dict,)).start()
+        vac.run_vac_seq(self.vac_dict)
         if self.ui.export_settings_at_seq.isChecked():
             self.export_settings()
 
@@ -667,6 +729,18 @@ class App(QMainWindow):  # create the main window
         # display the frequencies to be used for impedance measurement.
         eis.preview_eis_freqs(self.eis_dict)
 
+    def set_eis_tolerance(self):
+        # set the tolerance for adaptive averaging of impedance measurements
+        tolerance, ok = QInputDialog.getDouble(
+                self, 'Adaptive averaging tolerance',
+                'Relative standard error of impedance (%):',
+                self.eis_dict['eis_tolerance'], 0.001, 100, 3)
+        if ok:
+            self.eis_dict['eis_tolerance'] = tolerance
+            self.ui.output_box.append(
+                    'Impedance averaging tolerance set to {} %.'.format(
+                            tolerance))
+
     def plot_phase(self):
         # plot impedance phase over time
         eis.plot_phase(self.eis_dict)
@@ -707,6 +781,20 @@ class App(QMainWindow):  # create the main window
         # plot lowest-frequency impedance over time
         eis.plot_low_freq_z(self.eis_dict, self.df, self.df_i)
 
+    def fit_eis(self):
+        # fit saved impedance spectra to an equivalent circuit. a circuit
+        # can be selected from the list or typed, such as 'R0-p(R1,C1)'
+        circuit, ok = QInputDialog.getItem(
+                self, 'Fit equivalent circuit', 'Circuit:',
+                list(eisfit.circuits), 0, True)
+        if ok:
+            Thread(target=eisfit.fit_experiment,
+                   args=(self.eis_dict, str(circuit))).start()
+
+    def plot_eis_fit(self):
+        # plot equivalent circuit fit parameters over time
+        eisfit.plot_eis_fit(self.eis_dict)
+
     def clear_ac_data(self):
         # clear AC electrical data
         self.eis_dict['eis_df'] = pd.DataFrame()
@@ -742,14 +830,10 @@ class App(QMainWindow):  # create the main window
     def clear_qcm_data(self):
         # clear all QCM data
         self.sark_dict['nth_qcm_loop'] = 0
-        self.sark_dict['qcm_data'] = {
-                str(i): pd.DataFrame() for i in range(1, 19, 2)}
-        self.sark_dict['qcm_data']['params'] = pd.DataFrame(
-                data=np.full((10000, 19), ''),
-                columns=['time', 'f_1', 'f_3', 'f_5', 'f_7', 'f_9',
-                         'f_11', 'f_13', 'f_15', 'f_17',
-                         'd_1', 'd_3', 'd_5', 'd_7', 'd_9',
-                         'd_11', 'd_13', 'd_15', 'd_17'])
+        self.sark_dict['bvd_fitter'].reset()
+        # QCM data files are replaced when the next spectrum is saved
+        sark.close_qcm_data(self.sark_dict['qcm_data'])
+        self.sark_dict['qcm_data'] = sark.new_qcm_data()
 
 # %%  ---- functions for electrical characterization using Keithley 2420 -----
 
@@ -761,6 +845,30 @@ class App(QMainWindow):  # create the main window
         # Measure current continuously using Keithley multimeter.
         keith.get_current_continuously(self.keith_dict, self.df, self.df_i)
 
+    def set_current_stream(self):
+        # set the sampling rate and integration time of high-rate current
+        # logging. they are used the next time current logging starts.
+        rate, ok = QInputDialog.getDouble(
+                self, 'High-rate current logging', 'Sampling rate (Hz):',
+                self.keith_dict['stream_rate'], 0.01, 1000, 2)
+        if not ok:
+            return
+        nplc, ok = QInputDialog.getDouble(
+                self, 'High-rate current logging',
+                'Integration time (power line cycles):',
+                self.keith_dict['stream_nplc'], 0.01, 10, 2)
+        if not ok:
+            return
+        self.keith_dict['stream_rate'] = rate
+        self.keith_dict['stream_nplc'] = nplc
+        self.ui.output_box.append(
+                'Current logging set to {} Hz with {} NPLC.'.format(
+                        rate, nplc))
+        if rate * nplc / keith.line_freq > 1:
+            self.ui.output_box.append(
+                    'Integration time is longer than the sampling period,'
+                    ' so current will be logged at a lower rate.')
+
     def print_iv_biases(self):
         # print and display biases used for I-V measurements
         keith.print_iv_biases(self.keith_dict)
@@ -840,21 +948,27 @@ class App(QMainWindow):  # create the main window
         # clear DC electrical data
         self.keith_dict['iv_df'] = pd.DataFrame()
         self.keith_dict['cv_df'] = pd.DataFrame()
-        self.keith_dict['bs_df'] = pd.DataFrame()
+        # bias sequence file is replaced when the next row is saved
+        keith.close_bs_writer(self.keith_dict)
 
 # %% ---------- functions for RH control and sequence ------------------
 
-    def set_rh(self):
-        # measure and set RH using RH generator
-        if self.ui.rh200_on.isChecked():
-            Thread(target=rh200.set_rh, args=(self.rh_dict,
-                                              self.df,
-                                              self.df_i,)).start()
-
     def rh200_checked(self):
         # Triggers when RH-200 humidity generator checkbox status changes.
         rh200.checked(self.rh_dict)
 
+    def rh_continuous_daq_checked(self):
+        # Triggers when continuous dew point acquisition is toggled.
+        rh200.continuous_daq_checked(self.rh_dict)
+
+    def rh_closed_loop_checked(self):
+        # Triggers when closed-loop RH control is toggled.
+        rh200.closed_loop_checked(self.rh_dict)
+
+    def refit_rh_calibration(self):
+        # Refit the RH-200 calibration from the closed-loop RH history.
+        rh200.refit_calibration(self.rh_dict)
+
     def import_rh_seq(self):
         # Import a saved RH sequence from file
         seq_name = QFileDialog.getOpenFileName(
@@ -880,11 +994,11 @@ class App(QMainWindow):  # create the main window
 
     def stop_rh_seq(self):
         # Stop RH sequence
-        self.rh_dict['rh_seq_running'] = False
+        rh200.stop_rh_seq(self.rh_dict)
 
     def run_rh_seq(self):
         # Run the RH sequence
-        Thread(target=rh200.run_rh_seq, args=(self.rh_dict,)).start()
+        rh200.run_rh_seq(self.rh_dict)
         if self.ui.export_settings_at_seq.isChecked():
             self.export_settings()
 
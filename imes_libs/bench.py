@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""
+This module benchmarks the acquisition and data-saving code of IMES using
+the simulated instruments in sim.py, so it can be run on any PC. It sets
+IMES_SIMULATE=1 itself before importing the instrument modules. It
+reports:
+
+main loop tick latency percentiles (ms)
+SARK-110 points per second in sark.measure_band
+seconds per impedance spectrum in eis.measure_eis
+seconds per I-V curve in keith.measure_iv
+ms per iteration of the headless engine with simulated instruments
+ms to load and check the example experiment recipe file
+seconds per worker step of the vacuum instruments and the RH-200, with
+the RH-200 tasks started every step or running continuously
+cost of saving the main data file as a function of run length (ms)
+cost of save_qcm_data as a function of the number of saved spectra (ms)
+seconds per QCM cycle of sark.measure_bands over 9 harmonics
+
+Run from the IMES folder:
+python -m imes_libs.bench
+python -m imes_libs.bench --save bench_baseline.json
+python -m imes_libs.bench --baseline bench_baseline.json --tolerance 0.25
+
+When a baseline file is given, the exit status is 1 if any result is worse
+than the baseline by more than the tolerance (a fraction), so the
+benchmark can be used to catch regressions in the hot paths.
+Use --latency-scale 0 to remove the simulated instrument latency and
+measure only the time spent in IMES code.
+
+Packages required:
+os
+sys
+json
+time
+argparse
+tempfile
+numpy
+pandas
+
+Created on Sat Oct 17 13:26:18 2026
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+# the instrument modules and the headless engine use simulated
+# instruments, so the benchmark never needs instrument drivers such as
+# nidaqmx, and never opens a real instrument
+os.environ['IMES_SIMULATE'] = '1'
+from imes_libs import sim
+from imes_libs import ops
+from imes_libs import eis
+from imes_libs import sark
+from imes_libs import keith
+from imes_libs import storage
+from imes_libs import vac
+from imes_libs import rh200
+from imes_libs import workers
+from imes_libs import engine
+from imes_libs import recipe
+from imes_libs.engine import Field
+
+
+# metrics for which higher values are better. lower is better for the rest.
+higher_is_better = ('sark_points_per_s',)
+
+
+def scale_latency(device, scale):
+    # scale the simulated command latency of a device
+    device.default_latency *= scale
+    device.latency = {k: v*scale for k, v in device.latency.items()}
+    return device
+
+
+def new_buffer():
+    # create a master buffer with the columns used by the GUI
+    return storage.MasterBuffer(
+            columns=['date', 'time', 'note', 'save', 'pressure', 'rh',
+                     'rh_setpoint', 'valve_pos', 'mfc1', 'mfc2',
+                     'low_freq_z', 'bias', 'current', 'max_iv_current',
+                     'max_cv_current', 'cv_area', 'turbo_speed'],
+            chunk_rows=10000)
+
+
+def new_ops_dict(save_dir):
+    # create ops_dict with stand-in fields for running the main loop
+    return {'timer': Field(), 'gas1': Field('N2'), 'gas2': Field('N2'),
+            'saved_rows': 0, 'fsync_every': 10, 'main_df_saved_i': 0,
+            'main_df_writer': None, 'start_time': time.time(),
+            'start_date': 'bench_', 'output_box': Field(),
+            'sample_name': Field('bench'), 'save_file_dir': save_dir,
+            'save_data_now': Field(checked=True),
+            'rows_of_saved_data': Field(), 'set_main_loop_delay': Field(100),
+            'main_loop_counter_display': Field()}
+
+
+def bench_tick(save_dir, ticks=5000):
+    # time each iteration of the main loop while saving data
+    ops_dict = new_ops_dict(save_dir)
+    df = new_buffer()
+    df_i = df.new_row()
+    tick_times = np.empty(ticks)
+    for i in range(ticks):
+        t0 = time.perf_counter()
+        df, df_i = ops.main_loop_update(ops_dict, df, df_i)
+        tick_times[i] = time.perf_counter() - t0
+    ops.close_main_df(ops_dict, df, df_i)
+    tick_ms = 1e3 * tick_times
+    return {'tick_ms_p50': np.percentile(tick_ms, 50),
+            'tick_ms_p90': np.percentile(tick_ms, 90),
+            'tick_ms_p99': np.percentile(tick_ms, 99),
+            'tick_ms_max': np.max(tick_ms)}
+
+
+def bench_save_main(save_dir, run_lengths=(1000, 10000, 100000)):
+    # time one save of the main data file after runs of different lengths
+    results = {}
+    for run_length in run_lengths:
+        ops_dict = new_ops_dict(save_dir)
+        ops_dict['start_date'] = 'bench_{}_'.format(run_length)
+        df = new_buffer()
+        for i in range(run_length):
+            df.new_row()
+            df.set('date', time.time())
+            df.set('time', i)
+            df.set('pressure', 760)
+            df.set('save', 1)
+        # save everything except the last 10 rows, then time the last save
+        ops.save_main_df(ops_dict, df, run_length - 10)
+        t0 = time.perf_counter()
+        ops.save_main_df(ops_dict, df, run_length)
+        results['save_main_ms@{}'.format(run_length)] = 1e3 * (
+                time.perf_counter() - t0)
+        ops.close_main_df(ops_dict, df, run_length)
+    return results
+
+
+def new_sark_dict(save_dir, device, band_points=200):
+    # create sark_dict with stand-in fields for QCM measurements
+    return {'sark_dev': device, 'new_data': None, 'nth_qcm_loop': 0,
+            'bvd_fitter': sark.BvdFitter(),
+            'qcm_data': sark.new_qcm_data(), 'start_date': 'bench_',
+            'save_file_dir': save_dir, 'output_box': Field(),
+            'set_band_points': Field(band_points),
+            'set_qcm_averaging': Field(1), 'qcm_rs': Field(),
+            'qcm_xs': Field(), 'actual_frequency': Field()}
+
+
+def bench_sark(save_dir, latency_scale=1.0, bands=5, band_points=200):
+    # measure the acquisition rate of sark.measure_band
+    device = scale_latency(sim.SimSark110(), latency_scale)
+    device.open()
+    session = sark.Sark110Session(device)
+    sark_dict = new_sark_dict(save_dir, session, band_points=band_points)
+    t0 = time.perf_counter()
+    points = 0
+    for _ in range(bands):
+        spec = sark.measure_band(sark_dict, 5e6, 2e4)
+        points += len(spec)
+    return {'sark_points_per_s': points / (time.perf_counter() - t0)}
+
+
+def bench_qcm_cycle(save_dir, latency_scale=1.0, cycles=2, band_points=200):
+    # measure the time taken by sark.measure_bands for a full QCM cycle
+    # over all 9 harmonics
+    device = scale_latency(sim.SimSark110(), latency_scale)
+    device.open()
+    sark_dict = new_sark_dict(save_dir, sark.Sark110Session(device),
+                              band_points=band_points)
+    harmonics = [str(n) for n in range(1, 19, 2)]
+    sark_dict.update({
+            'n_on_fields': {n: Field(checked=True) for n in harmonics},
+            'bc_fields': {n: Field(int(n)*5e6) for n in harmonics},
+            'bw_fields': {n: Field(int(n)*2e4) for n in harmonics},
+            'f0_displays': {n: Field() for n in harmonics},
+            'dynamic_bc': Field(checked=True),
+            'adaptive_sweep': Field(checked=False),
+            'measure_bands': Field(), 'find_resonances': Field(),
+            'sec_per_band': Field()})
+    t0 = time.perf_counter()
+    for _ in range(cycles):
+        sark.measure_bands(sark_dict)
+    return {'qcm_cycle_s': (time.perf_counter() - t0) / cycles}
+
+
+def bench_save_qcm(save_dir, spectra_counts=(1, 10, 25, 50)):
+    # time save_qcm_data as the number of saved spectra grows
+    device = sim.SimSark110()
+    sark_dict = new_sark_dict(save_dir, device)
+    freq = np.linspace(4.99e6, 5.01e6, 200).astype(int)
+    spec = np.column_stack((freq, *device.impedance(freq)))
+    results = {}
+    for count in range(1, max(spectra_counts) + 1):
+        t0 = time.perf_counter()
+        sark.save_qcm_data(sark_dict, '{:06d}_'.format(count), 1, spec)
+        sark.save_qcm_params(sark_dict)
+        if count in spectra_counts:
+            results['save_qcm_ms@{}'.format(count)] = 1e3 * (
+                    time.perf_counter() - t0)
+        sark_dict['nth_qcm_loop'] += 1
+    return results
+
+
+def bench_eis(save_dir, latency_scale=1.0, spectra=1, points=10):
+    # measure the time taken by eis.measure_eis for each spectrum, with
+    # a fixed number of measurements and with adaptive averaging
+    results = {}
+    for key, adaptive in [('eis_s_per_spectrum', False),
+                          ('eis_adaptive_s_per_spectrum', True)]:
+        device = scale_latency(sim.SimSolartron1260(), latency_scale)
+        eis_dict = {'eis_dev': device, 'eis_df': pd.DataFrame(),
+                    'start_date': 'bench_', 'save_file_dir': save_dir,
+                    'output_box': Field(), 'start_freq': Field('10'),
+                    'end_freq': Field('100,000'), 'eis_points': Field(points),
+                    'averaging': Field(1), 'ac_bias': Field(0.1),
+                    'dc_offset': Field(0), 'pause_after_eis': Field(0),
+                    'actual_freq': Field(), 'actual_z': Field(),
+                    'actual_phase': Field(), 'eis_time': Field(),
+                    'adaptive_averaging': Field(checked=adaptive),
+                    'eis_tolerance': 0.5, 'eis_config': None}
+        df = new_buffer()
+        df.new_row()
+        t0 = time.perf_counter()
+        for _ in range(spectra):
+            eis.measure_eis(eis_dict, df, df.i)
+        results[key] = (time.perf_counter() - t0) / spectra
+    return results
+
+
+def bench_iv(save_dir, latency_scale=1.0, curves=1, steps=10):
+    # measure the time taken by keith.measure_iv for each I-V curve, with
+    # the bias stepped from the PC and with the hardware list sweep
+    results = {}
+    for key, list_sweep in [('keith_iv_s', False),
+                            ('keith_iv_list_s', True)]:
+        device = scale_latency(sim.SimKeithley2400(), latency_scale)
+        # set up the multimeter as keith.initialize does
+        device.measure_current(current=0.1)
+        keith_dict = {'keith_dev': device, 'iv_df': pd.DataFrame(),
+                      'start_date': 'bench_', 'save_file_dir': save_dir,
+                      'keith_seq_running': False, 'max_bias': Field(1),
+                      'voltage_steps': Field(steps),
+                      'list_sweep': Field(checked=list_sweep)}
+        for name in ['measure_iv_now', 'measure_cv_now',
+                     'measure_current_now', 'measure_bias_seq_now',
+                     'set_bias', 'output_box', 'actual_bias',
+                     'current_display']:
+            keith_dict[name] = Field()
+        df = new_buffer()
+        df.new_row()
+        t0 = time.perf_counter()
+        for _ in range(curves):
+            keith.measure_iv(keith_dict, df, df.i)
+        results[key] = (time.perf_counter() - t0) / curves
+        # the multimeter must be left giving one current per reading
+        if np.ndim(keith.get_current(device)) != 0:
+            raise RuntimeError('{}: multimeter not restored to single '
+                               'current readings'.format(key))
+    return results
+
+
+def bench_setpoints(latency_scale=1.0, steps=5):
+    # measure the time taken by one step of each of the MKS 651, two MFC
+    # and turbo pump workers together, and of the RH-200 worker with and
+    # without continuous acquisition, while the setpoints do not change.
+    # the first step, which sends the setpoints, is not timed.
+    mks = scale_latency(sim.SimMKS651(), latency_scale)
+    mfcs = [scale_latency(sim.SimAlicat(), latency_scale) for _ in range(2)]
+    turbo = scale_latency(sim.SimTurbo(), latency_scale)
+    rh_tasks = sim.sim_rh200_tasks()
+    daq_tasks = sim.sim_rh200_tasks()
+    for task in list(rh_tasks.values()) + list(daq_tasks.values()):
+        scale_latency(task, latency_scale)
+    daq = rh200.RhDaq(daq_tasks)
+    daq.start()
+    caches = {name: workers.SetpointCache(vac.setpoint_refresh)
+              for name in ['mks', 'mfc1', 'mfc2', 'rh200']}
+    command = {'mode': 'pressure', 'pressure_sp': 10.0, 'valve_sp': 50.0}
+
+    def vac_step():
+        vac.mks_step(mks, command, caches['mks'])
+        vac.mfc_step(mfcs[0], 10.0, caches['mfc1'])
+        vac.mfc_step(mfcs[1], 5.0, caches['mfc2'])
+        vac.turbo_step(turbo, False)
+
+    results = {}
+    for key, step in [
+            ('vac_step_s', vac_step),
+            ('rh_step_s',
+             lambda: rh200.rh_step(rh_tasks, 50.0, caches['rh200'])),
+            ('rh_daq_step_s', lambda: rh200.daq_step(daq, 50.0))]:
+        step()
+        t0 = time.perf_counter()
+        for _ in range(steps):
+            step()
+        results[key] = (time.perf_counter() - t0) / steps
+    daq.close()
+    return results
+
+
+def bench_engine(save_dir, ticks=200):
+    # run the headless engine with simulated instruments and no delay
+    # between iterations, and time each iteration
+    eng = engine.Engine(
+            {'save_dir': save_dir, 'loop_delay': 0,
+             'instruments': {'mks': {}, 'mfc1': {}, 'mfc2': {},
+                             'rh200': {'continuous_daq': True},
+                             'keithley': {'measure_current': True}},
+             'setpoints': {'rh': 20, 'pressure': 10, 'mfc1': 5,
+                           'bias': 0.1}})
+    eng.connect()
+    t0 = time.perf_counter()
+    eng.run(ticks=ticks)
+    tick_ms = 1e3 * (time.perf_counter() - t0) / ticks
+    eng.close()
+    return {'engine_tick_ms': tick_ms}
+
+
+def bench_recipe(save_dir, loads=100):
+    # time loading and checking the example recipe from a JSON file
+    filename = os.path.join(save_dir, 'bench_recipe.json')
+    recipe.save(recipe.example_recipe, filename)
+    t0 = time.perf_counter()
+    for _ in range(loads):
+        recipe.load(filename)
+    return {'recipe_check_ms': 1e3 * (time.perf_counter() - t0) / loads}
+
+
+def compare(results, baseline, tolerance=0.25):
+    # get a list of results which are worse than the baseline by more
+    # than the tolerance
+    regressions = []
+    for key, value in results.items():
+        if key not in baseline or baseline[key] <= 0:
+            continue
+        ratio = value / baseline[key]
+        if key in higher_is_better:
+            worse = ratio < 1 - tolerance
+        else:
+            worse = ratio > 1 + tolerance
+        if worse:
+            regressions.append((key, baseline[key], value))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Benchmark IMES with simulated instruments.')
+    parser.add_argument('--only', nargs='+',
+                        choices=['tick', 'save_main', 'sark', 'save_qcm',
+                                 'qcm_cycle', 'eis', 'iv', 'setpoints',
+                                 'engine', 'recipe'],
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('--ticks', type=int, default=5000,
+                        help='number of main loop ticks to time')
+    parser.add_argument('--run-lengths', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='main data file run lengths in rows')
+    parser.add_argument('--spectra', type=int, nargs='+',
+                        default=[1, 10, 25, 50],
+                        help='QCM spectra counts at which to time saving')
+    parser.add_argument('--latency-scale', type=float, default=1.0,
+                        help='factor applied to simulated device latency')
+    parser.add_argument('--save', help='save results to a JSON file')
+    parser.add_argument('--baseline', help='JSON file of baseline results')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed fractional slowdown vs. baseline')
+    args = parser.parse_args(argv)
+    only = args.only or ['tick', 'save_main', 'sark', 'save_qcm',
+                         'qcm_cycle', 'eis', 'iv', 'setpoints', 'engine',
+                         'recipe']
+
+    results = {}
+    with tempfile.TemporaryDirectory() as save_dir:
+        if 'tick' in only:
+            results.update(bench_tick(save_dir, ticks=args.ticks))
+        if 'save_main' in only:
+            results.update(bench_save_main(save_dir, args.run_lengths))
+        if 'sark' in only:
+            results.update(bench_sark(save_dir, args.latency_scale))
+        if 'save_qcm' in only:
+            results.update(bench_save_qcm(save_dir, args.spectra))
+        if 'qcm_cycle' in only:
+            results.update(bench_qcm_cycle(save_dir, args.latency_scale))
+        if 'eis' in only:
+            results.update(bench_eis(save_dir, args.latency_scale))
+        if 'iv' in only:
+            results.update(bench_iv(save_dir, args.latency_scale))
+        if 'setpoints' in only:
+            results.update(bench_setpoints(args.latency_scale))
+        if 'engine' in only:
+            results.update(bench_engine(save_dir))
+        if 'recipe' in only:
+            results.update(bench_recipe(save_dir))
+    results = {key: float(value) for key, value in results.items()}
+
+    for key, value in results.items():
+        print('{:<28}{:>14.4f}'.format(key, value))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for key, old, new in regressions:
+            print('REGRESSION {}: {:.4f} -> {:.4f}'.format(key, old, new))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
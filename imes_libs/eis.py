@@ -7,14 +7,24 @@ Created on Fri Mar 15 13:28:19 2019
 @author: ericmuckley@gmail.com
 """
 
-import visa
 import time
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib import cm
+from imes_libs import sim
 fontsize = 12
 
+# names of the columns saved for each impedance spectrum. each column name
+# in the impedance file is the name followed by the spectrum time.
+eis_columns = ['freq', 'z', 'phase', 'rez', 'imz', 'z_err', 'phase_err']
+
+# settings for adaptive averaging. 'SI' measurements at each frequency are
+# repeated between 'adaptive_min_repeats' and 'adaptive_max_repeats' times
+# until the standard error is small enough.
+adaptive_min_repeats = 3
+adaptive_max_repeats = 20
+
 
 def eis_checked(eis_dict):
     # run this function when solartron1260 checkbox is clicked
@@ -22,18 +32,18 @@ def eis_checked(eis_dict):
     # open connection to instrument
     if eis_dict['eis_on'].isChecked():
         try:
-            rm = visa.ResourceManager()
             # print(rm.list_resources())
             # solartron = rm.open_resource('GPIB1::4::INSTR')
             eis_add = eis_dict['solartron_address'].text()
-            eis_dev = rm.open_resource(eis_add)
+            eis_dev = sim.open_visa(eis_add, sim.SimSolartron1260)
             eis_dict['eis_dev'] = eis_dev
+            eis_dict['eis_config'] = None
             eis_dev.timeout = 60000
             time.sleep(0.2)
             eis_dev.write('*RST')
             time.sleep(0.2)
             eis_dict['output_box'].append('Solartron 1260 connected.')
-        except visa.VISAIOERROR:
+        except sim.VisaError:
             eis_dict['output_box'].append('Solartron 1260 could not connect.')
             eis_dict['eis_on'].setChecked(False)
 
@@ -42,7 +52,7 @@ def eis_checked(eis_dict):
         try:
             eis_dict['eis_dev'].close()
             eis_dict['output_box'].append('Solartron 1260 disconnected.')
-        except visa.VISAIOERROR:
+        except sim.VisaError:
             eis_dict['output_box'].append('Solartron 1260 could not close.')
         eis_dict['eis_on'].setChecked(False)
 
@@ -86,23 +96,17 @@ def preview_eis_freqs(eis_dict):
     plt.draw()
 
 
-def measure_eis(eis_dict, df, df_i):
-    # measure impedance spectrum
-    eis_dict['eis_busy'] = True
-    begin_eis_time = time.time()
-    spec_time = time.strftime('%Y-%m-%d_%H-%M-%S_')
-
-    # open connection to instrument
-    # rm = visa.ResourceManager()
-    # print(rm.list_resources())
-    # solartron = rm.open_resource('GPIB1::4::INSTR')
-    # solartron.timeout = 10000
-    # time.sleep(0.2)
-    # solartron.write('*RST')
-    # time.sleep(0.2)
-
+def configure_eis(eis_dict, freq_array):
+    # Reset and configure the Solartron 1260 for a measurement. This is
+    # skipped if the instrument is already configured with the same
+    # settings, because the reset takes several seconds.
     solartron = eis_dict['eis_dev']
-    eis_dict['output_box'].append('Measuring impedance spectrum...')
+    ac_bias = float(eis_dict['ac_bias'].value())
+    dc_offset = float(eis_dict['dc_offset'].value())
+    adaptive = eis_dict['adaptive_averaging'].isChecked()
+    config = (ac_bias, dc_offset, adaptive)
+    if config == eis_dict['eis_config']:
+        return False
 
     # reset device and configure default settings
     solartron.write('*RST')
@@ -119,22 +123,74 @@ def measure_eis(eis_dict, df, df_i):
     solartron.write('RH 0')
 
     # set AC voltage amplitude
-    ac_bias = float(eis_dict['ac_bias'].value())
     solartron.write('VA '+str(ac_bias))
-
     # set DC bias offset
-    dc_offset = float(eis_dict['dc_offset'].value())
     solartron.write('VB '+str(dc_offset))
-
-    # get frequencies at which to measure
-    freq_array = get_eis_freqs(eis_dict)
-    results = np.zeros((len(freq_array), 5))
+    eis_dict['eis_config'] = config
+    return True
+
+
+def show_eis_point(eis_dict, results, i, begin_eis_time):
+    # show the most recent impedance point on the GUI
+    eis_dict['new_data'] = results[:i, :2]
+    eis_dict['actual_freq'].setText(str(np.round(results[i, 0], decimals=2)))
+    eis_dict['actual_z'].setText(str(np.round(results[i, 1], decimals=2)))
+    eis_dict['actual_phase'].setText(
+            str(np.around(results[i, 2], decimals=2)))
+    tot_eis_time = (time.time() - begin_eis_time)/60
+    eis_dict['eis_time'].setText(str(np.round(tot_eis_time, decimals=2)))
+
+
+def get_eis_point(f0_exp, z, phase_deg, z_err=np.nan, phase_err=np.nan):
+    # get row of results from frequency, |Z|, phase in degrees, and the
+    # standard errors of |Z| and phase
+    # calculate real and imaginary impedance
+    phase_rad = np.pi * phase_deg / 180
+    rez = z * np.cos(phase_rad)
+    imz = z * np.sin(phase_rad)
+    return [f0_exp, z, phase_deg, rez, imz, z_err, phase_err]
+
+
+def standard_error(values):
+    # get standard error of the mean of a list of repeated measurements
+    if len(values) < 2:
+        return np.nan
+    return np.std(values, ddof=1) / np.sqrt(len(values))
+
+
+def averaging_done(z, phase_deg, tolerance):
+    # check whether repeated measurements at a single frequency have a
+    # small enough standard error. the error of |Z| relative to |Z| and
+    # the error of the phase in radians are both compared to the
+    # tolerance, since together they give the relative error of the
+    # complex impedance.
+    if len(z) < adaptive_min_repeats:
+        return False
+    z_rel_err = standard_error(z) / np.abs(np.mean(z))
+    phase_err = np.radians(standard_error(phase_deg))
+    return z_rel_err < tolerance and phase_err < tolerance
+
+
+def measure_eis_steps(eis_dict, freq_array, begin_eis_time):
+    # measure impedance spectrum by setting each frequency from the PC.
+    # in adaptive averaging mode, measurements are repeated until the
+    # standard error falls below the tolerance. otherwise each measurement
+    # is repeated a fixed number of times.
+    solartron = eis_dict['eis_dev']
+    adaptive = eis_dict['adaptive_averaging'].isChecked()
+    # tolerance is set in percent
+    tolerance = float(eis_dict['eis_tolerance']) / 100
+    if adaptive:
+        max_repeats = adaptive_max_repeats
+    else:
+        max_repeats = eis_dict['averaging'].value()
+    results = np.zeros((len(freq_array), len(eis_columns)))
     # loop over each frequency in frequency range
     for i, f0 in enumerate(freq_array):
         # set frequency
         solartron.write('FR '+str(f0))
         z, phase_deg, f0_exp = [], [], []
-        for sweep in range(eis_dict['averaging'].value()):
+        for sweep in range(max_repeats):
 
             time.sleep(0.1)
             '''
@@ -155,22 +211,28 @@ def measure_eis(eis_dict, df, df_i):
             phase_deg.append(float(result0[2]))
             # set delay between points based on the frequency
 
-        f0_exp = np.mean(f0_exp)
-        z = np.mean(z)
-        phase_deg = np.mean(phase_deg)
-        # calculate real and imaginary impedance
-        phase_rad = np.pi * phase_deg / 180
-        rez = z * np.cos(phase_rad)
-        imz = z * np.sin(phase_rad)
-
-        results[i, :] = [f0_exp, z, phase_deg, rez, imz]
-        eis_dict['new_data'] = results[:i, :2]
-        # display results on GUI
-        eis_dict['actual_freq'].setText(str(np.round(f0, decimals=2)))
-        eis_dict['actual_z'].setText(str(np.round(z, decimals=2)))
-        eis_dict['actual_phase'].setText(str(np.around(phase_deg, decimals=2)))
-        tot_eis_time = (time.time() - begin_eis_time)/60
-        eis_dict['eis_time'].setText(str(np.round(tot_eis_time, decimals=2)))
+            if adaptive and averaging_done(z, phase_deg, tolerance):
+                break
+
+        results[i, :] = get_eis_point(
+                np.mean(f0_exp), np.mean(z), np.mean(phase_deg),
+                standard_error(z), standard_error(phase_deg))
+        show_eis_point(eis_dict, results, i, begin_eis_time)
+    return results
+
+
+def measure_eis(eis_dict, df, df_i):
+    # measure impedance spectrum
+    eis_dict['eis_busy'] = True
+    begin_eis_time = time.time()
+    spec_time = time.strftime('%Y-%m-%d_%H-%M-%S_')
+
+    eis_dict['output_box'].append('Measuring impedance spectrum...')
+
+    # get frequencies at which to measure
+    freq_array = get_eis_freqs(eis_dict)
+    configure_eis(eis_dict, freq_array)
+    results = measure_eis_steps(eis_dict, freq_array, begin_eis_time)
     # solartron.close()
 
     eis_dict['output_box'].append('Impedance measurement complete.')
@@ -181,41 +243,22 @@ def measure_eis(eis_dict, df, df_i):
     eis_dict['actual_phase'].setText('--')
 
     # save results to file
-    # make empty columns to fill with data
-    eis_dict['eis_df']['freq_'+spec_time] = np.repeat('', 500)
-    eis_dict['eis_df']['z_'+spec_time] = np.repeat('', 500)
-    eis_dict['eis_df']['phase_'+spec_time] = np.repeat('', 500)
-    eis_dict['eis_df']['rez_'+spec_time] = np.repeat('', 500)
-    eis_dict['eis_df']['imz_'+spec_time] = np.repeat('', 500)
-
-    # now fill empty cells with new data
-    eis_dict['eis_df'][
-            'freq_'+spec_time].iloc[
-                    :len(freq_array)] = results[:, 0].astype(str)
-
-    eis_dict['eis_df'][
-            'z_'+spec_time].iloc[
-                    :len(freq_array)] = results[:, 1].astype(str)
-
-    eis_dict['eis_df'][
-            'phase_'+spec_time].iloc[
-                    :len(freq_array)] = results[:, 2].astype(str)
-
-    eis_dict['eis_df'][
-            'rez_'+spec_time].iloc[
-                    :len(freq_array)] = results[:, 3].astype(str)
-
-    eis_dict['eis_df'][
-            'imz_'+spec_time].iloc[
-                    :len(freq_array)] = results[:, 4].astype(str)
+    # make empty columns and fill them with new data. missing values such
+    # as the uncertainty of a single measurement are left empty.
+    for j, name in enumerate(eis_columns):
+        column = np.full(500, '', dtype=object)
+        values = results[:, j].astype(str)
+        values[np.isnan(results[:, j])] = ''
+        column[:len(freq_array)] = values
+        eis_dict['eis_df'][name+'_'+spec_time] = column
 
     # save data to file
     eis_dict['eis_df'].to_csv(
             eis_dict['save_file_dir']+'/'+eis_dict[
                                         'start_date']+'_eis.csv', index=False)
-    # save max current to main df
+    # save low-frequency impedance to the most recent row of main df
     low_freq_z = results[0, 1]
-    df['low_freq_z'].iloc[df_i] = str(low_freq_z)
+    df.set('low_freq_z', low_freq_z)
 
     time.sleep(10)
     time.sleep(float(eis_dict['pause_after_eis'].value())*60)
@@ -233,25 +276,44 @@ def eis_vac_seq(eis_dict, df, df_i):
     measure_eis(eis_dict, df, df_i)
 
 
+def read_eis_file(file):
+    # read impedance spectra from an impedance file. columns are matched
+    # to the spectra by name, so files with or without uncertainty columns
+    # can be read. returns a dictionary of dataframes of each spectrum,
+    # keyed by spectrum time, with the names in 'eis_columns' as columns.
+    data = pd.read_csv(file)
+    # match longer names first, so 'z_err_' is not read as 'z_'
+    names = sorted(eis_columns, key=len, reverse=True)
+    spectra = {}
+    for col in data.columns:
+        for name in names:
+            if col.startswith(name+'_'):
+                spec_time = col[len(name)+1:]
+                spectra.setdefault(spec_time, {})[name] = pd.to_numeric(
+                        data[col], errors='coerce')
+                break
+    return {spec_time: pd.DataFrame(spectra[spec_time]).dropna(
+            subset=['freq']) for spec_time in spectra}
+
+
 def plot_phase(eis_dict):
     # plot phase over time
     file = eis_dict['save_file_dir']+'/'+eis_dict[
             'start_date']+'_eis.csv'
-    data = pd.read_csv(file)
+    spectra = list(read_eis_file(file).values())
     plt.ion
     fig_eis_p = plt.figure(41)
     fig_eis_p.clf()
     # loop over each measurement
-    for i in range(0, len(data.columns)-1, 5):
-        colors = cm.jet(np.linspace(0, 1, len(data.columns)-4))
-        plt.semilogx(data.iloc[:, i].astype(float),
-                     data.iloc[:, i+2].astype(float),
-                     c=colors[int(i/5)], label=str(int(i/5)))
+    colors = cm.jet(np.linspace(0, 1, max(len(spectra), 1)))
+    for i, spectrum in enumerate(spectra):
+        plt.semilogx(spectrum['freq'], spectrum['phase'],
+                     c=colors[i], label=str(i))
     plt.xlabel('Frequency (Hz)', fontsize=fontsize)
     plt.ylabel('Phase (deg)', fontsize=fontsize)
     plt.legend()
     fig_eis_p.canvas.set_window_title(
-            'Displaying '+str(int(len(data.columns)/5))+' phase plots')
+            'Displaying '+str(len(spectra))+' phase plots')
     plt.tight_layout()
     plt.draw()
 
@@ -260,21 +322,20 @@ def plot_z(eis_dict):
     # plot impedance ovwer time
     file = eis_dict['save_file_dir']+'/'+eis_dict[
             'start_date']+'_eis.csv'
-    data = pd.read_csv(file)
+    spectra = list(read_eis_file(file).values())
     plt.ion
     fig_eis_z = plt.figure(42)
     fig_eis_z.clf()
     # loop over each measurement
-    for i in range(0, len(data.columns)-1, 5):
-        colors = cm.jet(np.linspace(0, 1, len(data.columns)-4))
-        plt.semilogx(data.iloc[:, i].astype(float),
-                     data.iloc[:, i+1].astype(float),
-                     c=colors[int(i/5)], label=str(int(i/5)))
+    colors = cm.jet(np.linspace(0, 1, max(len(spectra), 1)))
+    for i, spectrum in enumerate(spectra):
+        plt.semilogx(spectrum['freq'], spectrum['z'],
+                     c=colors[i], label=str(i))
     plt.xlabel('Frequency (Hz)', fontsize=fontsize)
     plt.ylabel('Z (Ohm)', fontsize=fontsize)
     plt.legend()
     fig_eis_z.canvas.set_window_title(
-            'Displaying '+str(int(len(data.columns)/5))+' impedance plots')
+            'Displaying '+str(len(spectra))+' impedance plots')
     plt.tight_layout()
     plt.draw()
 
@@ -283,21 +344,20 @@ def plot_nyquist(eis_dict):
     # plot Nyquist impedance over time
     file = eis_dict['save_file_dir']+'/'+eis_dict[
             'start_date']+'_eis.csv'
-    data = pd.read_csv(file)
+    spectra = list(read_eis_file(file).values())
     plt.ion
     fig_eis_z = plt.figure(43)
     fig_eis_z.clf()
     # loop over each measurement
-    for i in range(0, len(data.columns)-1, 5):
-        colors = cm.jet(np.linspace(0, 1, len(data.columns)-4))
-        plt.plot(data.iloc[:, i+3].astype(float),
-                 data.iloc[:, i+4].astype(float),
-                 c=colors[int(i/5)], label=str(int(i/5)))
+    colors = cm.jet(np.linspace(0, 1, max(len(spectra), 1)))
+    for i, spectrum in enumerate(spectra):
+        plt.plot(spectrum['rez'], spectrum['imz'],
+                 c=colors[i], label=str(i))
     plt.xlabel('Re(Z) (Ohm)', fontsize=fontsize)
     plt.ylabel('Im(Z) (Ohm)', fontsize=fontsize)
     plt.legend()
     fig_eis_z.canvas.set_window_title(
-            'Displaying '+str(int(len(data.columns)/5))+' Nyquist plots')
+            'Displaying '+str(len(spectra))+' Nyquist plots')
     plt.tight_layout()
     plt.draw()
 
@@ -307,10 +367,8 @@ def plot_low_freq_z(eis_dict, df, df_i):
     plt.ion
     fig_current = plt.figure(45)
     fig_current.clf()
-    df_small = df[df['low_freq_z'] != '']
-    plt.plot(pd.to_numeric(df_small['time']),
-             pd.to_numeric(df_small['low_freq_z']),
-             c='r', lw=1)
+    z_time, low_freq_z = df.select('low_freq_z', 'time', 'low_freq_z')
+    plt.plot(z_time, low_freq_z, c='r', lw=1)
     plt.xlabel('Elapsed time (min)', fontsize=fontsize)
     plt.ylabel('Low-frequency Impedance (Ohm)', fontsize=fontsize)
     fig_current.canvas.set_window_title('Low-frequency Impedance')
@@ -325,6 +383,7 @@ if __name__ == '__main__':
     vac, vdc, freq = 0.5, 0.0, 1
 
     # open connection to instrument
+    import visa
     rm = visa.ResourceManager()
     print(rm.list_resources())
 
@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+"""
+This module fits impedance spectra saved by eis.py to equivalent circuit
+models. Circuits are written as strings of elements joined in series by
+'-', with p(a,b,...) for elements in parallel, for example 'R0-p(R1,C1)'.
+The elements are:
+
+R: resistor (Ohm)
+C: capacitor (F)
+L: inductor (H)
+Q: constant phase element Z = 1 / (Q (jw)^alpha), with parameters Q and
+   alpha (0 < alpha <= 1)
+W: semi-infinite Warburg element Z = sigma (1 - j) / sqrt(w)
+
+The impedance of a circuit and its derivatives with respect to each
+parameter are calculated on the whole frequency array at once. Fits are
+done on the logarithm of the parameters, since they can span many orders
+of magnitude, and each spectrum starts from the fit of the previous one.
+All spectra of an experiment are fitted with fit_spectra(), which splits
+the spectra into consecutive chunks fitted on a pool of processes, and
+returns a dataframe of fit parameters over time. join_main_df() adds the
+RH, pressure and other values of the main data file at each spectrum.
+
+Packages required:
+os
+re
+numpy
+pandas
+scipy
+matplotlib
+concurrent.futures
+
+Created on Sat Oct 17 15:42:18 2026
+"""
+
+import os
+import re
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from scipy.optimize import least_squares
+from concurrent.futures import ProcessPoolExecutor
+from imes_libs import eis
+fontsize = 12
+
+# common equivalent circuits
+circuits = {'R-RC': 'R0-p(R1,C1)',
+            'R-CPE': 'R0-p(R1,Q1)',
+            'Randles': 'R0-p(C1,R1-W1)',
+            'R-RC-RC': 'R0-p(R1,C1)-p(R2,C2)',
+            'R-RCPE-RCPE': 'R0-p(R1,Q1)-p(R2,Q2)'}
+
+
+class Element:
+    # Single circuit element. impedance() returns the complex impedance at
+    # angular frequencies w, and gradient() returns its derivatives with
+    # respect to each parameter as an array of shape (len(w), len(names)).
+    kinds = {}
+
+    def __init__(self, name):
+        self.name = name
+        self.names = [name]
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Element.kinds[cls.kind] = cls
+
+    def guess(self, est):
+        # estimate parameter values from spectrum estimates 'est'
+        return [est[self.kind]]
+
+
+class Resistor(Element):
+    kind = 'R'
+
+    def impedance(self, p, w):
+        return np.full(len(w), p[0], dtype=complex)
+
+    def gradient(self, p, w):
+        return np.ones((len(w), 1), dtype=complex)
+
+    def guess(self, est):
+        # the first resistor is the series resistance of the circuit, the
+        # others share the rest of the low-frequency resistance
+        if est['first_r']:
+            est['first_r'] = False
+            return [est['rs']]
+        return [est['rp'] / est['num_r']]
+
+
+class Capacitor(Element):
+    kind = 'C'
+
+    def impedance(self, p, w):
+        return 1 / (1j * w * p[0])
+
+    def gradient(self, p, w):
+        return (-1 / (1j * w * p[0]**2))[:, None]
+
+
+class Inductor(Element):
+    kind = 'L'
+
+    def impedance(self, p, w):
+        return 1j * w * p[0]
+
+    def gradient(self, p, w):
+        return (1j * w)[:, None].astype(complex)
+
+
+class CPE(Element):
+    kind = 'Q'
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.names = [name, name+'_alpha']
+
+    def impedance(self, p, w):
+        return 1 / (p[0] * (1j * w)**p[1])
+
+    def gradient(self, p, w):
+        z = self.impedance(p, w)
+        return np.column_stack((-z / p[0], -z * np.log(1j * w)))
+
+    def guess(self, est):
+        return [est['Q'], 0.9]
+
+
+class Warburg(Element):
+    kind = 'W'
+
+    def impedance(self, p, w):
+        return p[0] * (1 - 1j) / np.sqrt(w)
+
+    def gradient(self, p, w):
+        return ((1 - 1j) / np.sqrt(w))[:, None]
+
+
+class Series:
+    # elements in series: Z = sum(Zk)
+
+    def __init__(self, children):
+        self.children = children
+        self.names = [n for child in children for n in child.names]
+
+    def split(self, p):
+        # split a parameter array into the parameters of each child
+        i = 0
+        for child in self.children:
+            yield child, p[i:i+len(child.names)]
+            i += len(child.names)
+
+    def impedance(self, p, w):
+        return sum(child.impedance(pk, w) for child, pk in self.split(p))
+
+    def gradient(self, p, w):
+        return np.column_stack(
+                [child.gradient(pk, w) for child, pk in self.split(p)])
+
+    def guess(self, est):
+        return [v for child in self.children for v in child.guess(est)]
+
+
+class Parallel(Series):
+    # elements in parallel: 1/Z = sum(1/Zk), so dZ/dp = (Z/Zk)^2 dZk/dp
+    # for each parameter p of element k
+
+    def impedance(self, p, w):
+        return 1 / sum(1 / child.impedance(pk, w)
+                       for child, pk in self.split(p))
+
+    def gradient(self, p, w):
+        zk = [child.impedance(pk, w) for child, pk in self.split(p)]
+        z = 1 / sum(1 / zi for zi in zk)
+        return np.column_stack(
+                [(z / zi)[:, None]**2 * child.gradient(pk, w)
+                 for zi, (child, pk) in zip(zk, self.split(p))])
+
+
+def parse_circuit(circuit):
+    # build a circuit from a string such as 'R0-p(R1,C1)', or from the name
+    # of a circuit in 'circuits'
+    text = circuits.get(circuit, circuit).replace(' ', '')
+    tokens = re.findall(r'p\(|[A-Z]\w*|[-,)]', text)
+    if ''.join(tokens) != text:
+        raise ValueError('Invalid circuit: '+circuit)
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else None
+
+    def take(expected=None):
+        token = peek()
+        if token is None or (expected is not None and token != expected):
+            raise ValueError('Invalid circuit: '+circuit)
+        pos[0] += 1
+        return token
+
+    def parse_series():
+        children = [parse_term()]
+        while peek() == '-':
+            take('-')
+            children.append(parse_term())
+        return children[0] if len(children) == 1 else Series(children)
+
+    def parse_term():
+        token = take()
+        if token == 'p(':
+            children = [parse_series()]
+            while peek() == ',':
+                take(',')
+                children.append(parse_series())
+            take(')')
+            return Parallel(children)
+        if token[0] not in Element.kinds:
+            raise ValueError('Unknown circuit element: '+token)
+        return Element.kinds[token[0]](token)
+
+    tree = parse_series()
+    if peek() is not None:
+        raise ValueError('Invalid circuit: '+circuit)
+    if len(set(tree.names)) != len(tree.names):
+        raise ValueError('Circuit element names must be unique: '+circuit)
+    return tree
+
+
+class CircuitFitter:
+    # Fits complex impedance spectra to an equivalent circuit. Residuals
+    # are the differences between model and measured impedance divided by
+    # the measured |Z|, so every frequency has a similar weight. Fits are
+    # done on log(parameters) with the analytic Jacobian, and each fit
+    # starts from the previous fit, so fits of slowly changing spectra
+    # converge in a few iterations. Call reset() before fitting spectra
+    # which are not related to the previous ones.
+
+    def __init__(self, circuit, max_nfev=200):
+        self.circuit = circuit
+        self.tree = parse_circuit(circuit)
+        self.names = self.tree.names
+        self.max_nfev = max_nfev
+        # most recent fit parameters
+        self.last = None
+        # number of function evaluations and cost of the most recent fit
+        self.nfev = 0
+        self.cost = np.nan
+
+    def reset(self):
+        self.last = None
+
+    def impedance(self, params, freq):
+        # complex impedance of the circuit at frequencies in Hz
+        return self.tree.impedance(np.asarray(params, dtype=float),
+                                   2*np.pi*np.asarray(freq, dtype=float))
+
+    def gradient(self, params, freq):
+        # derivatives of the complex impedance with respect to each
+        # parameter, with shape (len(freq), len(params))
+        return self.tree.gradient(np.asarray(params, dtype=float),
+                                  2*np.pi*np.asarray(freq, dtype=float))
+
+    def guess(self, freq, z):
+        # estimate fit parameters from a spectrum of complex impedance
+        order = np.argsort(freq)
+        freq, z = freq[order], z[order]
+        # frequency of the maximum of -Im(Z) gives the time constant
+        f_peak = freq[np.argmax(-z.imag)]
+        rs = max(np.min(z.real), 1e-3)
+        rp = max(np.max(z.real) - rs, rs)
+        num_r = max(1, len([n for n in self.names if n[0] == 'R']) - 1)
+        c = 1 / (2*np.pi*f_peak*rp)
+        est = {'first_r': True, 'rs': rs, 'rp': rp, 'num_r': num_r,
+               'C': c, 'Q': c, 'L': 1e-6,
+               'W': np.abs(z[0]) * np.sqrt(2*np.pi*freq[0]) / 10}
+        return np.array(self.tree.guess(est), dtype=float)
+
+    def bounds(self):
+        # bounds of log(parameters). CPE exponents are between 0 and 1.
+        lower = np.full(len(self.names), -np.inf)
+        upper = np.full(len(self.names), np.inf)
+        for i, name in enumerate(self.names):
+            if name.endswith('_alpha'):
+                lower[i], upper[i] = np.log(1e-2), 0
+        return lower, upper
+
+    def residuals(self, x, freq, z):
+        # relative residuals of real and imaginary impedance
+        dz = (self.impedance(np.exp(x), freq) - z) / np.abs(z)
+        return np.concatenate((dz.real, dz.imag))
+
+    def jacobian(self, x, freq, z):
+        # derivatives of the residuals with respect to log(parameters)
+        p = np.exp(x)
+        jac = self.gradient(p, freq) * p / np.abs(z)[:, None]
+        return np.vstack((jac.real, jac.imag))
+
+    def fit(self, freq, z):
+        # fit the complex impedance spectrum z. returns the fit parameters
+        # and the fitted spectrum.
+        freq = np.asarray(freq, dtype=float)
+        z = np.asarray(z, dtype=complex)
+        lower, upper = self.bounds()
+        guesses = [self.guess(freq, z)]
+        if self.last is not None:
+            guesses.insert(0, self.last)
+        for guess in guesses:
+            x0 = np.clip(np.log(guess), lower + 1e-9, upper - 1e-9)
+            result = least_squares(
+                    self.residuals, x0, jac=self.jacobian,
+                    bounds=(lower, upper), method='trf',
+                    args=(freq, z), max_nfev=self.max_nfev)
+            self.nfev = result.nfev
+            if result.success:
+                params = np.exp(result.x)
+                self.last = params
+                self.cost = result.cost
+                return params, self.impedance(params, freq)
+        raise RuntimeError('Equivalent circuit fit did not converge.')
+
+
+def fit_chunk(circuit, chunk):
+    # fit a list of consecutive spectra (spec_time, freq, z), each starting
+    # from the fit of the previous spectrum. runs in a worker process.
+    fitter = CircuitFitter(circuit)
+    rows = []
+    for spec_time, freq, z in chunk:
+        try:
+            params, _ = fitter.fit(freq, z)
+            rows.append([spec_time] + list(params) + [
+                    fitter.cost, fitter.nfev])
+        except (RuntimeError, ValueError):
+            fitter.reset()
+            rows.append([spec_time] + [np.nan]*len(fitter.names) + [
+                    np.nan, fitter.nfev])
+    return rows
+
+
+def fit_spectra(spectra, circuit, processes=None, min_chunk=100):
+    # fit spectra to an equivalent circuit, where spectra is a dictionary
+    # of dataframes of each spectrum keyed by spectrum time, as returned by
+    # eis.read_eis_file(). spectra are split into one chunk of at least
+    # 'min_chunk' consecutive spectra per process. returns a dataframe with
+    # one row of fit parameters for each spectrum.
+    names = CircuitFitter(circuit).names
+    data = [(spec_time, s['freq'].values,
+             s['rez'].values + 1j*s['imz'].values)
+            for spec_time, s in spectra.items()]
+    processes = processes or os.cpu_count() or 1
+    num_chunks = max(1, min(processes, len(data) // max(1, min_chunk)))
+    bounds = np.linspace(0, len(data), num_chunks+1).astype(int)
+    chunks = [data[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+    if num_chunks == 1:
+        rows = fit_chunk(circuit, data)
+    else:
+        with ProcessPoolExecutor(max_workers=num_chunks) as pool:
+            results = pool.map(fit_chunk, [circuit]*num_chunks, chunks)
+            rows = [row for chunk_rows in results for row in chunk_rows]
+    params = pd.DataFrame(rows, columns=['date']+names+['cost', 'nfev'])
+    # spectrum times are saved as '%Y-%m-%d_%H-%M-%S_'
+    params['date'] = params['date'].str.rstrip('_')
+    params.insert(1, 'timestamp', pd.to_datetime(
+            params['date'], format='%Y-%m-%d_%H-%M-%S', errors='coerce'))
+    return params
+
+
+def join_main_df(params, main_df_file):
+    # add the values in the main data file (such as RH and pressure) at
+    # the time of each spectrum to a dataframe of fit parameters
+    main = pd.read_csv(main_df_file)
+    main['timestamp'] = pd.to_datetime(
+            main['date'], format='%Y-%m-%d_%H-%M-%S', errors='coerce')
+    main = main.drop(columns=[col for col in ['date', 'note']
+                              if col in main.columns])
+    main = main.dropna(subset=['timestamp']).sort_values('timestamp')
+    params = params.dropna(subset=['timestamp']).sort_values('timestamp')
+    return pd.merge_asof(params, main, on='timestamp', direction='nearest')
+
+
+def fit_experiment(eis_dict, circuit, processes=None):
+    # fit all impedance spectra of the experiment, join them to the main
+    # data file if it exists, and save them to the '_eis_fit.csv' file
+    base = eis_dict['save_file_dir']+'/'+eis_dict['start_date']
+    eis_dict['output_box'].append('Fitting impedance spectra to '+str(
+            circuits.get(circuit, circuit))+'...')
+    try:
+        spectra = eis.read_eis_file(base+'_eis.csv')
+        params = fit_spectra(spectra, circuit, processes=processes)
+    except FileNotFoundError:
+        eis_dict['output_box'].append('No impedance data found.')
+        return None
+    except ValueError as e:
+        eis_dict['output_box'].append(str(e))
+        return None
+    try:
+        params = join_main_df(params, base+'_main_df.csv')
+    except FileNotFoundError:
+        pass
+    params.to_csv(base+'_eis_fit.csv', index=False)
+    eis_dict['output_box'].append('Fit {} impedance spectra.'.format(
+            len(params)))
+    return params
+
+
+def plot_eis_fit(eis_dict):
+    # plot equivalent circuit parameters over time
+    file = eis_dict['save_file_dir']+'/'+eis_dict[
+            'start_date']+'_eis_fit.csv'
+    try:
+        params = pd.read_csv(file)
+    except FileNotFoundError:
+        eis_dict['output_box'].append('No impedance fit data found.')
+        return
+    timestamp = pd.to_datetime(params['timestamp'])
+    elapsed = (timestamp - timestamp.min()).dt.total_seconds() / 60
+    names = list(params.columns[2:params.columns.get_loc('cost')])
+    plt.ion
+    fig_fit = plt.figure(46)
+    fig_fit.clf()
+    for i, name in enumerate(names):
+        ax = fig_fit.add_subplot(len(names), 1, i+1)
+        ax.plot(elapsed, params[name], c='k', marker='o', ms=3, lw=1)
+        if not name.endswith('_alpha'):
+            ax.set_yscale('log')
+        ax.set_ylabel(name, fontsize=fontsize)
+    ax.set_xlabel('Elapsed time (min)', fontsize=fontsize)
+    fig_fit.canvas.set_window_title('Equivalent circuit fit parameters')
+    plt.tight_layout()
+    plt.draw()
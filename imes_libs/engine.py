@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides a headless acquisition engine which runs the
+instruments, sequences and data files of IMES without the Qt GUI, so
+long unattended experiments can run on a PC or server without a display.
+The engine is configured with a plain Python dictionary, for example:
+
+config = {'save_dir': 'C:\\data', 'sample_name': 'film_1',
+          'loop_delay': 0.5, 'save_data': True,
+          'instruments': {'mks': {'address': 'COM12', 'mode': 'pressure'},
+                          'mfc1': {'address': 'COM17', 'gas': 'N2'},
+                          'rh200': {'continuous_daq': True},
+                          'keithley': {'address': 'GPIB::24',
+                                       'measure_current': True}},
+          'setpoints': {'pressure': 760, 'mfc1': 10, 'rh': 5, 'bias': 0.1}}
+
+engine = Engine(config)
+engine.connect()
+engine.subscribe(print)
+engine.run_sequence({'rh': [{'type': 'linear', 'value': 90,
+                             'duration': 3600}]})
+engine.run(until_sequence_done=True)
+engine.close()
+
+The engine drives the same driver functions as the GUI. Their settings
+and displays are held by Field objects in place of Qt widgets, in the
+same dictionaries the GUI uses (ops_dict, vac_dict, rh_dict, keith_dict).
+The instrument control of each iteration is in update_instruments(),
+which the main loop of the GUI also runs, so it is changed in one place.
+Each iteration of the loop takes the most recent instrument readings,
+adds a row to the master buffer, appends saved rows to the main data
+file, and passes the new row to each subscriber. Subscribers run in the
+engine thread, so a GUI which subscribes must pass updates to its own
+thread (see uibridge.py).
+
+Instruments in 'instruments' are:
+mks ---------- MKS 651 pressure controller (address, mode 'pressure' or
+               'valve')
+turbo -------- Leybold turbo pump (address, auto_on, run)
+mfc1, mfc2 --- Alicat mass flow controllers (address, gas)
+rh200 -------- RH-200 humidity generator (continuous_daq, closed_loop)
+keithley ----- Keithley 2400 (address, measure_current, stream_current,
+               list_sweep)
+solartron ---- Solartron 1260 impedance analyzer (address)
+spectrometer - Ocean Optics USB4000 spectrometer
+sark110 ------ SARK-110 analyzer for QCM measurements
+
+measure() starts a measurement ('iv', 'cv', 'bs', 'eis', 'qcm' or
+'optical') on its own thread, as the GUI does, unless the instrument is
+already measuring. Settings of the measurements are held by the Fields
+of the instrument dictionaries (eis_dict, spec_dict, sark_dict and
+keith_dict), for example engine.keith_dict['max_bias'].setValue(2).
+
+Packages required:
+time
+threading
+pandas
+
+Created on Sat Oct 17 21:15:32 2026
+"""
+
+import time
+import threading
+import pandas as pd
+from imes_libs import ops
+from imes_libs import vac
+from imes_libs import rh200
+from imes_libs import keith
+from imes_libs import eis
+from imes_libs import spec
+from imes_libs import sark
+from imes_libs import storage
+from imes_libs import sequence
+from imes_libs import workers
+
+default_config = {'save_dir': '.', 'sample_name': 'sample',
+                  'loop_delay': 0.5, 'save_data': True, 'fsync_every': 10,
+                  'max_rows': 500000, 'instruments': {}, 'setpoints': {}}
+
+# options of each instrument in the 'instruments' entry of the config
+instrument_options = {
+        'mks': ('address', 'mode'),
+        'turbo': ('address', 'auto_on', 'run'),
+        'mfc1': ('address', 'gas'),
+        'mfc2': ('address', 'gas'),
+        'rh200': ('continuous_daq', 'closed_loop'),
+        'keithley': ('address', 'measure_current', 'stream_current',
+                     'stream_rate', 'stream_nplc', 'list_sweep'),
+        'solartron': ('address',),
+        'spectrometer': (),
+        'sark110': ()}
+
+# instrument, busy flag and function of each type of measurement
+measurements = {'iv': ('keithley', 'keith_busy', keith.measure_iv),
+                'cv': ('keithley', 'keith_busy', keith.measure_multi_cv),
+                'bs': ('keithley', 'keith_busy', keith.measure_bias_seq),
+                'eis': ('solartron', 'eis_busy', eis.measure_eis),
+                'qcm': ('sark110', 'sark_busy', sark.measure_bands),
+                'optical': ('spectrometer', 'spec_busy', spec.get_spec)}
+
+# QCM harmonics which can be measured
+harmonics = ['1', '3', '5', '7', '9', '11', '13', '15', '17']
+
+# columns of the master buffer, the same as in the GUI
+columns = ['date', 'time', 'pressure', 'pressure_setpoint', 'mfc1', 'mfc2',
+           'rh', 'rh_setpoint', 'temp', 'bias', 'current', 'max_iv_current',
+           'max_cv_current', 'cv_area', 'low_freq_z', 'note', 'save']
+
+
+def update_instruments(rh_dict, vac_dict, keith_dict, df, df_i):
+    # One iteration of instrument control, run by both the main loop of
+    # the GUI and Engine.tick(): send setpoints to the RH-200 and vacuum
+    # instrument workers and save their most recent readings, and measure
+    # current if current logging is on.
+    if rh_dict['rh200_on'].isChecked():
+        rh200.set_rh(rh_dict, df, df_i)
+    vac.vac_main(vac_dict, df, df_i)
+    if keith_dict['keithley_on'].isChecked():
+        if keith_dict['measure_current_now'].isChecked():
+            keith.get_current_continuously(keith_dict, df, df_i)
+
+
+class Field:
+    # Stand-in for a Qt widget on the GUI which holds a single value, so
+    # driver functions can be run without a GUI.
+
+    def __init__(self, value=0, checked=False):
+        self._value = value
+        self._checked = checked
+        self.enabled = True
+        self.lines = []
+
+    def value(self):
+        return self._value
+
+    def setValue(self, value):
+        self._value = value
+
+    def text(self):
+        return str(self._value)
+
+    def setText(self, value):
+        self._value = value
+
+    def currentText(self):
+        return str(self._value)
+
+    def isChecked(self):
+        return self._checked
+
+    def setChecked(self, checked):
+        self._checked = checked
+
+    def setEnabled(self, enabled):
+        self.enabled = enabled
+
+    def append(self, line):
+        self.lines.append(line)
+
+    def start(self, interval=None):
+        pass
+
+
+class Table:
+    # Stand-in for a table on the GUI, such as the bias sequence table,
+    # which holds rows of cells.
+
+    def __init__(self, rows=(), columns=2):
+        self.columns = columns
+        self.setRows(rows)
+
+    def setRows(self, rows):
+        # set the rows of the table from a list of lists of values
+        self.rows = [[Field(str(value)) for value in row] for row in rows]
+
+    def rowCount(self):
+        return len(self.rows)
+
+    def columnCount(self):
+        return self.columns
+
+    def item(self, row, column):
+        return self.rows[row][column]
+
+
+class Panel(dict):
+    # Dictionary of settings and state of an instrument, in the form used
+    # by the driver modules. Keys which have not been set are created as
+    # Fields when they are first used, in place of widgets on the GUI.
+
+    def __missing__(self, key):
+        self[key] = Field()
+        return self[key]
+
+
+class Engine:
+    # Headless acquisition engine. Create it with a config dictionary,
+    # call connect() to open the instruments, then tick() for a single
+    # iteration or run() to loop at 'loop_delay' seconds per iteration.
+
+    def __init__(self, config=None):
+        self.config = dict(default_config)
+        self.config.update({} if config is None else config)
+        self.instruments = dict(self.config['instruments'])
+        self.start_time = time.time()
+        self.start_date = time.strftime('%Y-%m-%d_%H-%M_')
+        self.df = storage.MasterBuffer(columns, chunk_rows=10000,
+                                       max_rows=self.config['max_rows'])
+        self.df_i = self.df.new_row()
+        self.output_box = Field()
+        self.subscribers = []
+        self.runner = None
+        self.measure_threads = []
+        self.ticks = 0
+        self._messages_sent = 0
+        self._stop_event = threading.Event()
+        self.build_dicts()
+        for channel, value in self.config['setpoints'].items():
+            self.set_setpoint(channel, value)
+
+    def build_dicts(self):
+        # create the dictionaries of settings and state used by the
+        # driver modules, in the same form as in the GUI
+        config = self.config
+        common = {'output_box': self.output_box,
+                  'save_file_dir': config['save_dir'],
+                  'start_date': self.start_date,
+                  'save_data_now': Field(checked=config['save_data'])}
+        gas = {mfc: Field(self.instruments.get(mfc, {}).get('gas', 'N2'))
+               for mfc in ['mfc1', 'mfc2']}
+        self.ops_dict = Panel(common, **{
+                'elapsed_time': 0, 'timer': Field(), 'saved_rows': 0,
+                'fsync_every': config['fsync_every'], 'app_settings': None,
+                'main_df_saved_i': 0, 'main_df_writer': None,
+                'start_time': self.start_time, 'gas1': gas['mfc1'],
+                'gas2': gas['mfc2'],
+                'sample_name': Field(config['sample_name']),
+                'set_main_loop_delay': Field(
+                        int(1000*config['loop_delay']))})
+        mks = self.instruments.get('mks', {})
+        turbo = self.instruments.get('turbo', {})
+        self.vac_dict = Panel(common, **{
+                'mks_dev': None, 'mfc1_dev': None, 'mfc2_dev': None,
+                'turbo_dev': None, 'workers': {}, 'current_pressure': None,
+                'vac_seq_running': False, 'vac_seq_runner': None,
+                'vac_seq_model': None, 'gas1': gas['mfc1'],
+                'gas2': gas['mfc2'],
+                'pressure_mode': Field(
+                        checked=mks.get('mode', 'pressure') == 'pressure'),
+                'valve_mode': Field(checked=mks.get('mode') == 'valve'),
+                'turbo_auto_on': Field(checked=turbo.get('auto_on', True)),
+                'run_turbo': Field(checked=turbo.get('run', False))})
+        for name in ['mks', 'mfc1', 'mfc2', 'turbo']:
+            self.vac_dict[name+'_address'] = Field(
+                    self.instruments.get(name, {}).get('address', ''))
+        rh = self.instruments.get('rh200', {})
+        self.rh_dict = Panel(common, **{
+                'workers': {}, 'current_rh': None, 'rh_task_dict': None,
+                'rh_daq': None, 'rh_controller': None, 'rh_history': None,
+                'rh_seq_running': False, 'rh_seq_runner': None,
+                'rh_seq_model': None,
+                'continuous_daq': Field(
+                        checked=rh.get('continuous_daq', False)),
+                'closed_loop': Field(checked=rh.get('closed_loop', False))})
+        kt = self.instruments.get('keithley', {})
+        self.keith_dict = Panel(common, **{
+                'new_data': None, 'keith_dev': None, 'bs_writer': None,
+                'keith_seq_running': False, 'keith_busy': False,
+                'current_stream': None,
+                'stream_rate': kt.get('stream_rate', 10.0),
+                'stream_nplc': kt.get('stream_nplc', 1.0),
+                'iv_df': pd.DataFrame(), 'cv_df': pd.DataFrame(),
+                'bias_seq_table': Table(), 'max_bias': Field(1.0),
+                'voltage_steps': Field(21),
+                'cv_sweep_rates': Field('0.3, 0.1, 0.05'),
+                'pause_after_cycle': Field(0),
+                'keith_address': Field(kt.get('address', '')),
+                'list_sweep': Field(checked=kt.get('list_sweep', False)),
+                'measure_current_now': Field(
+                        checked=kt.get('measure_current', False)),
+                'stream_current': Field(
+                        checked=kt.get('stream_current', False))})
+        self.eis_dict = Panel(common, **{
+                'eis_dev': None, 'new_data': None, 'eis_df': pd.DataFrame(),
+                'eis_busy': False, 'eis_config': None, 'eis_tolerance': 0.5,
+                'solartron_address': Field(self.instruments.get(
+                        'solartron', {}).get('address', '')),
+                'start_freq': Field('1'), 'end_freq': Field('1,000,000'),
+                'eis_points': Field(20), 'averaging': Field(2),
+                'ac_bias': Field(0.1), 'dc_offset': Field(0),
+                'pause_after_eis': Field(0)})
+        self.spec_dict = Panel(common, **{
+                'spec_dev': None, 'new_data': None, 'spec_busy': False,
+                'optical_df': pd.DataFrame(), 'spec_int_time': Field(1000),
+                'set_spec_pause': Field(0)})
+        self.sark_dict = Panel(common, **{
+                'sark_dev': None, 'new_data': None, 'sark_busy': False,
+                'nth_qcm_loop': 0, 'bvd_fitter': sark.BvdFitter(),
+                'qcm_data': sark.new_qcm_data(), 'set_f0': Field(5),
+                'set_band_points': Field(1500),
+                'set_qcm_averaging': Field(1),
+                'n_on_fields': {n: Field(checked=n == '1')
+                                for n in harmonics},
+                'bc_fields': {n: Field(int(n)*5000000) for n in harmonics},
+                'bw_fields': {n: Field(int(n)*10000) for n in harmonics},
+                'f0_displays': {n: Field() for n in harmonics}})
+        # dictionary of each instrument which runs measurements
+        self.panels = {'keithley': self.keith_dict,
+                       'solartron': self.eis_dict,
+                       'spectrometer': self.spec_dict,
+                       'sark110': self.sark_dict}
+        self.widgets = sequence.setpoint_widgets(
+                self.rh_dict, self.vac_dict, self.keith_dict)
+        self.setters = {channel: widget.setValue
+                        for channel, widget in self.widgets.items()}
+
+    def connect(self):
+        # connect to each instrument in the config and return a list of
+        # the instruments which could not connect. the pressure
+        # controller is connected first because the turbo pump needs it.
+        checked = {'mks': vac.mks_checked, 'mfc1': vac.mfc1_checked,
+                   'mfc2': vac.mfc2_checked, 'turbo': vac.turbo_checked}
+        for name in ['mks', 'mfc1', 'mfc2', 'turbo']:
+            if name in self.instruments:
+                self.vac_dict[name+'_on'].setChecked(True)
+                checked[name](self.vac_dict)
+        if 'rh200' in self.instruments:
+            self.rh_dict['rh200_on'].setChecked(True)
+            rh200.checked(self.rh_dict)
+        if 'keithley' in self.instruments:
+            self.keith_dict['keithley_on'].setChecked(True)
+            keith.checked(self.keith_dict)
+        if 'solartron' in self.instruments:
+            self.eis_dict['eis_on'].setChecked(True)
+            eis.eis_checked(self.eis_dict)
+        if 'spectrometer' in self.instruments:
+            self.spec_dict['spec_on'].setChecked(True)
+            spec.spec_checked(self.spec_dict)
+        if 'sark110' in self.instruments:
+            self.sark_dict['sark_on'].setChecked(True)
+            sark.checked(self.sark_dict)
+        return [name for name in self.instruments
+                if not self.connected(name)]
+
+    def connected(self, name):
+        # check whether an instrument in the config is connected
+        if name in ['mks', 'mfc1', 'mfc2', 'turbo']:
+            return self.vac_dict[name+'_on'].isChecked()
+        if name == 'rh200':
+            return self.rh_dict['rh200_on'].isChecked()
+        if name == 'keithley':
+            return self.keith_dict['keithley_on'].isChecked()
+        if name == 'solartron':
+            return self.eis_dict['eis_on'].isChecked()
+        if name == 'spectrometer':
+            return self.spec_dict['spec_on'].isChecked()
+        if name == 'sark110':
+            return self.sark_dict['sark_dev'] is not None
+        return False
+
+    def set_setpoint(self, channel, value):
+        # set the setpoint of a channel ('rh', 'pressure', 'mfc1', 'mfc2'
+        # or 'bias'). it is sent to the instrument at the next iteration.
+        self.setters[channel](float(value))
+
+    def subscribe(self, callback):
+        # call callback(row) after each iteration, where row is a
+        # dictionary of the values in the new row of the master buffer,
+        # and the new lines of the output box in row['messages']
+        self.subscribers.append(callback)
+
+    def run_sequence(self, timeline, ramp_interval=1.0):
+        # start running a timeline of setpoints (see sequence.py) and
+        # return its SequenceRunner. ramps at the start of the timeline
+        # start from the current setpoints.
+        self.stop_sequence()
+        initial = {channel: float(widget.value())
+                   for channel, widget in self.widgets.items()}
+        schedule = sequence.compile_timeline(timeline, ramp_interval,
+                                             initial)
+        self.runner = sequence.SequenceRunner(
+                schedule, self.setters, name='engine_sequence')
+        self.output_box.append('Sequence started ({:.1f} min).'.format(
+                schedule.duration/60))
+        self.runner.start()
+        return self.runner
+
+    def stop_sequence(self):
+        # stop the running sequence, if any
+        if self.runner is not None:
+            self.runner.stop()
+            self.runner.join()
+
+    def busy(self, kind):
+        # check whether the instrument of a type of measurement is busy
+        instrument, busy_key, _ = measurements[kind]
+        return self.panels[instrument][busy_key]
+
+    def measure(self, kind):
+        # start a measurement on its own thread and return True, or return
+        # False if its instrument is busy. the instrument is marked busy
+        # until the measurement is finished, even if it fails.
+        instrument, busy_key, function = measurements[kind]
+        panel = self.panels[instrument]
+        if panel[busy_key]:
+            return False
+        panel[busy_key] = True
+        args = (panel,) if kind in ['qcm', 'optical'] else (
+                panel, self.df, self.df_i)
+
+        def run():
+            try:
+                function(*args)
+            except Exception as e:
+                self.output_box.append('{} measurement failed: {}'.format(
+                        kind, e))
+            finally:
+                panel[busy_key] = False
+
+        thread = threading.Thread(target=run, name='engine_'+kind,
+                                  daemon=True)
+        self.measure_threads = [t for t in self.measure_threads
+                                if t.is_alive()] + [thread]
+        thread.start()
+        return True
+
+    def wait_measurements(self):
+        # wait until all running measurements are finished
+        for thread in self.measure_threads:
+            thread.join()
+        self.measure_threads = []
+
+    def sequence_done(self):
+        # check whether a sequence was run and has finished
+        return self.runner is not None and not self.runner.is_alive()
+
+    def tick(self):
+        # run one iteration of the main loop and return the new row
+        update_instruments(self.rh_dict, self.vac_dict, self.keith_dict,
+                           self.df, self.df_i)
+        row_i = self.df_i
+        self.df, self.df_i = ops.main_loop_update(
+                self.ops_dict, self.df, self.df_i)
+        self.ticks += 1
+        row = {col: self.df.get(col, row_i) for col in self.df.num_columns}
+        row['messages'] = self.output_box.lines[self._messages_sent:]
+        self._messages_sent = len(self.output_box.lines)
+        for callback in self.subscribers:
+            callback(row)
+        return row
+
+    def run(self, duration=None, ticks=None, until_sequence_done=False):
+        # run the main loop at a fixed rate until stop() is called, or
+        # until 'duration' seconds or 'ticks' iterations have passed, or
+        # the sequence has finished if 'until_sequence_done' is True
+        self._stop_event.clear()
+        start = time.time()
+        next_time = start
+        n = 0
+        while not self._stop_event.is_set():
+            self.tick()
+            n += 1
+            if ticks is not None and n >= ticks:
+                break
+            if duration is not None and time.time() - start >= duration:
+                break
+            if until_sequence_done and self.sequence_done():
+                break
+            next_time += self.config['loop_delay']
+            next_time = max(next_time, time.time())
+            self._stop_event.wait(next_time - time.time())
+
+    def stop(self):
+        # stop run() after the current iteration. safe from any thread.
+        self._stop_event.set()
+
+    def close(self):
+        # stop the sequence and the workers, disconnect the instruments
+        # and close the data files. running measurements are finished
+        # first.
+        self.stop_sequence()
+        self.wait_measurements()
+        keith.stop_current_stream(self.keith_dict)
+        if self.keith_dict['keithley_on'].isChecked():
+            self.keith_dict['keithley_on'].setChecked(False)
+            keith.checked(self.keith_dict)
+        if self.rh_dict['rh200_on'].isChecked():
+            self.rh_dict['rh200_on'].setChecked(False)
+            rh200.checked(self.rh_dict)
+        # the turbo pump is disconnected before the pressure controller
+        checked = {'mks': vac.mks_checked, 'mfc1': vac.mfc1_checked,
+                   'mfc2': vac.mfc2_checked, 'turbo': vac.turbo_checked}
+        for name in ['turbo', 'mfc1', 'mfc2', 'mks']:
+            if self.vac_dict[name+'_on'].isChecked():
+                self.vac_dict[name+'_on'].setChecked(False)
+                checked[name](self.vac_dict)
+        if self.eis_dict['eis_on'].isChecked():
+            self.eis_dict['eis_on'].setChecked(False)
+            eis.eis_checked(self.eis_dict)
+        if self.spec_dict['spec_on'].isChecked():
+            self.spec_dict['spec_on'].setChecked(False)
+            spec.spec_checked(self.spec_dict)
+        if self.sark_dict['sark_dev'] is not None:
+            self.sark_dict['sark_on'].setChecked(False)
+            sark.checked(self.sark_dict)
+            self.sark_dict['sark_dev'] = None
+        workers.stop_all(self.vac_dict['workers'])
+        keith.close_bs_writer(self.keith_dict)
+        sark.close_qcm_data(self.sark_dict['qcm_data'])
+        ops.close_main_df(self.ops_dict, self.df, self.df_i)
+
@@ -6,6 +6,7 @@ executing I-V and C-V measurements.
 
 Packages required:
 time
+threading
 numpy
 pymeasure
 matplotlib
@@ -19,13 +20,23 @@ Created on Tue Jan 15 17:33:40 2019
 # from PyQt5.QtCore import QThreadPool, pyqtSignal, QRunnable
 
 import time
+import threading
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib import cm
-from pymeasure.instruments.keithley import Keithley2400
+from imes_libs import sim
+from imes_libs import storage
 fontsize = 12
 
+# maximum number of points in a source list of the Keithley 2400
+max_list_points = 100
+# power line frequency in Hz, used to get the integration time of readings
+line_freq = 60.0
+# columns of the bias sequence file, which holds one row per reading of
+# every bias sequence. time is in minutes from the start of the sequence.
+bs_columns = ['sequence', 'time', 'bias', 'current']
+
 
 def initialize(device_address):
     '''Set up Keithley device using the GPIB address of the multimeter.
@@ -35,7 +46,11 @@ def initialize(device_address):
         device_address = 'GPIB::24'
     Returns a device instance.
     '''
-    dev = Keithley2400(device_address)
+    if sim.enabled():
+        dev = sim.SimKeithley2400()
+    else:
+        from pymeasure.instruments.keithley import Keithley2400
+        dev = Keithley2400(device_address)
     dev.reset()
     dev.use_front_terminals()
     dev.measure_current(current=0.1)  # set current compliance
@@ -83,6 +98,188 @@ def get_current(dev):
     return dev.current
 
 
+def restore_single_reading(dev):
+    # Return the multimeter to the state set up by initialize() after a
+    # list sweep or current logging, so each ':READ?' through dev.current
+    # gives one current reading at the fixed source voltage.
+    dev.write(':SOUR:VOLT:MODE FIX')
+    dev.write(':TRIG:COUN 1')
+    dev.write(':TRIG:DEL 0')
+    dev.write(':SOUR:DEL:AUTO ON')
+    dev.write(':SENS:CURR:NPLC 1')
+    dev.write(':FORM:ELEM CURR')
+
+
+def list_sweep(dev, biases, delay, nplc=1):
+    '''Measure current at a list of biases using the source list and
+    trigger model of the Keithley, so the sweep is timed by the instrument.
+    The list is loaded into the instrument, each bias is held for the
+    source delay plus the integration time of nplc power line cycles, and
+    all readings are fetched in one transfer. Lists longer than
+    'max_list_points' are measured in consecutive chunks.
+    Returns arrays of current and of the time of each reading in seconds
+    from the start of the sweep, as measured by the instrument.
+    '''
+    biases = np.asarray(biases, dtype=float)
+    currents = np.empty(len(biases))
+    times = np.empty(len(biases))
+    dev.write(':SENS:FUNC "CURR"')
+    dev.write(':SENS:CURR:NPLC {}'.format(nplc))
+    dev.write(':SOUR:FUNC VOLT')
+    dev.write(':SOUR:VOLT:MODE LIST')
+    dev.write(':SOUR:DEL {:.6f}'.format(max(0, delay)))
+    dev.write(':FORM:ELEM CURR,TIME')
+    # reset the timestamp so the first reading of the sweep is near zero
+    dev.write(':SYST:TIME:RES')
+    dev.write(':OUTP ON')
+    try:
+        for start in range(0, len(biases), max_list_points):
+            chunk = biases[start:start+max_list_points]
+            dev.write(':SOUR:LIST:VOLT '+','.join(
+                    '{:.6g}'.format(v) for v in chunk))
+            dev.write(':TRIG:COUN {}'.format(len(chunk)))
+            # readings are pairs of current and timestamp
+            readings = np.array(dev.values(':READ?'), dtype=float)
+            currents[start:start+len(chunk)] = readings[0::2]
+            times[start:start+len(chunk)] = readings[1::2]
+    finally:
+        restore_single_reading(dev)
+    return currents, times
+
+
+def measure_biases(keith_dict, biases, delay):
+    # Measure current at each bias in a list, using the hardware list sweep
+    # if it is selected on the GUI or by stepping the bias from the PC,
+    # with 'delay' seconds per point. Returns arrays of current and the
+    # time of each reading in seconds.
+    dev = keith_dict['keith_dev']
+    if keith_dict['list_sweep'].isChecked():
+        # the integration time of each reading is part of the time per
+        # point, so the sweep rate is set by the instrument
+        current_list, times = list_sweep(
+                dev, biases, delay - 1/line_freq)
+        keith_dict['new_data'] = np.column_stack((biases, current_list))
+        keith_dict['actual_bias'].setText(
+                str(np.round(biases[-1], decimals=8)))
+        keith_dict['current_display'].setText(
+                str(np.round(current_list[-1], decimals=11)))
+        return current_list, times
+    current_list = np.zeros_like(biases)
+    times = np.zeros_like(biases)
+    start_time = time.time()
+    # loop through each applied voltage level
+    for v_i, v0 in enumerate(biases):
+        # apply voltage
+        apply_bias(dev, v0)
+        time.sleep(delay)
+        # read current
+        current_list[v_i] = get_current(dev)
+        times[v_i] = time.time() - start_time
+        keith_dict['new_data'] = np.column_stack(
+                (biases, current_list))[:v_i]
+        keith_dict['actual_bias'].setText(str(np.round(v0, decimals=8)))
+        keith_dict['current_display'].setText(
+                str(np.round(current_list[v_i], decimals=11)))
+    return current_list, times
+
+
+class CurrentStream(threading.Thread):
+    # Thread which holds a constant bias and logs current at a fixed rate.
+    # Readings are taken in batches by the trigger model of the Keithley,
+    # timed by the instrument, and each batch is fetched in one transfer.
+    # Every reading is appended to a log file with its timestamp, and the
+    # mean of the readings since the last call to decimated() can be used
+    # for the main data table. The bias can be changed while streaming with
+    # set_bias(), and takes effect at the next batch.
+
+    def __init__(self, dev, bias, filepath, rate=10.0, nplc=1.0,
+                 batch_time=0.5):
+        super().__init__(name='keithley_current', daemon=True)
+        self.dev = dev
+        self.bias = float(bias)
+        self.new_bias = None
+        self.rate = float(rate)
+        self.nplc = float(nplc)
+        # number of readings in each batch
+        self.batch = max(1, int(round(self.rate * batch_time)))
+        self.writer = storage.AppendCSVWriter(
+                filepath, ['timestamp', 'bias', 'current'], fsync_every=20)
+        self.error = None
+        self.readings = 0
+        self.latest = None
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def set_bias(self, bias):
+        # change the bias at the start of the next batch
+        if float(bias) != self.bias:
+            self.new_bias = float(bias)
+
+    def decimated(self):
+        # get mean current since the last call, or None if there are no
+        # new readings
+        with self._lock:
+            if self._count == 0:
+                return None
+            mean = self._sum / self._count
+            self._sum, self._count = 0.0, 0
+        return mean
+
+    def stop(self, timeout=5):
+        # stop streaming after the current batch and close the log file
+        self._stop_event.set()
+        self.join(timeout)
+
+    def configure(self):
+        # hold the bias and set up the trigger model for batches
+        dev = self.dev
+        dev.write(':SENS:FUNC "CURR"')
+        dev.write(':SENS:CURR:NPLC {}'.format(self.nplc))
+        dev.write(':SOUR:FUNC VOLT')
+        dev.write(':SOUR:VOLT:MODE FIX')
+        dev.write(':SOUR:VOLT:LEV {:.6g}'.format(self.bias))
+        dev.write(':SOUR:DEL 0')
+        # the delay between readings sets the rate
+        delay = max(0, 1/self.rate - self.nplc/line_freq)
+        dev.write(':TRIG:DEL {:.6f}'.format(delay))
+        dev.write(':TRIG:COUN {}'.format(self.batch))
+        dev.write(':FORM:ELEM CURR,TIME')
+        dev.write(':SYST:TIME:RES')
+        # instrument timestamps are relative to this time
+        self.time_zero = time.time()
+        dev.write(':OUTP ON')
+
+    def run(self):
+        try:
+            self.configure()
+            while not self._stop_event.is_set():
+                if self.new_bias is not None:
+                    self.bias, self.new_bias = self.new_bias, None
+                    self.dev.write(':SOUR:VOLT:LEV {:.6g}'.format(self.bias))
+                # readings are pairs of current and timestamp
+                readings = np.array(self.dev.values(':READ?'), dtype=float)
+                currents = readings[0::2]
+                timestamps = self.time_zero + readings[1::2]
+                self.writer.append(
+                        [[t, self.bias, c] for t, c in zip(
+                                timestamps, currents)])
+                with self._lock:
+                    self._sum += np.sum(currents)
+                    self._count += len(currents)
+                self.latest = currents[-1]
+                self.readings += len(currents)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.writer.close()
+            try:
+                restore_single_reading(self.dev)
+            except Exception:
+                pass
+
+
 def close(dev):
     # Close communication with multimeter (dev=initialize(device_address))
     dev.disable_source()
@@ -161,12 +358,18 @@ def get_current_continuously(keith_dict, df, df_i):
         keith_dict['keith_busy'] = True
 
         bias = float(keith_dict['set_bias'].value())
-        apply_bias(keith_dict['keith_dev'], bias)
-
-        current0 = get_current(keith_dict['keith_dev'])
+        if keith_dict['stream_current'].isChecked():
+            # high-rate logging runs on its own thread, and only the mean
+            # current since the last main loop iteration is saved here
+            current0 = stream_current(keith_dict, bias)
+            if current0 is None:
+                return
+        else:
+            apply_bias(keith_dict['keith_dev'], bias)
+            current0 = get_current(keith_dict['keith_dev'])
         # save results to file
-        df['bias'].iloc[df_i] = str(bias)
-        df['current'].iloc[df_i] = str(current0)
+        df.set('bias', bias, df_i)
+        df.set('current', current0, df_i)
         # display on GUI
         keith_dict['actual_bias'].setText(
                 str(np.round(bias, decimals=8)))
@@ -174,6 +377,7 @@ def get_current_continuously(keith_dict, df, df_i):
                 str(np.round(current0, decimals=11)))
 
     if not keith_dict['measure_current_now'].isChecked():  # if current stopped
+        stop_current_stream(keith_dict)
         remove_bias(keith_dict)
         keith_dict['actual_bias'].setText('0')
         keith_dict['current_display'].setText('--')
@@ -186,15 +390,45 @@ def get_current_continuously(keith_dict, df, df_i):
         plt.close()
 
 
+def stream_current(keith_dict, bias):
+    # start high-rate current logging if it is not running, and get the
+    # mean current since the last call, or None if there is no new reading
+    stream = keith_dict['current_stream']
+    if stream is None:
+        stream = CurrentStream(
+                keith_dict['keith_dev'], bias,
+                keith_dict['save_file_dir']+'/'+keith_dict[
+                        'start_date']+'_current.csv',
+                rate=keith_dict['stream_rate'],
+                nplc=keith_dict['stream_nplc'])
+        stream.start()
+        keith_dict['current_stream'] = stream
+        keith_dict['output_box'].append(
+                'Logging current at {} Hz.'.format(stream.rate))
+    if stream.error is not None:
+        keith_dict['output_box'].append(
+                'Current logging stopped: '+str(stream.error))
+        keith_dict['current_stream'] = None
+        keith_dict['measure_current_now'].setChecked(False)
+        return None
+    stream.set_bias(bias)
+    return stream.decimated()
+
+
+def stop_current_stream(keith_dict):
+    # stop high-rate current logging if it is running
+    if keith_dict['current_stream'] is not None:
+        keith_dict['current_stream'].stop()
+        keith_dict['current_stream'] = None
+
+
 def plot_current(df):
     # plot current over time
     plt.ion
     fig_current = plt.figure(5)
     fig_current.clf()
-    df_current = df[df['current'] != '']
-    plt.plot(pd.to_numeric(df_current['time']),
-             pd.to_numeric(df_current['current']),
-             c='r', lw=1)
+    current_time, current = df.select('current', 'time', 'current')
+    plt.plot(current_time, current, c='r', lw=1)
     plt.xlabel('Elapsed time (min)', fontsize=fontsize)
     plt.ylabel('Current (A)', fontsize=fontsize)
     fig_current.canvas.set_window_title('Sample current')
@@ -214,23 +448,10 @@ def measure_iv(keith_dict, df, df_i):
     keith_dict['keith_busy'] = True
     iv_biases, _ = get_bias_voltages(float(keith_dict['max_bias'].value()),
                                      int(keith_dict['voltage_steps'].value()))
-    current_list = np.empty_like(iv_biases)
     keith_dict['output_box'].append('Measuring I-V...')
     iv_time = time.strftime('%Y-%m-%d_%H-%M-%S_')
     keith_dict['new_data'] = None
-    # loop through each applied voltage level
-    for v_i, v0 in enumerate(iv_biases):
-        # apply voltage
-        apply_bias(keith_dict['keith_dev'], v0)
-        time.sleep(0.2)
-        # read current
-        current_list[v_i] = get_current(keith_dict['keith_dev'])
-
-        keith_dict['new_data'] = np.column_stack(
-                (iv_biases, current_list))[:v_i]
-        keith_dict['actual_bias'].setText(str(np.round(v0, decimals=8)))
-        keith_dict['current_display'].setText(
-                str(np.round(current_list[v_i], decimals=11)))
+    current_list, _ = measure_biases(keith_dict, iv_biases, 0.2)
 
     remove_bias(keith_dict)
     keith_dict['actual_bias'].setText('0')
@@ -258,9 +479,9 @@ def measure_iv(keith_dict, df, df_i):
     keith_dict['iv_df'].to_csv(
             keith_dict['save_file_dir']+'/'+keith_dict[
                                         'start_date']+'_iv.csv', index=False)
-    # save max current to main df
+    # save max current to the most recent row of main df
     max_current = np.amax(current_list)
-    df['max_iv_current'].iloc[df_i] = str(max_current)
+    df.set('max_iv_current', max_current)
     if keith_dict['keith_seq_running'] is True:
         pass
     else:
@@ -283,20 +504,10 @@ def measure_cv(keith_dict, df, df_i):
     keith_dict['new_data'] = None
     _, cv_biases = get_bias_voltages(float(keith_dict['max_bias'].value()),
                                      int(keith_dict['voltage_steps'].value()))
-    current_list = np.empty_like(cv_biases)
     keith_dict['output_box'].append('Measuring C-V...')
     iv_time = time.strftime('%Y-%m-%d_%H-%M-%S_')
 
-    # loop through each applied voltage level
-    for v_i, v0 in enumerate(cv_biases):
-        # apply voltage
-        apply_bias(keith_dict['keith_dev'], v0)
-        time.sleep(0.2)
-        # read current
-        current_list[v_i] = get_current(keith_dict['keith_dev'])
-        keith_dict['actual_bias'].setText(str(np.round(v0, decimals=8)))
-        keith_dict['current_display'].setText(
-                str(np.round(current_list[v_i], decimals=11)))
+    current_list, _ = measure_biases(keith_dict, cv_biases, 0.2)
     keith_dict['output_box'].append('C-V measurement complete.')
     remove_bias(keith_dict)
     keith_dict['actual_bias'].setText('0')
@@ -323,10 +534,10 @@ def measure_cv(keith_dict, df, df_i):
             keith_dict['save_file_dir']+'/'+keith_dict[
                                         'start_date']+'_cv.csv', index=False)
 
-    # save capacitance to main df
+    # save capacitance to the most recent row of main df
     capacitance, max_cv_current = get_capacitance(cv_biases, current_list)
-    df['cv_area'].iloc[df_i] = str(capacitance)
-    df['max_cv_current'].iloc[df_i] = str(max_cv_current)
+    df.set('cv_area', capacitance)
+    df.set('max_cv_current', max_cv_current)
     if keith_dict['keith_seq_running'] is True:
         pass
     else:
@@ -371,20 +582,13 @@ def measure_multi_cv(keith_dict, df, df_i):
     for delay_i, delay0 in enumerate(delays):
         rate0 = rates_list[delay_i]
         save_rate = '_'+str(np.round(rate0, decimals=3))+'V/s_'
-        current_list = np.zeros_like(cv_biases)
-        # loop through each applied voltage level
-        for v_i, v0 in enumerate(cv_biases):
-            # apply voltage
-            apply_bias(keith_dict['keith_dev'], v0)
-            time.sleep(delay0)
-            # read current
-            current_list[v_i] = get_current(keith_dict['keith_dev'])
-            keith_dict['actual_bias'].setText(str(np.round(v0, decimals=8)))
-            keith_dict['current_display'].setText(
-                    str(np.round(current_list[v_i], decimals=11)))
-
-            keith_dict['new_data'] = np.column_stack(
-                    (cv_biases, current_list))[:v_i]
+        current_list, times = measure_biases(keith_dict, cv_biases, delay0)
+        # report the sweep rate measured from the time of each reading
+        measured_rate = np.sum(np.abs(np.diff(cv_biases))) / (
+                times[-1] - times[0])
+        keith_dict['output_box'].append(
+                'Sweep rate set to {} V/s, measured {} V/s.'.format(
+                        rate0, np.round(measured_rate, decimals=4)))
 
         # append new data to C-V dataframe. first create empty cells to fill.
         # this is done so C-V curves with different lengths can be appended
@@ -395,10 +599,10 @@ def measure_multi_cv(keith_dict, df, df_i):
     keith_dict['cv_df'].to_csv(
             keith_dict['save_file_dir']+'/'+keith_dict[
                                         'start_date']+'_cv.csv', index=False)
-    # save capacitance to main df
+    # save capacitance to the most recent row of main df
     capacitance, max_cv_current = get_capacitance(cv_biases, current_list)
-    df['cv_area'].iloc[df_i] = str(capacitance)
-    df['max_cv_current'].iloc[df_i] = str(max_cv_current)
+    df.set('cv_area', capacitance)
+    df.set('max_cv_current', max_cv_current)
     keith_dict['output_box'].append('C-V measurement complete.')
     remove_bias(keith_dict)
     keith_dict['actual_bias'].setText('0')
@@ -527,23 +731,21 @@ def view_bs_data(keith_dict):
     bs_file = keith_dict['save_file_dir']+'/'+keith_dict[
             'start_date']+'_bs.csv'
     bs_data = pd.read_csv(bs_file)
+    sequences = list(bs_data.groupby('sequence', sort=False))
 
     plt.ion
     fig_bsd = plt.figure(32)
     fig_bsd.clf()
-    # loop over each I-V measurement
-    for i in range(0, len(bs_data.columns)-1, 3):
-        colors = cm.jet(np.linspace(0, 1, len(bs_data.columns)-1))
-
-        plt.plot(bs_data.iloc[:, i].astype(float),
-                 bs_data.iloc[:, i+2].astype(float),
-                 c=colors[int(i/3)],
-                 label=str(int(i/3)))
+    # loop over each bias sequence
+    colors = cm.jet(np.linspace(0, 1, max(len(sequences), 1)))
+    for i, (_, seq_data) in enumerate(sequences):
+        plt.plot(seq_data['time'], seq_data['current'],
+                 c=colors[i], label=str(i))
     plt.xlabel('Time (min)', fontsize=fontsize)
     plt.ylabel('Current (A)', fontsize=fontsize)
     plt.legend()
     fig_bsd.canvas.set_window_title(
-            'Displaying '+str(int(len(bs_data.columns)/2))+' bias sequences')
+            'Displaying '+str(len(sequences))+' bias sequences')
     plt.tight_layout()
     plt.draw()
 
@@ -553,10 +755,9 @@ def iv_max_vs_time(keith_dict, df, df_i):
     plt.ion
     fig_current = plt.figure(60)
     fig_current.clf()
-    df_current = df[df['max_iv_current'] != '']
-    plt.plot(pd.to_numeric(df_current['time']),
-             pd.to_numeric(df_current['max_iv_current']),
-             c='r', lw=1)
+    current_time, current = df.select(
+            'max_iv_current', 'time', 'max_iv_current')
+    plt.plot(current_time, current, c='r', lw=1)
     plt.xlabel('Elapsed time (min)', fontsize=fontsize)
     plt.ylabel('Max. I-V current (A)', fontsize=fontsize)
     fig_current.canvas.set_window_title('Max. I-V current')
@@ -569,10 +770,9 @@ def cv_max_vs_time(keith_dict, df, df_i):
     plt.ion
     fig_current = plt.figure(60)
     fig_current.clf()
-    df_current = df[df['max_cv_current'] != '']
-    plt.plot(pd.to_numeric(df_current['time']),
-             pd.to_numeric(df_current['max_cv_current']),
-             c='r', lw=1)
+    current_time, current = df.select(
+            'max_cv_current', 'time', 'max_cv_current')
+    plt.plot(current_time, current, c='r', lw=1)
     plt.xlabel('Elapsed time (min)', fontsize=fontsize)
     plt.ylabel('Max. C-V current (A)', fontsize=fontsize)
     fig_current.canvas.set_window_title('Max. C-V current')
@@ -585,10 +785,8 @@ def cv_area_vs_time(keith_dict, df, df_i):
     plt.ion
     fig_current = plt.figure(60)
     fig_current.clf()
-    df_current = df[df['cv_area'] != '']
-    plt.plot(pd.to_numeric(df_current['time']),
-             pd.to_numeric(df_current['cv_area']),
-             c='r', lw=1)
+    current_time, current = df.select('cv_area', 'time', 'cv_area')
+    plt.plot(current_time, current, c='r', lw=1)
     plt.xlabel('Elapsed time (min)', fontsize=fontsize)
     plt.ylabel('C-V area (V A)', fontsize=fontsize)
     fig_current.canvas.set_window_title('C-V area')
@@ -612,9 +810,9 @@ def measure_bias_seq(keith_dict, df, df_i):
     keith_dict['max_bias'].setEnabled(False)
     keith_dict['voltage_steps'].setEnabled(False)
     keith_dict['keith_busy'] = True
-    # create empty array to hold measured data
-    bs_results = np.empty((0, 3))
-    bs_time = time.strftime('%Y-%m-%d_%H-%M-%S_')
+    # rows are appended to the bias sequence file as they are measured
+    bs_writer = get_bs_writer(keith_dict)
+    bs_time = time.strftime('%Y-%m-%d_%H-%M-%S')
     bs_start_time = time.time()
 
     for i in range(len(bias_seq)):
@@ -635,8 +833,8 @@ def measure_bias_seq(keith_dict, df, df_i):
             new_row = [(time.time() - bs_start_time)/60,
                        step_biases[i],
                        current0]
-            # add results to saved bias array
-            bs_results = np.vstack((bs_results, new_row))
+            # save results to file
+            bs_writer.append([[bs_time] + new_row])
 
     remove_bias(keith_dict)
     keith_dict['actual_bias'].setText('0')
@@ -648,22 +846,8 @@ def measure_bias_seq(keith_dict, df, df_i):
     keith_dict['set_bias'].setEnabled(True)
     keith_dict['max_bias'].setEnabled(True)
     keith_dict['voltage_steps'].setEnabled(True)
-    # append new data to bias seq dataframe. #first create empty cells to
-    # fill so bias sequences with different lengths can be appended
-    keith_dict['bs_df']['time_'+bs_time] = np.repeat('', 10000)
-    keith_dict['bs_df']['bias_'+bs_time] = np.repeat('', 10000)
-    keith_dict['bs_df']['current_'+bs_time] = np.repeat('', 10000)
-    # now fill empty cells with new data
-    keith_dict['bs_df']['time_'+bs_time].iloc[
-            :(len(bs_results))] = bs_results[:, 0].astype(str)
-    keith_dict['bs_df']['bias_'+bs_time].iloc[
-            :(len(bs_results))] = bs_results[:, 1].astype(str)
-    keith_dict['bs_df']['current_'+bs_time].iloc[
-            :(len(bs_results))] = bs_results[:, 2].astype(str)
-    # save bias seq data to file
-    keith_dict['bs_df'].to_csv(
-            keith_dict['save_file_dir']+'/'+keith_dict[
-                    'start_date']+'_bs.csv', index=False)
+    # make sure the whole sequence is written to disk
+    bs_writer.sync()
     if keith_dict['keith_seq_running'] is True:
         pass
     else:
@@ -673,6 +857,24 @@ def measure_bias_seq(keith_dict, df, df_i):
     # plt.close()
 
 
+def get_bs_writer(keith_dict):
+    # get the writer of the bias sequence file. the file is created, or
+    # replaced after DC data was cleared, when the first row is saved.
+    if keith_dict['bs_writer'] is None:
+        keith_dict['bs_writer'] = storage.AppendCSVWriter(
+                keith_dict['save_file_dir']+'/'+keith_dict[
+                        'start_date']+'_bs.csv',
+                bs_columns, fsync_every=50, overwrite=True)
+    return keith_dict['bs_writer']
+
+
+def close_bs_writer(keith_dict):
+    # close the bias sequence file
+    if keith_dict['bs_writer'] is not None:
+        keith_dict['bs_writer'].close()
+        keith_dict['bs_writer'] = None
+
+
 def keith_rh_seq(keith_dict, df, df_i):
     # measure keithley functions during RH sequence
     keith_dict['keith_busy'] = True
@@ -714,9 +916,6 @@ def keith_vac_seq(keith_dict, df, df_i):
 
 if __name__ == '__main__':
     print('testing device...')
-    dev = Keithley2400('GPIB2::24')
-    dev.reset()
-    dev.use_front_terminals()
-    dev.measure_current(current=0.1)  # set current compliance
+    dev = initialize('GPIB2::24')
     close(dev)
     print('test successful')
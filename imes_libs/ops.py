@@ -13,11 +13,11 @@ Created on Mon Feb  4 10:37:07 2019
 
 import os
 import time
-import visa
 import subprocess
 import numpy as np
 import inspect
-import pywinusb.hid as hid
+from imes_libs import storage
+from imes_libs import sim
 from PyQt5.QtWidgets import QLabel, QComboBox, QLineEdit, QSlider
 from PyQt5.QtWidgets import QSpinBox, QDoubleSpinBox, QCheckBox, QRadioButton
 from PyQt5.QtCore import QSettings
@@ -35,44 +35,67 @@ def main_loop_update(ops_dict, df, df_i):
     ops_dict['main_loop_counter_display'].setText(str(df_i))
 
     # record date/time and elapsed time at each iteration
-    df['date'].iloc[df_i] = str(time.strftime('%Y-%m-%d_%H-%M-%S_'))[:-1]
+    df.set('date', time.time(), df_i)
 
     elapsed_time = np.round((
             time.time()-ops_dict['start_time'])/60, decimals=3)
     ops_dict['elapsed_time'] = elapsed_time
-    df['time'].iloc[df_i] = str(elapsed_time)
-    df['note'].iloc[df_i] = ops_dict['sample_name'].text()
+    df.set('time', elapsed_time, df_i)
+    df.set('note', ops_dict['sample_name'].text(), df_i)
     # save data
     if ops_dict['save_data_now'].isChecked():
         # mark current row as "saved"
-        df['save'].iloc[df_i] = 'on'
-        # every n points, save data to file
+        df.set('save', 1, df_i)
+        ops_dict['saved_rows'] += 1
+        # every n points, append newly saved rows to file
         if df_i % 10 == 0:
-            # remove extra rows
-            save_master_df = df[df['save'] == 'on']
-            # remove "save" column
-            save_master_df = save_master_df[save_master_df.columns[:-1]]
-
-            # rename MFC column headers to include gas names
-            gas1 = str(ops_dict['gas1'].currentText())
-            gas2 = str(ops_dict['gas2'].currentText())
-            save_master_df = save_master_df.rename(
-                    columns={'mfc1': 'mfc1_'+gas1,
-                             'mfc2': 'mfc2_'+gas2})
-
-            # save dataframe to file
-            save_master_df.to_csv(
-                    ops_dict['save_file_dir']+'/'+ops_dict[
-                            'start_date']+'_main_df.csv', index=False)
+            save_main_df(ops_dict, df, df_i)
     # update GUI indicator of number of save data rows
-    ops_dict['rows_of_saved_data'].setText(str(len(df[df['save'] != ''])))
-    # increment main loop counter
-    df_i = df_i + 1
+    ops_dict['rows_of_saved_data'].setText(str(ops_dict['saved_rows']))
+    # add a new row to the master buffer and increment main loop counter
+    df_i = df.new_row()
     return df, df_i
 
 
+def save_main_df(ops_dict, df, df_i):
+    # Append rows which were marked as "saved" since the last save to the
+    # main data file. The current row is left for the next save because
+    # instrument threads may still be writing to it during this iteration.
+    if ops_dict['main_df_writer'] is None:
+        # rename MFC column headers to include gas names
+        gas1 = str(ops_dict['gas1'].currentText())
+        gas2 = str(ops_dict['gas2'].currentText())
+        columns = [{'mfc1': 'mfc1_'+gas1, 'mfc2': 'mfc2_'+gas2}.get(col, col)
+                   for col in df.save_columns]
+        # header is written once when the file is created
+        ops_dict['main_df_writer'] = storage.AppendCSVWriter(
+                ops_dict['save_file_dir']+'/'+ops_dict[
+                        'start_date']+'_main_df.csv',
+                columns, fsync_every=ops_dict['fsync_every'])
+    # get only the new rows which were marked as "saved"
+    new_rows = df.saved_rows(ops_dict['main_df_saved_i'], df_i)
+    ops_dict['main_df_writer'].append(new_rows)
+    ops_dict['main_df_saved_i'] = df_i
+
+
+def close_main_df(ops_dict, df, df_i):
+    # Append rows which were saved since the last save, and close the main
+    # data file writer when the application quits. df_i is the row which
+    # the main loop fills next, so all earlier rows are complete.
+    if ops_dict['saved_rows'] > 0:
+        save_main_df(ops_dict, df, df_i)
+    if ops_dict['main_df_writer'] is not None:
+        ops_dict['main_df_writer'].close()
+        ops_dict['main_df_writer'] = None
+
+
 def list_devices(ops_dict):
     # list all connected devices in the GUi output box
+    if sim.enabled():
+        ops_dict['output_box'].append('Using simulated instruments.')
+        return
+    import visa
+    import pywinusb.hid as hid
     rm = visa.ResourceManager()
     visa_devs = rm.list_resources()
     # get SARK devices
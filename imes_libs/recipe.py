@@ -0,0 +1,582 @@
+# -*- coding: utf-8 -*-
+"""
+This module runs experiments from recipe files, so an unattended run can
+be set up from a file instead of checkboxes and tables on the GUI, and
+the same file can be used again for the next sample. A recipe is a JSON
+or YAML file which declares the instruments and their addresses, the
+starting setpoints, where to save data, and a list of sequences which
+run one after another. Each sequence has a timeline of setpoints (see
+sequence.py) and a list of measurements made at a fixed cadence while
+it runs. For example, in JSON:
+
+{"name": "humidity_iv",
+ "output": {"save_dir": "C:/data/%Y-%m-%d", "sample_name": "film_1"},
+ "loop_delay": 0.5,
+ "instruments": {"rh200": {"continuous_daq": true},
+                 "keithley": {"address": "GPIB::24"},
+                 "solartron": {"address": "GPIB1::4::INSTR"}},
+ "setpoints": {"rh": 5, "bias": 0.1},
+ "sequences": [
+    {"name": "rh_cycle", "ramp_interval": 10,
+     "timeline": {"rh": [{"type": "hold", "duration": 1800},
+                         {"type": "linear", "value": 90, "duration": 7200},
+                         {"type": "linear", "value": 5, "duration": 7200}]},
+     "measurements": [
+        {"type": "iv", "every": 600,
+         "settings": {"max_bias": 1, "voltage_steps": 21}},
+        {"type": "eis", "every": 1800, "start": 60,
+         "settings": {"start_freq": 1, "end_freq": 1e6, "points": 20}}]}]}
+
+Measurement types are 'iv', 'cv', 'bs' (bias sequence), 'eis', 'qcm' and
+'optical'. A measurement starts 'start' seconds after its sequence starts
+and then every 'every' seconds, or as often as possible if 'every' is 0.
+A measurement which is due while its instrument is busy starts when the
+instrument is free, and cadences missed in the meantime are skipped. The
+settings of each measurement type are listed in measurement_settings.
+Strftime codes such as %Y in 'save_dir' are filled in when the run
+starts, and file names start with the start time of the run, so files of
+earlier runs are not overwritten.
+
+load() reads and checks a recipe file. validate() returns a list of all
+problems in a recipe without connecting to the instruments, and
+summary() gives the duration of each sequence. RecipeRunner runs a
+recipe end to end on a headless Engine (see engine.py).
+
+Run from the IMES folder:
+python -m imes_libs.recipe my_recipe.json --check
+python -m imes_libs.recipe my_recipe.json
+python -m imes_libs.recipe --example my_recipe.json
+
+Packages required:
+os
+sys
+json
+math
+time
+argparse
+yaml (only for YAML recipes)
+
+Created on Sat Oct 17 22:40:05 2026
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+from imes_libs import engine
+from imes_libs import sequence
+
+# keys allowed at the top level of a recipe, and in its sections
+recipe_keys = ('name', 'description', 'output', 'loop_delay', 'instruments',
+               'setpoints', 'sequences')
+output_keys = ('save_dir', 'sample_name', 'save_data')
+sequence_keys = ('name', 'ramp_interval', 'timeline', 'measurements')
+measurement_keys = ('type', 'every', 'start', 'settings')
+
+# most setpoint events a sequence may have, so checking a recipe stays
+# fast and a very short ramp interval cannot fill the memory
+max_events = 1000000
+
+# instrument which each setpoint channel needs
+channel_instruments = {'rh': 'rh200', 'pressure': 'mks', 'mfc1': 'mfc1',
+                       'mfc2': 'mfc2', 'bias': 'keithley'}
+
+# settings of each type of measurement, with the key of the field which
+# holds the setting in the dictionary of the instrument, and its kind:
+# int, float, bool, freq (frequency in Hz), rates (list of sweep
+# rates in V/s), steps (list of [minutes, bias] steps) or harmonics
+# (dictionary of QCM harmonics to measure, each with an optional band
+# 'center' and 'width' in Hz)
+measurement_settings = {
+        'iv': {'max_bias': ('max_bias', 'float'),
+               'voltage_steps': ('voltage_steps', 'int')},
+        'cv': {'max_bias': ('max_bias', 'float'),
+               'voltage_steps': ('voltage_steps', 'int'),
+               'sweep_rates': ('cv_sweep_rates', 'rates')},
+        'bs': {'steps': ('bias_seq_table', 'steps')},
+        'eis': {'start_freq': ('start_freq', 'freq'),
+                'end_freq': ('end_freq', 'freq'),
+                'points': ('eis_points', 'int'),
+                'averaging': ('averaging', 'int'),
+                'ac_bias': ('ac_bias', 'float'),
+                'dc_offset': ('dc_offset', 'float'),
+                'adaptive_averaging': ('adaptive_averaging', 'bool')},
+        'qcm': {'harmonics': ('n_on_fields', 'harmonics'),
+                'band_points': ('set_band_points', 'int'),
+                'averaging': ('set_qcm_averaging', 'int'),
+                'adaptive_sweep': ('adaptive_sweep', 'bool'),
+                'dynamic_center': ('dynamic_bc', 'bool')},
+        'optical': {'integration_time': ('spec_int_time', 'int')}}
+
+# recipe written by --example, to start new recipes from
+example_recipe = {
+        'name': 'humidity_iv_eis',
+        'description': 'I-V and impedance during a slow RH cycle',
+        'output': {'save_dir': 'data/%Y-%m-%d', 'sample_name': 'film_1'},
+        'loop_delay': 0.5,
+        'instruments': {'rh200': {'continuous_daq': True},
+                        'keithley': {'address': 'GPIB::24'},
+                        'solartron': {'address': 'GPIB1::4::INSTR'}},
+        'setpoints': {'rh': 5, 'bias': 0.1},
+        'sequences': [
+                {'name': 'rh_cycle', 'ramp_interval': 10,
+                 'timeline': {'rh': [
+                         {'type': 'hold', 'duration': 1800},
+                         {'type': 'linear', 'value': 90, 'duration': 7200},
+                         {'type': 'hold', 'duration': 1800},
+                         {'type': 'linear', 'value': 5, 'duration': 7200}]},
+                 'measurements': [
+                         {'type': 'iv', 'every': 600,
+                          'settings': {'max_bias': 1, 'voltage_steps': 21}},
+                         {'type': 'eis', 'every': 1800, 'start': 60,
+                          'settings': {'start_freq': 1, 'end_freq': 1e6,
+                                       'points': 20}}]}]}
+
+
+def load(filename):
+    # read a recipe from a JSON or YAML file and check it. raises
+    # ValueError if the recipe has problems.
+    with open(filename) as f:
+        if filename.lower().endswith(('.yml', '.yaml')):
+            import yaml
+            recipe = yaml.safe_load(f)
+        else:
+            recipe = json.load(f)
+    check(recipe)
+    return recipe
+
+
+def save(recipe, filename):
+    # write a recipe to a JSON file
+    with open(filename, 'w') as f:
+        json.dump(recipe, f, indent=2)
+
+
+def is_number(value):
+    # check whether a value from a recipe file is a number
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_finite(value):
+    # check whether a number is finite, where integers too large for a
+    # float are not
+    try:
+        return math.isfinite(value)
+    except OverflowError:
+        return False
+
+
+def check_number(errors, where, value, positive=False, signed=False):
+    # add an error if a value is not a finite number, or is negative unless
+    # 'signed' is True, or is not positive if 'positive' is True
+    if not is_number(value):
+        errors.append('{}: {!r} is not a number.'.format(where, value))
+    elif not is_finite(value):
+        errors.append('{}: must be finite.'.format(where))
+    elif positive and value <= 0:
+        errors.append('{}: must be positive.'.format(where))
+    elif not signed and value < 0:
+        errors.append('{}: must not be negative.'.format(where))
+
+
+def check_keys(errors, where, section, keys):
+    # add an error if a section of a recipe is not a dictionary, or has
+    # keys which are not allowed
+    if not isinstance(section, dict):
+        errors.append('{}: must be a dictionary.'.format(where))
+        return False
+    for key in section:
+        if key not in keys:
+            errors.append('{}: unknown key {!r}.'.format(where, key))
+    return True
+
+
+def check_setting(errors, where, kind, value):
+    # add an error if the value of a measurement setting has the wrong
+    # form for its kind
+    if kind in ('int', 'float', 'freq'):
+        check_number(errors, where, value, positive=kind != 'float',
+                     signed=kind == 'float')
+        if kind == 'int' and is_number(value) and (
+                value != int(value)):
+            errors.append('{}: must be a whole number.'.format(where))
+    elif kind == 'bool':
+        if not isinstance(value, bool):
+            errors.append('{}: must be true or false.'.format(where))
+    elif kind == 'rates':
+        if not isinstance(value, list) or len(value) == 0:
+            errors.append('{}: must be a list of sweep rates.'.format(where))
+        else:
+            for rate in value:
+                check_number(errors, where, rate, positive=True)
+    elif kind == 'steps':
+        if not isinstance(value, list) or len(value) == 0:
+            errors.append('{}: must be a list of steps.'.format(where))
+            return
+        for i, step in enumerate(value):
+            if not isinstance(step, list) or len(step) != 2:
+                errors.append('{}[{}]: must be [minutes, bias].'.format(
+                        where, i))
+                continue
+            check_number(errors, '{}[{}]'.format(where, i), step[0],
+                         positive=True)
+            check_number(errors, '{}[{}]'.format(where, i), step[1],
+                         signed=True)
+    elif kind == 'harmonics':
+        # harmonic numbers may be numbers in YAML files
+        if isinstance(value, dict):
+            value = {str(n): band for n, band in value.items()}
+        if not check_keys(errors, where, value, engine.harmonics):
+            return
+        for n, band in value.items():
+            if check_keys(errors, '{}.{}'.format(where, n), band,
+                          ('center', 'width')):
+                for key, hz in band.items():
+                    check_number(errors, '{}.{}.{}'.format(where, n, key),
+                                 hz, positive=True)
+
+
+def check_measurement(errors, where, measurement, instruments):
+    # add errors for problems in a measurement of a sequence
+    if not check_keys(errors, where, measurement, measurement_keys):
+        return
+    kind = measurement.get('type')
+    if kind not in engine.measurements:
+        errors.append('{}: unknown measurement type {!r}.'.format(
+                where, kind))
+        return
+    instrument = engine.measurements[kind][0]
+    if instrument not in instruments:
+        errors.append('{}: {} measurements need the {} instrument.'.format(
+                where, kind, instrument))
+    for key in ('every', 'start'):
+        if key in measurement:
+            check_number(errors, where+'.'+key, measurement[key])
+    settings = measurement.get('settings', {})
+    if check_keys(errors, where+'.settings', settings,
+                  measurement_settings[kind]):
+        for key, value in settings.items():
+            if key in measurement_settings[kind]:
+                check_setting(errors, where+'.settings.'+key,
+                              measurement_settings[kind][key][1], value)
+        freqs = [settings.get(key) for key in ('start_freq', 'end_freq')]
+        if kind == 'eis' and all(is_number(f) for f in freqs) and (
+                freqs[1] < freqs[0]):
+            errors.append('{}.settings: end_freq must not be below '
+                          'start_freq.'.format(where))
+
+
+def check_segments(errors, where, segments, ramp_interval):
+    # add errors for segments of a channel with a duration, value or
+    # start which is not a finite number, and return the number of
+    # setpoint events which the segments compile into
+    events = 0
+    for i, segment in enumerate(segments):
+        seg_where = '{}[{}]'.format(where, i)
+        if not isinstance(segment, dict):
+            errors.append('{}: must be a dictionary.'.format(seg_where))
+            continue
+        if 'duration' in segment:
+            check_number(errors, seg_where+'.duration', segment['duration'],
+                         positive=True)
+        for key in ('value', 'start'):
+            if key in segment:
+                check_number(errors, seg_where+'.'+key, segment[key],
+                             signed=True)
+        duration = segment.get('duration', 0)
+        if segment.get('type') in ('linear', 'log') and is_number(
+                duration) and is_finite(duration) and duration > 0:
+            events += math.ceil(duration / ramp_interval) + 1
+        else:
+            events += 1
+    return events
+
+
+def check_sequence(errors, where, seq, instruments, setpoints):
+    # add errors for problems in a sequence, including its timeline
+    if not check_keys(errors, where, seq, sequence_keys):
+        return
+    ramp_interval = seq.get('ramp_interval', 1.0)
+    n_errors = len(errors)
+    check_number(errors, where+'.ramp_interval', ramp_interval,
+                 positive=True)
+    # the timeline is only compiled when all of its numbers are valid
+    ramp_ok = len(errors) == n_errors
+    compile_ok = ramp_ok
+    timeline = seq.get('timeline')
+    if not isinstance(timeline, dict):
+        errors.append('{}.timeline: must be a dictionary.'.format(where))
+    else:
+        events = 0
+        for channel, segments in timeline.items():
+            if channel not in channel_instruments:
+                errors.append('{}.timeline: unknown channel {!r}.'.format(
+                        where, channel))
+            elif channel_instruments[channel] not in instruments:
+                errors.append('{}.timeline: {} needs the {} instrument.'
+                              .format(where, channel,
+                                      channel_instruments[channel]))
+            if not isinstance(segments, list):
+                errors.append('{}.timeline.{}: must be a list.'.format(
+                        where, channel))
+                compile_ok = False
+            elif ramp_ok:
+                n_errors = len(errors)
+                events += check_segments(
+                        errors, '{}.timeline.{}'.format(where, channel),
+                        segments, ramp_interval)
+                compile_ok = compile_ok and len(errors) == n_errors
+        if compile_ok and events > max_events:
+            errors.append('{}.timeline: has {} setpoint events, more than '
+                          '{}. Use a longer ramp_interval.'.format(
+                                  where, events, max_events))
+            compile_ok = False
+        if compile_ok:
+            try:
+                sequence.compile_timeline(timeline, ramp_interval,
+                                          setpoints)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                errors.append('{}.timeline: {}'.format(where, e))
+    measurements = seq.get('measurements', [])
+    if not isinstance(measurements, list):
+        errors.append('{}.measurements: must be a list.'.format(where))
+        return
+    for i, measurement in enumerate(measurements):
+        check_measurement(errors, '{}.measurements[{}]'.format(where, i),
+                          measurement, instruments)
+
+
+def validate(recipe):
+    # check a recipe without connecting to the instruments, and return a
+    # list of problems, which is empty if the recipe can be run
+    errors = []
+    if not check_keys(errors, 'recipe', recipe, recipe_keys):
+        return errors
+    output = recipe.get('output', {})
+    if check_keys(errors, 'output', output, output_keys):
+        for key in ('save_dir', 'sample_name'):
+            if key in output and not isinstance(output[key], str):
+                errors.append('output.{}: must be text.'.format(key))
+        if not isinstance(output.get('save_data', True), bool):
+            errors.append('output.save_data: must be true or false.')
+    if 'loop_delay' in recipe:
+        check_number(errors, 'loop_delay', recipe['loop_delay'],
+                     positive=True)
+    instruments = recipe.get('instruments', {})
+    if check_keys(errors, 'instruments', instruments,
+                  engine.instrument_options):
+        for name, options in instruments.items():
+            if name in engine.instrument_options:
+                check_keys(errors, 'instruments.'+name, options,
+                           engine.instrument_options[name])
+    else:
+        instruments = {}
+    setpoints = recipe.get('setpoints', {})
+    if check_keys(errors, 'setpoints', setpoints, channel_instruments):
+        for channel, value in setpoints.items():
+            check_number(errors, 'setpoints.'+channel, value,
+                         signed=True)
+    else:
+        setpoints = {}
+    sequences = recipe.get('sequences')
+    if not isinstance(sequences, list) or len(sequences) == 0:
+        errors.append('sequences: must be a list of at least one sequence.')
+        return errors
+    for i, seq in enumerate(sequences):
+        check_sequence(errors, 'sequences[{}]'.format(i), seq,
+                       instruments, setpoints)
+    return errors
+
+
+def check(recipe):
+    # raise ValueError listing all problems of a recipe, if it has any
+    errors = validate(recipe)
+    if errors:
+        raise ValueError('Recipe has {} problem(s):\n{}'.format(
+                len(errors), '\n'.join(errors)))
+
+
+def summary(recipe):
+    # get the name, duration in seconds, number of setpoint events and
+    # measurement types of each sequence of a checked recipe
+    results = []
+    for i, seq in enumerate(recipe['sequences']):
+        schedule = sequence.compile_timeline(
+                seq['timeline'], seq.get('ramp_interval', 1.0),
+                recipe.get('setpoints', {}))
+        results.append({
+                'name': seq.get('name', 'sequence_{}'.format(i)),
+                'duration': schedule.duration, 'events': len(schedule),
+                'measurements': [m['type']
+                                 for m in seq.get('measurements', [])]})
+    return results
+
+
+def engine_config(recipe):
+    # get the config of the headless engine for a checked recipe
+    output = recipe.get('output', {})
+    config = {'save_dir': time.strftime(output.get('save_dir', '.')),
+              'sample_name': output.get('sample_name', 'sample'),
+              'save_data': output.get('save_data', True),
+              'instruments': recipe.get('instruments', {}),
+              'setpoints': recipe.get('setpoints', {})}
+    if 'loop_delay' in recipe:
+        config['loop_delay'] = recipe['loop_delay']
+    return config
+
+
+def apply_settings(eng, measurement):
+    # write the settings of a measurement to the fields of the dictionary
+    # of its instrument on the engine
+    kind = measurement['type']
+    panel = eng.panels[engine.measurements[kind][0]]
+    for key, value in measurement.get('settings', {}).items():
+        field_key, setting_kind = measurement_settings[kind][key]
+        if setting_kind == 'int':
+            panel[field_key].setValue(int(value))
+        elif setting_kind == 'float':
+            panel[field_key].setValue(float(value))
+        elif setting_kind == 'bool':
+            panel[field_key].setChecked(value)
+        elif setting_kind == 'freq':
+            panel[field_key].setText(str(value))
+        elif setting_kind == 'rates':
+            panel[field_key].setText(', '.join(str(r) for r in value))
+        elif setting_kind == 'steps':
+            panel[field_key].setRows(value)
+        elif setting_kind == 'harmonics':
+            value = {str(n): band for n, band in value.items()}
+            for n in engine.harmonics:
+                panel['n_on_fields'][n].setChecked(n in value)
+                band = value.get(n, {})
+                if 'center' in band:
+                    panel['bc_fields'][n].setValue(int(band['center']))
+                if 'width' in band:
+                    panel['bw_fields'][n].setValue(int(band['width']))
+
+
+class RecipeRunner:
+    # Runs a recipe end to end on a headless Engine. run() connects the
+    # instruments, runs each sequence in turn while starting its
+    # measurements at their cadence, waits for the measurements of each
+    # sequence to finish before the next sequence, then disconnects the
+    # instruments and closes the data files. stop() may be called from
+    # any thread.
+
+    def __init__(self, recipe):
+        check(recipe)
+        self.recipe = recipe
+        config = engine_config(recipe)
+        os.makedirs(config['save_dir'], exist_ok=True)
+        self.engine = engine.Engine(config)
+        self.engine.subscribe(self.start_measurements)
+        self.sequence = None
+        # time of the next measurement of each measurement of the sequence
+        self.next_times = []
+        self.stopped = False
+
+    def start_sequence(self, i):
+        # start running sequence i of the recipe
+        seq = self.recipe['sequences'][i]
+        self.next_times = [float(m.get('start', 0))
+                           for m in seq.get('measurements', [])]
+        self.engine.output_box.append('Recipe sequence {} started.'.format(
+                seq.get('name', i)))
+        self.engine.run_sequence(seq['timeline'],
+                                 seq.get('ramp_interval', 1.0))
+        self.sequence = seq
+
+    def start_measurements(self, row):
+        # start the measurements of the running sequence which are due.
+        # this runs in the engine thread after each iteration.
+        if self.sequence is None:
+            return
+        t = self.engine.runner.elapsed()
+        for i, measurement in enumerate(self.sequence.get(
+                'measurements', [])):
+            kind = measurement['type']
+            if t < self.next_times[i] or self.engine.busy(kind):
+                continue
+            apply_settings(self.engine, measurement)
+            self.engine.measure(kind)
+            every = float(measurement.get('every', 0))
+            while every > 0 and self.next_times[i] <= t:
+                self.next_times[i] += every
+
+    def run(self):
+        # run the whole recipe and return True if it was not stopped.
+        # raises RuntimeError if an instrument could not connect.
+        eng = self.engine
+        failed = eng.connect()
+        try:
+            if failed:
+                raise RuntimeError('Could not connect to {}.'.format(
+                        ', '.join(failed)))
+            for i in range(len(self.recipe['sequences'])):
+                if self.stopped:
+                    break
+                self.start_sequence(i)
+                eng.run(until_sequence_done=True)
+                self.sequence = None
+                eng.wait_measurements()
+        finally:
+            self.sequence = None
+            eng.close()
+        return not self.stopped
+
+    def stop(self):
+        # stop the recipe after the current iteration of the engine
+        self.stopped = True
+        self.engine.stop()
+
+
+def print_messages(row):
+    # print new lines of the engine output box
+    for message in row['messages']:
+        print(time.strftime('%H:%M:%S'), message)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Check or run an IMES experiment recipe.')
+    parser.add_argument('recipe', help='JSON or YAML recipe file')
+    parser.add_argument('--check', action='store_true',
+                        help='only check the recipe, without running it')
+    parser.add_argument('--example', action='store_true',
+                        help='write an example recipe to the file')
+    args = parser.parse_args(argv)
+    if args.example:
+        save(example_recipe, args.recipe)
+        return 0
+
+    t0 = time.perf_counter()
+    try:
+        recipe = load(args.recipe)
+    except ValueError as e:
+        print(e)
+        return 1
+    print('Recipe loaded and checked in {:.1f} ms.'.format(
+            1e3*(time.perf_counter() - t0)))
+    for seq in summary(recipe):
+        print('{}: {:.1f} min, {} setpoint events, measurements: {}'.format(
+                seq['name'], seq['duration']/60, seq['events'],
+                ', '.join(seq['measurements']) or 'none'))
+    if args.check:
+        return 0
+
+    runner = RecipeRunner(recipe)
+    runner.engine.subscribe(print_messages)
+    try:
+        completed = runner.run()
+    except RuntimeError as e:
+        print(e)
+        return 1
+    except KeyboardInterrupt:
+        completed = False
+    return 0 if completed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
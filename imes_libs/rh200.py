@@ -11,6 +11,7 @@ for automated long-term  control of the RH-200.
 
 Packages required:
 time
+threading
 numpy
 PyQt5
 nidaqmx
@@ -25,16 +26,36 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import datetime
 import time
+import threading
 import numpy as np
-import nidaqmx
+from collections import deque
+from imes_libs import workers
+from imes_libs import storage
+from imes_libs import sequence
+from imes_libs import sim
 fontsize = 12
-
-# suppress NI DAQ warning:
-# Finite acquisition or generation has been stopped before the requested
-# number of samples were acquired or generated.
-# error_buffer.value.decode("utf-8"), error_code)
-# DaqWarning: Warning 200010 occurred.
-warnings.filterwarnings('ignore', category=nidaqmx.DaqWarning)
+# seconds after which an unchanged setpoint is re-written to the RH-200,
+# or None to only write the setpoint when it changes
+setpoint_refresh = 60.0
+# settings for continuous acquisition of the dew point: sample rate in Hz,
+# size of the hardware buffer in seconds of samples, and time in seconds
+# over which samples are averaged to get the filtered RH
+dp_rate = 10.0
+dp_buffer_time = 60.0
+dp_filter_time = 2.0
+# value of nidaqmx.constants.READ_ALL_AVAILABLE
+read_all_available = -1
+# coefficients of the calibration polynomial which relates the voltage v
+# of the wet mass flow controller to the RH produced:
+# rh = bi - b1*v + b2*v**2
+calibration = {'bi': -0.4347, 'b1': -48.3857, 'b2': -1.74901}
+# maximum voltage of the wet and dry mass flow controllers
+max_volts = 4.0
+# settings of the closed-loop RH controller: loop rate in Hz, PID gains
+# in V/%RH, V/(%RH s) and V s/%RH, and number of rows of history to keep
+control_rate = 1.0
+control_gains = {'kp': 0.02, 'ki': 0.02/60, 'kd': 0.0}
+control_history_rows = 100000
 
 # ---------these functions are related to controlling the RH-200
 
@@ -45,6 +66,15 @@ warnings.filterwarnings('ignore', category=nidaqmx.DaqWarning)
 def initialize():
     # Initialize RH-200 humidity generator. Returns a dictionary of
     # NI DAQ tasks required for controlling the RH-200 humidity generator.
+    if sim.enabled():
+        return sim.sim_rh200_tasks()
+    import nidaqmx
+    # suppress NI DAQ warning:
+    # Finite acquisition or generation has been stopped before the requested
+    # number of samples were acquired or generated.
+    # error_buffer.value.decode("utf-8"), error_code)
+    # DaqWarning: Warning 200010 occurred.
+    warnings.filterwarnings('ignore', category=nidaqmx.DaqWarning)
     # system = nidaqmx.system.system.System()
     # create persisted task for dew point meter ('AI DP')
     dp_ptask = nidaqmx.system.storage.persisted_task.PersistedTask(
@@ -109,15 +139,360 @@ def rh_setpoint_to_volts(setpoint):
     # Outputs voltages to apply to wet and dry flow contollers.
     # Uses coefficients from calibration polynomial which relates
     # mass flow controller voltage to the actual RH produced.
-    bi = -0.4347
-    b1 = -48.3857
-    b2 = -1.74901
+    bi = calibration['bi']
+    b1 = calibration['b1']
+    b2 = calibration['b2']
     sp = setpoint
     wet_volts = (np.sqrt((b1**2)-(4*b2*(bi-sp)))+b1)/(2*b2)
-    dry_volts = 4 - wet_volts
+    dry_volts = max_volts - wet_volts
     return wet_volts, dry_volts
 
 
+def rolling_std(x, window):
+    # Get the standard deviation of each run of 'window' consecutive
+    # values of x, from cumulative sums of x and x**2. x is centered
+    # first to limit the loss of precision in the difference of sums.
+    x = x - np.mean(x)
+    s1 = np.concatenate(([0], np.cumsum(x)))
+    s2 = np.concatenate(([0], np.cumsum(x**2)))
+    mean = (s1[window:] - s1[:-window]) / window
+    var = (s2[window:] - s2[:-window]) / window - mean**2
+    return np.sqrt(np.clip(var, 0, None))
+
+
+def fit_rh_calibration(volts, rh, settle_samples=60, rh_tol=0.2,
+                       volts_tol=0.005):
+    # Fit the calibration polynomial rh = bi - b1*v + b2*v**2 to logged
+    # wet MFC voltages and measured RH by least squares. Only samples at
+    # which both the voltage and RH have been steady for the preceding
+    # 'settle_samples' samples are used, where steady means a standard
+    # deviation below 'volts_tol' (V) and 'rh_tol' (%RH).
+    # Returns a dictionary of coefficients and the number of samples used
+    # and RMS residual of the fit in %RH.
+    volts = np.asarray(volts, dtype=float)
+    rh = np.asarray(rh, dtype=float)
+    good = np.isfinite(volts) & np.isfinite(rh)
+    volts, rh = volts[good], rh[good]
+    if len(volts) < settle_samples:
+        raise ValueError('Not enough RH history to refit calibration.')
+    # standard deviation over each window of the preceding samples
+    steady = np.zeros(len(volts), dtype=bool)
+    steady[settle_samples-1:] = (
+            (rolling_std(volts, settle_samples) < volts_tol) &
+            (rolling_std(rh, settle_samples) < rh_tol))
+    v, y = volts[steady], rh[steady]
+    # at least three distinct voltages are needed for a quadratic
+    if len(np.unique(np.round(v, decimals=2))) < 3:
+        raise ValueError(
+                'RH history must settle at three or more setpoints.')
+    a = np.column_stack((np.ones_like(v), -v, v**2))
+    coefs, _, _, _ = np.linalg.lstsq(a, y, rcond=None)
+    rms = float(np.sqrt(np.mean((a.dot(coefs) - y)**2)))
+    return {'bi': float(coefs[0]), 'b1': float(coefs[1]),
+            'b2': float(coefs[2]), 'samples': int(len(v)), 'rms': rms}
+
+
+def daq_modes():
+    # Get the NI-DAQ sample mode for continuous acquisition and the task
+    # mode which commits a task, or their names for the simulated tasks.
+    if sim.enabled():
+        return 'continuous', 'commit'
+    from nidaqmx.constants import AcquisitionType, TaskMode
+    return AcquisitionType.CONTINUOUS, TaskMode.TASK_COMMIT
+
+
+class RhDaq:
+    # Persistent NI-DAQ tasks of the RH-200. The tasks are committed and
+    # started once, and the dew point is acquired continuously into the
+    # hardware buffer of the DAQ at 'rate' Hz. read_rh() takes all samples
+    # acquired since the last read and returns the mean RH of the samples
+    # from the last 'filter_time' seconds. Output tasks are only written
+    # when the setpoint changes (see workers.SetpointCache).
+
+    def __init__(self, rh_task_dict, rate=dp_rate,
+                 buffer_time=dp_buffer_time, filter_time=dp_filter_time,
+                 refresh=setpoint_refresh):
+        self.tasks = rh_task_dict
+        self.rate = float(rate)
+        self.buffer_time = float(buffer_time)
+        self.filter_time = float(filter_time)
+        self.cache = workers.SetpointCache(refresh)
+        # RH of recent samples, enough to cover the filter time
+        self.samples = deque(maxlen=max(1, int(self.rate*self.filter_time)))
+        self.reads = 0
+
+    def start(self):
+        # configure continuous acquisition of the dew point, then commit
+        # and start all tasks so they stay reserved until close()
+        continuous, commit = daq_modes()
+        self.tasks['dp'].timing.cfg_samp_clk_timing(
+                self.rate, sample_mode=continuous,
+                samps_per_chan=int(self.rate*self.buffer_time))
+        for task in self.tasks.values():
+            task.control(commit)
+        for task in self.tasks.values():
+            task.start()
+
+    def read_rh(self):
+        # read the buffered dew point samples and return the filtered RH
+        dp = self.tasks['dp'].read(
+                number_of_samples_per_channel=read_all_available)
+        if len(self.samples) == 0 and len(dp) == 0:
+            # wait for the first sample after the tasks start
+            dp = self.tasks['dp'].read(number_of_samples_per_channel=1)
+        self.samples.extend(np.atleast_1d(dp_to_rh(np.asarray(dp))))
+        self.reads += 1
+        return float(np.round(np.mean(self.samples), decimals=3))
+
+    def open_valves(self):
+        # open the wet, dry and gas valves if they have not been opened
+        if self.cache.needs_send('valves', True):
+            self.tasks['do_wet'].write(True)
+            self.tasks['do_dry'].write(True)
+            self.tasks['do_gas'].write(True)
+            self.cache.sent('valves', True)
+
+    def write_setpoint(self, setpoint):
+        # write the MFC voltages for an RH setpoint if it has changed, and
+        # open the wet, dry and gas valves once
+        self.open_valves()
+        if self.cache.needs_send('setpoint', setpoint):
+            wet_volts, _ = rh_setpoint_to_volts(setpoint)
+            self.write_volts(wet_volts)
+            self.cache.sent('setpoint', setpoint)
+        else:
+            self.cache.skips += 1
+
+    def write_volts(self, wet_volts):
+        # write the wet MFC voltage, and the dry MFC voltage which keeps
+        # the total flow constant, if the voltage changed by more than 1 mV
+        wet_volts = float(np.round(np.clip(wet_volts, 0, max_volts), 3))
+        if self.cache.needs_send('wet_volts', wet_volts):
+            self.tasks['ao_wet'].write(wet_volts)
+            self.tasks['ao_dry'].write(max_volts - wet_volts)
+            self.cache.sent('wet_volts', wet_volts)
+
+    def close(self):
+        # stop and close all tasks
+        close(self.tasks)
+
+
+class RhController(threading.Thread):
+    # Closed-loop RH controller which runs at a fixed rate on its own
+    # thread. At each step the filtered RH is read from an RhDaq and the
+    # wet MFC voltage is set to the open-loop voltage of the calibration
+    # polynomial plus a PID correction of the RH error, so errors in the
+    # calibration are removed and steps are driven harder while the RH
+    # is far from the setpoint. The integral is only updated while the
+    # output is not saturated, and the derivative acts on the measured RH.
+    # Each step is added as a row of (time, setpoint, wet volts, RH) to
+    # 'history', a storage.ChunkedArray, for refitting the calibration.
+
+    def __init__(self, daq, setpoint, history, rate=control_rate,
+                 gains=None):
+        super().__init__(name='rh200_controller', daemon=True)
+        self.daq = daq
+        self.setpoint = float(setpoint)
+        self.history = history
+        self.period = 1 / float(rate)
+        self.gains = dict(control_gains if gains is None else gains)
+        self.integral = 0.0
+        self.error = None
+        self.steps = 0
+        self._last_rh = None
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def set_setpoint(self, setpoint):
+        # change the RH setpoint at the next step
+        with self._lock:
+            self.setpoint = float(setpoint)
+
+    def reset_integral(self):
+        # clear the integral term, for example after the calibration has
+        # been refit
+        with self._lock:
+            self.integral = 0.0
+
+    def snapshot(self):
+        # get the most recent RH, setpoint and wet MFC voltage, or None
+        with self._lock:
+            return self._snapshot
+
+    def stop(self, timeout=5):
+        # stop the controller after the current step
+        self._stop_event.set()
+        self.join(timeout)
+
+    def control(self, setpoint, rh, dt):
+        # get the wet MFC voltage for the next step
+        error = setpoint - rh
+        derivative = 0.0
+        if self._last_rh is not None and dt > 0:
+            derivative = -(rh - self._last_rh) / dt
+        self._last_rh = rh
+        feedforward, _ = rh_setpoint_to_volts(setpoint)
+        integral = self.integral + error*dt
+        volts = (feedforward + self.gains['kp']*error +
+                 self.gains['ki']*integral + self.gains['kd']*derivative)
+        # do not integrate further into saturation
+        if 0 <= volts <= max_volts or (
+                volts > max_volts and error < 0) or (volts < 0 and error > 0):
+            self.integral = integral
+        return float(np.clip(volts, 0, max_volts))
+
+    def step(self, dt):
+        with self._lock:
+            setpoint = self.setpoint
+        rh = self.daq.read_rh()
+        with self._lock:
+            volts = self.control(setpoint, rh, dt)
+        self.daq.open_valves()
+        self.daq.write_volts(volts)
+        self.history.add_row([time.time(), setpoint, volts, rh])
+        with self._lock:
+            self._snapshot = {'rh': rh, 'setpoint': setpoint,
+                              'wet_volts': volts}
+        self.steps += 1
+
+    def run(self):
+        next_time = time.time()
+        last_time = None
+        while not self._stop_event.is_set():
+            now = time.time()
+            try:
+                self.step(0.0 if last_time is None else now - last_time)
+                self.error = None
+            except Exception as e:
+                self.error = e
+            last_time = now
+            # fixed rate: steps are timed from the start, not the last step
+            next_time += self.period
+            if next_time < time.time():
+                next_time = time.time()
+            self._stop_event.wait(max(0, next_time - time.time()))
+
+
+def control_step(controller, setpoint):
+    # Sends the setpoint to the closed-loop RH controller and returns its
+    # most recent reading. This runs in the RH-200 worker thread.
+    controller.set_setpoint(setpoint)
+    if controller.error is not None:
+        raise controller.error
+    reading = controller.snapshot()
+    if reading is None:
+        raise ValueError('RH controller has not measured RH yet.')
+    return {'rh': reading['rh'], 'setpoint': reading['setpoint']}
+
+
+def daq_step(daq, setpoint):
+    # Writes the setpoint to the RH-200 if it changed and reads the
+    # filtered RH from the continuously acquired dew point. This runs in
+    # the RH-200 worker thread.
+    daq.write_setpoint(setpoint)
+    return {'rh': daq.read_rh(), 'setpoint': setpoint}
+
+
+def connect(rh_dict):
+    # Initialize the RH-200 NIDAQ tasks and start the worker thread which
+    # owns them. If continuous acquisition is selected on the GUI, the
+    # tasks are kept running between steps. If closed-loop control is
+    # selected, the tasks are run by an RhController thread instead.
+    rh_task_dict = initialize()
+    rh_dict['rh_task_dict'] = rh_task_dict
+    if rh_dict['closed_loop'].isChecked():
+        daq = RhDaq(rh_task_dict)
+        daq.start()
+        rh_dict['rh_daq'] = daq
+        if rh_dict['rh_history'] is None:
+            rh_dict['rh_history'] = storage.ChunkedArray(
+                    4, max_rows=control_history_rows)
+        controller = RhController(daq, rh_dict['set_rh'].value(),
+                                  rh_dict['rh_history'])
+        controller.start()
+        rh_dict['rh_controller'] = controller
+        workers.start_worker(
+                rh_dict['workers'], 'rh200',
+                lambda setpoint: control_step(controller, setpoint))
+    elif rh_dict['continuous_daq'].isChecked():
+        daq = RhDaq(rh_task_dict)
+        daq.start()
+        rh_dict['rh_daq'] = daq
+        workers.start_worker(rh_dict['workers'], 'rh200',
+                             lambda setpoint: daq_step(daq, setpoint))
+    else:
+        rh_dict['rh_daq'] = None
+        cache = workers.SetpointCache(setpoint_refresh)
+        workers.start_worker(
+                rh_dict['workers'], 'rh200',
+                lambda setpoint: rh_step(rh_task_dict, setpoint, cache))
+
+
+def disconnect(rh_dict):
+    # Stop the RH-200 worker and controller threads and close the NIDAQ
+    # tasks.
+    workers.stop_worker(rh_dict['workers'], 'rh200')
+    if rh_dict['rh_controller'] is not None:
+        rh_dict['rh_controller'].stop()
+        rh_dict['rh_controller'] = None
+    close(rh_dict['rh_task_dict'])
+    rh_dict['rh_daq'] = None
+
+
+def continuous_daq_checked(rh_dict):
+    # Triggers when continuous dew point acquisition is selected or
+    # deselected on the GUI. Reconnects the RH-200 in the new mode.
+    if rh_dict['rh200_on'].isChecked():
+        disconnect(rh_dict)
+        connect(rh_dict)
+        if rh_dict['continuous_daq'].isChecked():
+            rh_dict['output_box'].append(
+                    'RH-200 dew point acquired continuously at {} Hz'.format(
+                            dp_rate))
+        else:
+            rh_dict['output_box'].append(
+                    'RH-200 dew point read once per step')
+
+
+def closed_loop_checked(rh_dict):
+    # Triggers when closed-loop RH control is selected or deselected on
+    # the GUI. Reconnects the RH-200 in the new mode.
+    if rh_dict['rh200_on'].isChecked():
+        disconnect(rh_dict)
+        connect(rh_dict)
+        if rh_dict['closed_loop'].isChecked():
+            rh_dict['output_box'].append('Closed-loop RH control on')
+        else:
+            rh_dict['output_box'].append('Closed-loop RH control off')
+
+
+def refit_calibration(rh_dict):
+    # Refit the RH calibration polynomial to the history logged by the
+    # closed-loop controller, and use it for all further setpoints.
+    history = rh_dict['rh_history']
+    if history is None or len(history) == 0:
+        rh_dict['output_box'].append(
+                'No RH history yet. Run closed-loop RH control first.')
+        return
+    data = history.rows()
+    try:
+        fit = fit_rh_calibration(data[:, 2], data[:, 3],
+                                 settle_samples=int(60*control_rate))
+    except ValueError as e:
+        rh_dict['output_box'].append(str(e))
+        return
+    for key in ['bi', 'b1', 'b2']:
+        calibration[key] = fit[key]
+    if rh_dict['rh_controller'] is not None:
+        rh_dict['rh_controller'].reset_integral()
+    rh_dict['output_box'].append(
+            'RH calibration refit from {} samples (RMS error {:.2f} %RH): '
+            'bi={:.5g}, b1={:.5g}, b2={:.5g}'.format(
+                    fit['samples'], fit['rms'], fit['bi'], fit['b1'],
+                    fit['b2']))
+
+
 def checked(rh_dict):
     # Triggers when RH-200 box is checked or unchecked on the GUI.
     if rh_dict['rh200_on'].isChecked():  # if box was checked
@@ -127,82 +502,105 @@ def checked(rh_dict):
             rh_dict['menu_rh'].setEnabled(True)
             rh_dict['run_rh_seq'].setEnabled(True)
 
-            # initialize RH generator NIDAQ tasks
-            rh_dict['rh_task_dict'] = initialize()
+            # initialize RH generator NIDAQ tasks and worker thread
+            connect(rh_dict)
 
         except NameError:
             rh_dict['output_box'].append(
                     'RH-200 connection failed, please restart kernel.')
 
     if not rh_dict['rh200_on'].isChecked():  # if box was unchecked
-        close(rh_dict['rh_task_dict'])
+        disconnect(rh_dict)
         rh_dict['set_rh'].setEnabled(False)
-        rh_dict['rh_seq_running'] = False
+        stop_rh_seq(rh_dict)
         rh_dict['menu_rh'].setEnabled(False)
         rh_dict['rh_display'].setText('--')
         rh_dict['output_box'].append('RH-200 humidity generator disconnected')
 
 
-def set_rh(rh_dict, df, df_i):
-    # Sets RH and dispays RH on front GUI.
+def rh_step(rh_task_dict, setpoint, cache):
+    # Measures RH and writes the setpoint to the RH-200. This runs in the
+    # RH-200 worker thread and returns the measured RH. The analog outputs
+    # are only written when the setpoint changes, and the digital valve
+    # lines only when they have not been opened yet, so most steps only
+    # run the dew point task.
+    write_setpoint = cache.needs_send('setpoint', setpoint)
+    write_valves = cache.needs_send('valves', True)
+    tasks = ['dp']
+    if write_setpoint:
+        tasks += ['ao_wet', 'ao_dry']
+    if write_valves:
+        tasks += ['do_wet', 'do_dry', 'do_gas']
     # try to close NI_DAQ tasks if they are already opened
     try:
-        [rh_dict['rh_task_dict'][key].stop() for key in rh_dict['rh_task_dict']]
+        [rh_task_dict[key].stop() for key in tasks]
     except:
         pass
-    # try to run RH generator
-    try:
-        # run Ni-DAQ tasks
-        [rh_dict['rh_task_dict'][key].start() for key in rh_dict['rh_task_dict']]
-        time.sleep(0.1)
-        # read actual dewpoint
-        dp = rh_dict['rh_task_dict']['dp'].read()
-        # convert depoint to actual RH
-        actual_rh = dp_to_rh(dp)
-        rh_dict['current_rh'] = float(actual_rh)
-        rh_dict['rh_display'].setText(str(actual_rh))
-        # get setpoint from GUI
-        setpoint = float(rh_dict['set_rh'].value())
-        # append values to main GUI dataframe
-        df['rh'].iloc[df_i] = str(actual_rh)
-        df['rh_setpoint'].iloc[df_i] = str(setpoint)
-        # write voltages to mass flow controllers
+    # run Ni-DAQ tasks
+    [rh_task_dict[key].start() for key in tasks]
+    time.sleep(0.1)
+    # read actual dewpoint
+    dp = rh_task_dict['dp'].read()
+    # convert depoint to actual RH
+    actual_rh = dp_to_rh(dp)
+    # write voltages to mass flow controllers
+    if write_setpoint:
         wet_volts, dry_volts = rh_setpoint_to_volts(setpoint)
-        rh_dict['rh_task_dict']['ao_wet'].write(wet_volts)
-        rh_dict['rh_task_dict']['ao_dry'].write(dry_volts)
-        rh_dict['rh_task_dict']['do_wet'].write(True)
-        rh_dict['rh_task_dict']['do_dry'].write(True)
-        rh_dict['rh_task_dict']['do_gas'].write(True)
-        # try to close RH generator tasks
-        try:
-            [rh_dict['rh_task_dict'][key].stop() for key in rh_dict['rh_task_dict']]
-        except:
-            pass   
-
-        # update RH sequence duration on GUI.
-        rh_df = rh_table_to_df(rh_dict)
-        seq_time = rh_df['time'].sum()
-        rh_dict['tot_rh_seq_time'].setText(
-                str(np.round(int(seq_time)/60, decimals=2)))
-        
-        
-        # display estimated sequence end time
-        if not rh_dict['rh_seq_running']:
-            tot_seq_min = rh_df['time'].sum()
-            seq_start_date = datetime.datetime.now()
-            seq_end_date = seq_start_date + datetime.timedelta(minutes=tot_seq_min)
-            rh_dict['seq_end_time_display'].setText(
-                   seq_end_date.strftime('%m-%d %H:%M:%S'))
+        rh_task_dict['ao_wet'].write(wet_volts)
+        rh_task_dict['ao_dry'].write(dry_volts)
+        cache.sent('setpoint', setpoint)
+    else:
+        cache.skips += 1
+    if write_valves:
+        rh_task_dict['do_wet'].write(True)
+        rh_task_dict['do_dry'].write(True)
+        rh_task_dict['do_gas'].write(True)
+        cache.sent('valves', True)
+    # try to close RH generator tasks
+    try:
+        [rh_task_dict[key].stop() for key in tasks]
     except:
         pass
+    return {'rh': float(actual_rh), 'setpoint': setpoint}
+
+
+def set_rh(rh_dict, df, df_i):
+    # Sets RH and dispays RH on front GUI. This runs in the GUI thread:
+    # the setpoint is sent to the RH-200 worker thread and the most recent
+    # measured RH is taken from its snapshot.
+    if 'rh200' not in rh_dict['workers']:
+        return
+    # get setpoint from GUI and send it to the RH-200 worker
+    setpoint = float(rh_dict['set_rh'].value())
+    rh_dict['workers']['rh200'].submit(setpoint)
+    # there is no reading if the last read or the RH controller failed
+    workers.report_error(rh_dict['workers']['rh200'],
+                         rh_dict['output_box'], 'RH-200')
+    reading = rh_dict['workers']['rh200'].snapshot()
+    rh_dict['current_rh'] = None
+    if reading is None:
+        rh_dict['rh_display'].setText('--')
+    else:
+        rh_dict['current_rh'] = reading['rh']
+        rh_dict['rh_display'].setText(str(reading['rh']))
+        # append values to main GUI dataframe
+        df.set('rh', reading['rh'], df_i)
+        df.set('rh_setpoint', reading['setpoint'], df_i)
+
+    # display estimated sequence end time, using the sequence duration
+    # which was parsed when the sequence table last changed
+    if rh_dict['rh_seq_model'] is not None and (
+            not rh_dict['rh_seq_running']):
+        seq_start_date = datetime.datetime.now()
+        seq_end_date = seq_start_date + datetime.timedelta(
+                minutes=rh_dict['rh_seq_model'].total_time)
+        rh_dict['seq_end_time_display'].setText(
+               seq_end_date.strftime('%m-%d %H:%M:%S'))
 
 
 def plot_rh(df, df_i):
     # Plot the RH over time
-    rh_df = df[df['rh'] != '']
-    setpoint = rh_df['rh_setpoint'].astype(float)
-    rh = rh_df['rh'].astype(float)
-    rh_time = rh_df['time'].astype(float)
+    rh_time, rh, setpoint = df.select('rh', 'time', 'rh', 'rh_setpoint')
     fig_seq = plt.figure(20)
     plt.cla()
     plt.ion()
@@ -220,21 +618,16 @@ def plot_rh(df, df_i):
 
 
 def rh_table_to_df(rh_dict):
-    # Convert RH sequence table on GUI to a Pandas dataframe
-    # create empty dataframe
-    rh_df = pd.DataFrame(
-            columns=['time', 'rh'],
-            index=range(rh_dict['rh_table'].rowCount()))
+    # Get the RH sequence table on GUI as a Pandas dataframe. The table is
+    # parsed by the sequence model only when it changes.
+    return rh_dict['rh_seq_model'].dataframe()
 
-    # loop over table entries
-    for rowi in range(rh_dict['rh_table'].rowCount()):
-        for colj in range(rh_dict['rh_table'].columnCount()):
-            # populate dataframe with table entries
-            new_entry = rh_dict['rh_table'].item(rowi, colj).text()
-            rh_df.iloc[rowi, colj] = new_entry
-    # delete empty rows
-    rh_df = rh_df[rh_df['time'] != '0']
-    return rh_df.astype(float)
+
+def show_rh_seq_total(rh_dict):
+    # update RH sequence duration on GUI. runs when the table changes.
+    seq_time = rh_dict['rh_seq_model'].total_time
+    rh_dict['tot_rh_seq_time'].setText(
+            str(np.round(int(seq_time)/60, decimals=2)))
 
 
 def add_rh_step(rh_dict):
@@ -310,7 +703,8 @@ def clear_rh_seq(rh_dict):
 
 
 def run_rh_seq(rh_dict):
-    # run RH sequence
+    # run RH sequence. the setpoints are sent by a sequence runner thread
+    # at the times of each step, and this function returns at once.
     rh_dict['output_box'].append('RH sequence initiated.')
     rh_dict['rh_seq_running'] = True
     rh_dict['run_rh_seq'].setEnabled(False)
@@ -318,55 +712,49 @@ def run_rh_seq(rh_dict):
     rh_dict['set_rh'].setEnabled(False)
     rh_dict['rh_table'].setEnabled(False)
     rh_df = rh_table_to_df(rh_dict)
-    tot_seq_time = rh_df['time'].sum()
-    tot_time_disp = str(np.round(tot_seq_time, decimals=1))
-    # set up timers and counters
-    elapsed_seq_time = 0
-    seq_start_time = time.time()
+    schedule = sequence.compile_timeline(
+            {'rh': sequence.table_segments(rh_df['time'], rh_df['rh'])})
 
-    tot_seq_min = rh_df['time'].sum()
     seq_start_date = datetime.datetime.now()
     seq_end_date = seq_start_date + datetime.timedelta(
-                                               minutes=tot_seq_min)
+            seconds=schedule.duration)
     rh_dict['seq_end_time_display'].setText(
            seq_end_date.strftime('%m-%d %H:%M:%S'))
 
-    step_num = 0
-    # loop over each step in sequence
-    for step in range(len(rh_df)):
-
-        if rh_dict['rh_seq_running']:
-            step_start_time = time.time()
-            elapsed_step_time = 0
-            step_dur = rh_df['time'].iloc[step]*60
-        else:
-            break
-        # repeat until step duration has elapsed
-        while elapsed_step_time < step_dur:
+    def show_step(t, changes):
+        # update the sequence step on the GUI
+        step = schedule.segment_index('rh', t)
+        rh_dict['rh_seq_step'].setText(
+                str(int(step+1))+'/'+str(len(rh_df)))
 
-            if rh_dict['rh_seq_running']:
-                elapsed_step_time = time.time() - step_start_time
-                elapsed_seq_time = time.time() - seq_start_time
+    runner = sequence.SequenceRunner(
+            schedule, sequence.widget_setters(rh_dict=rh_dict),
+            on_event=show_step,
+            on_finish=lambda completed: finish_rh_seq(rh_dict),
+            name='rh_sequence')
+    rh_dict['rh_seq_runner'] = runner
+    runner.start()
 
-                # update fields on GUI
-                if step_num % 5 == 0:
-                    rh_dict['save_data_now'].setChecked(True)
-                    rh_dict['rh_seq_step'].setText(
-                            str(int(step+1))+'/'+str(len(rh_df)))
 
-                    rh_dict['set_rh'].setValue(float(rh_df['rh'].iloc[step]))
+def show_rh_seq_time(rh_dict):
+    # show the elapsed time of the running RH sequence on the GUI
+    runner = rh_dict['rh_seq_runner']
+    if runner is not None:
+        rh_dict['elapsed_rh_seq_time'].setText(
+                str(np.round(runner.elapsed()/60, decimals=2)) + '/' +
+                str(np.round(runner.schedule.duration/60, decimals=1)))
 
-                    elasped_time_disp = str(
-                            np.round(elapsed_seq_time/60, decimals=2))
 
-                    rh_dict['elapsed_rh_seq_time'].setText(
-                            elasped_time_disp + '/' + tot_time_disp)
+def stop_rh_seq(rh_dict):
+    # stop the RH sequence. the GUI is reset when the runner finishes.
+    rh_dict['rh_seq_running'] = False
+    if rh_dict['rh_seq_runner'] is not None:
+        rh_dict['rh_seq_runner'].stop()
 
-                time.sleep(.5)
-                step_num += 1
-            else:
-                break
 
+def finish_rh_seq(rh_dict):
+    # reset the GUI after the RH sequence completes or is stopped
+    rh_dict['rh_seq_runner'] = None
     rh_dict['rh_seq_step'].setText('0')
     rh_dict['set_rh'].setValue(2)
     rh_dict['elapsed_rh_seq_time'].setText('0')
@@ -51,13 +51,15 @@ Created on Fri Jan 25 11:29:05 2019
 
 import time
 import numpy as np
-import pywinusb.hid as hid
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import struct
 import matplotlib.pyplot as plt
 from matplotlib import cm
 import pandas as pd
-from scipy.optimize import curve_fit
+from scipy.optimize import curve_fit, least_squares
+from imes_libs import sim
+from imes_libs import storage
 
 # Code written by Melchor Valera: ------------------------------------------
 
@@ -111,6 +113,12 @@ def sark_open():
     Opens the device
     :return: handler
     """
+    if sim.enabled():
+        device = sim.SimSark110()
+        device.open()
+        device.set_raw_data_handler(rx_handler)
+        return device
+    import pywinusb.hid as hid
     target_vendor_id = 0x0483
     target_product_id = 0x5750
     filter = hid.HidDeviceFilter(vendor_id=target_vendor_id,
@@ -306,7 +314,7 @@ def sark_measure_ext(device, freq, step, cal=True, samples=1):
 
 # code written by Eric Muckley: ------------------------------------------
 
-def get_fast_spec(device, freq, step, cal=True, avg=1):
+def get_fast_spec(device, freq, step, cal=True, avg=1, out=None):
     '''
     ADAPTED FROM sark_measure_ext() FUNCTION:
 
@@ -335,6 +343,9 @@ def get_fast_spec(device, freq, step, cal=True, avg=1):
         step = 10
         cal = True
         avg = 4
+    If 'out' is given, it must be a 4x2 array (for example a view of the
+    Rs and Xs columns of a spectrum array) and the results are written
+    directly into it.
     Returns series resistance and reactance value.
     '''
     report = device.find_output_reports()[0]
@@ -361,18 +372,124 @@ def get_fast_spec(device, freq, step, cal=True, avg=1):
     event.wait()
     if rcv[1] != 79:
         return 'Nan', 'Nan'
-    rs = [0x0] * 4
-    xs = [0x0] * 4
+    # decode the 8 little-endian half floats (rs0, xs0, rs1, xs1, ...)
+    # in the report in one step
+    vals = np.frombuffer(bytes(rcv[2:18]), dtype='<f2').reshape(4, 2)
+    if out is None:
+        out = vals.astype(float)
+    else:
+        out[:] = vals
+    return out[:, 0], out[:, 1]
 
-    rs[0] = half2Float(rcv[2], rcv[3])
-    xs[0] = half2Float(rcv[4], rcv[5])
-    rs[1] = half2Float(rcv[6], rcv[7])
-    xs[1] = half2Float(rcv[8], rcv[9])
-    rs[2] = half2Float(rcv[10], rcv[11])
-    xs[2] = half2Float(rcv[12], rcv[13])
-    rs[3] = half2Float(rcv[14], rcv[15])
-    xs[3] = half2Float(rcv[16], rcv[17])
-    return rs, xs
+
+class Sark110Session:
+    """
+    Session with a single SARK-110 device, which can be used instead of
+    the functions above for fast measurements. The output report is found
+    once and a single command buffer is reused for every command, so no
+    objects are created in the measurement loop. Each session has its own
+    response slot and event, so more than one analyzer can be used at the
+    same time.
+    :param device:  opened HID device
+    :param timeout: time in seconds to wait for each response
+    """
+    vendor_id = 0x0483
+    product_id = 0x5750
+
+    def __init__(self, device, timeout=2.0):
+        self.device = device
+        self.timeout = timeout
+        self.report = device.find_output_reports()[0]
+        self.snd = bytearray(19)
+        self.rcv = [0xff] * 19
+        self.event = threading.Event()
+        device.set_raw_data_handler(self.rx_handler)
+
+    @classmethod
+    def open(cls, index=0, timeout=2.0):
+        """
+        Opens a session with the SARK-110 at position 'index' in the list
+        of connected SARK-110 devices
+        :return: session
+        """
+        if sim.enabled():
+            device = sim.SimSark110()
+        else:
+            import pywinusb.hid as hid
+            filter = hid.HidDeviceFilter(vendor_id=cls.vendor_id,
+                                         product_id=cls.product_id)
+            device = filter.get_devices()[index]
+        device.open()
+        return cls(device, timeout=timeout)
+
+    def close(self):
+        self.device.close()
+
+    def rx_handler(self, data):
+        # handler called when a report is received
+        self.rcv = data
+        self.event.set()
+
+    def send(self):
+        """
+        Sends the command in the command buffer and waits for the response
+        :return: True if the device responded with status OK
+        """
+        self.event.clear()
+        self.report.set_raw_data(self.snd)
+        self.report.send()
+        if not self.event.wait(self.timeout):
+            raise TimeoutError('SARK-110 did not respond.')
+        return self.rcv[1] == 79
+
+    def command(self, cmd):
+        # clear the command buffer and set the command code
+        self.snd[:] = bytes(19)
+        self.snd[1] = cmd
+
+    def reset(self):
+        self.command(50)
+        return self.send()
+
+    def version(self):
+        """
+        :return: prot, ver
+        """
+        self.command(1)
+        if not self.send():
+            return 0, ''
+        prot = (self.rcv[3] << 8) + self.rcv[2]
+        return prot, list(self.rcv[4:])
+
+    def measure(self, freq, cal=True, samples=1):
+        """
+        Takes one measurement sample at the specified frequency
+        :return: rs, xs
+        """
+        self.command(2)
+        struct.pack_into('<IBB', self.snd, 2, int(freq), int(cal), samples)
+        if not self.send():
+            return 'Nan', 'Nan'
+        return struct.unpack('<ff', bytes(self.rcv[2:10]))
+
+    def measure_ext(self, freq, step, cal=True, samples=1, out=None):
+        """
+        Takes four measurement samples starting at the specified frequency
+        and incremented at the specified step, like get_fast_spec().
+        :param out: optional 4x2 array in which to write rs, xs
+        :return: rs, xs  four vals
+        """
+        self.command(12)
+        struct.pack_into('<IBBI', self.snd, 2,
+                         int(freq), int(cal), samples, int(step))
+        if not self.send():
+            return 'Nan', 'Nan'
+        vals = np.frombuffer(bytes(self.rcv[2:18]), dtype='<f2').reshape(4, 2)
+        if out is None:
+            out = vals.astype(float)
+        else:
+            out[:] = vals
+        return out[:, 0], out[:, 1]
 
 
 # ---- The following functions are used to communicate with PyQT GUI -------
@@ -382,7 +499,7 @@ def checked(sark_dict):
     # This function triggers when SARK-110 checkbox status changes.
     if sark_dict['sark_on'].isChecked():  # if SARK checkbox was checked
         try:
-            sark_dict['sark_dev'] = sark_open()
+            sark_dict['sark_dev'] = Sark110Session.open()
             sark_dict['qcm_box'].setEnabled(True)
             sark_dict['output_box'].append('SARK-110 connected.')
         except NameError:
@@ -406,34 +523,32 @@ def get_selected_harmonics(sark_dict):
     return n_selected
 
 
-def measure_band(sark_dict, band_center, band_width):
-    # Measure resistance, reactance spectrum across a single frequency band
-    device = sark_dict['sark_dev']
+def get_band_points(sark_dict):
+    # Get number of points to measure in each band from the GUI, rounded
+    # to nearest multiple of 4 to allow fast measurement
     band_points = int(sark_dict['set_band_points'].value())
-
-    # round band_points to nearest multiple of 4 to allow fast measurement
     if band_points < 40:
         band_points = 40
-    band_points = int(4 * round(float(band_points)/4))
+    return int(4 * round(float(band_points)/4))
 
-    avg = int(sark_dict['set_qcm_averaging'].value())
 
-    band = np.linspace(band_center - band_width/2,
-                       band_center + band_width/2,
-                       num=int(band_points)).astype(int)
+def sweep(sark_dict, band):
+    # Measure resistance, reactance spectrum at evenly spaced frequencies
+    # in the array 'band', whose length must be a multiple of 4
+    device = sark_dict['sark_dev']
+    avg = int(sark_dict['set_qcm_averaging'].value())
     band_step = band[2] - band[1]  # get frequency interval in band
 
     # create array to hold the data: freq, rs, xs
-    spec = np.zeros((band_points, 3))
+    spec = np.zeros((len(band), 3))
     spec[:, 0] = band
     # loop over each point in frequency band
     for f0_i in range(0, len(band), 4):
         # QtCore.QCoreApplication.processEvents()  # handle threading
         # measure resistance and reactance at each frequency
-        rs0, xs0 = get_fast_spec(device, band[f0_i], band_step, avg=avg)
-
-        spec[f0_i:f0_i+4, 1] = rs0  # save resistance values
-        spec[f0_i:f0_i+4, 2] = xs0  # save reactance values
+        # resistance and reactance values are written directly into spec
+        rs0, xs0 = device.measure_ext(band[f0_i], band_step, samples=avg,
+                                      out=spec[f0_i:f0_i+4, 1:3])
 
         # get nonzero values of most recent spectrum for real-time plotting
         sark_dict['new_data'] = spec[:, :2]
@@ -448,6 +563,70 @@ def measure_band(sark_dict, band_center, band_width):
             sark_dict['qcm_rs'].setText(str(rs_display))
             sark_dict['qcm_xs'].setText(str(xs_display))
             sark_dict['actual_frequency'].setText(str(f_display))
+    return spec
+
+
+def measure_band(sark_dict, band_center, band_width):
+    # Measure resistance, reactance spectrum across a single frequency band
+    band_points = get_band_points(sark_dict)
+    band = np.linspace(band_center - band_width/2,
+                       band_center + band_width/2,
+                       num=int(band_points)).astype(int)
+    spec = sweep(sark_dict, band)
+
+    sark_dict['actual_frequency'].setText('--')
+    sark_dict['qcm_rs'].setText('--')
+    sark_dict['qcm_xs'].setText('--')
+    return spec
+
+
+def estimate_peak(freq, g):
+    # Estimate the frequency and full width at half maximum (FWHM) of the
+    # conductance peak in a spectrum of conductance g. The FWHM is at least
+    # one frequency step, because narrower peaks cannot be resolved.
+    peak_i = np.argmax(g)
+    above = g >= (g[peak_i] + np.min(g)) / 2
+    # find edges of the region above half maximum which contains the peak
+    left = peak_i
+    while left > 0 and above[left-1]:
+        left -= 1
+    right = peak_i
+    while right < len(g) - 1 and above[right+1]:
+        right += 1
+    fwhm = max(freq[right] - freq[left], freq[1] - freq[0])
+    return freq[peak_i], fwhm
+
+
+def measure_band_adaptive(sark_dict, band_center, band_width):
+    # Measure resistance, reactance spectrum across a single frequency band
+    # using a coarse sweep across the whole band, followed by a fine sweep
+    # within 2 FWHM of the conductance peak found in the coarse sweep.
+    # A quarter of the band points are used for the coarse sweep.
+    band_points = get_band_points(sark_dict)
+    coarse_points = 4 * max(3, int(round(band_points/16)))
+    fine_points = band_points - coarse_points
+    band_start = band_center - band_width/2
+    band_end = band_center + band_width/2
+
+    # coarse sweep across the whole band
+    coarse_band = np.linspace(band_start, band_end,
+                              num=coarse_points).astype(int)
+    coarse = sweep(sark_dict, coarse_band)
+
+    # fine sweep around the peak, at least 4 coarse steps wide
+    f_peak, fwhm = estimate_peak(coarse[:, 0], get_conductance(coarse))
+    fine_width = min(max(4*fwhm, 4*(coarse_band[1]-coarse_band[0])),
+                     band_width)
+    fine_start = np.clip(f_peak - fine_width/2, band_start,
+                         band_end - fine_width)
+    fine_band = np.linspace(fine_start, fine_start + fine_width,
+                            num=fine_points).astype(int)
+    fine = sweep(sark_dict, fine_band)
+
+    # combine coarse and fine spectra in order of frequency
+    spec = np.concatenate((coarse, fine))
+    spec = spec[np.argsort(spec[:, 0], kind='stable')]
+    sark_dict['new_data'] = spec[:, :2]
 
     sark_dict['actual_frequency'].setText('--')
     sark_dict['qcm_rs'].setText('--')
@@ -455,6 +634,13 @@ def measure_band(sark_dict, band_center, band_width):
     return spec
 
 
+def measure_selected_band(sark_dict, band_center, band_width):
+    # Measure a band using the sweep mode selected on the GUI
+    if sark_dict['adaptive_sweep'].isChecked():
+        return measure_band_adaptive(sark_dict, band_center, band_width)
+    return measure_band(sark_dict, band_center, band_width)
+
+
 def find_resonances(sark_dict):
     # Find resonance frequencies at selected QCM frequency bands
     n_list = get_selected_harmonics(sark_dict)
@@ -471,7 +657,7 @@ def find_resonances(sark_dict):
         bandcenter = int(sark_dict['set_f0'].value())*1e6*n - (5e4*n)
         bandwidth = 200000*n
 
-        spec = measure_band(sark_dict, bandcenter, bandwidth)
+        spec = measure_selected_band(sark_dict, bandcenter, bandwidth)
         # save QCM data to file, fit spectrum to Butterworth van Dyke circuit
         f0, D = save_qcm_data(sark_dict, measure_time, n, spec)
 
@@ -486,6 +672,9 @@ def find_resonances(sark_dict):
         band_time = int(time.time() - band_start_time)
         sark_dict['sec_per_band'].setText(str(band_time))
 
+    # write the resonances to the params file, so they are not carried
+    # into the row of the next QCM cycle
+    save_qcm_params(sark_dict)
     sark_dict['output_box'].append('Resonance search complete.')
     sark_dict['sark_busy'] = False
     sark_dict['measure_bands'].setEnabled(True)
@@ -503,37 +692,51 @@ def measure_bands(sark_dict):
     sark_dict['sark_busy'] = True
     sark_dict['measure_bands'].setEnabled(False)
     sark_dict['find_resonances'].setEnabled(False)
-    measure_time = time.strftime('%Y-%m-%d_%H-%M-%S_')
-
-    # loop through each selected harmonic
-    for n in n_list:
-        band_start_time = time.time()
-        sark_dict['output_box'].append('Measuring n='+str(n)+' band...')
-        bandcenter = int(sark_dict['bc_fields'][str(n)].value())
-        bandwidth = int(sark_dict['bw_fields'][str(n)].value())
-        spec = measure_band(sark_dict, bandcenter, bandwidth)
-
-        # save QCM data to file, fit spectrum to Butterworth van Dyke circuit
-        f0, D = save_qcm_data(sark_dict, measure_time, n, spec)
-
-        # update GUI displays
-        sark_dict['output_box'].append(
-                            'Measurement at n='+str(n)+' band complete.')
-        sark_dict['f0_displays'][str(n)].setText(str(int(f0)))
-        band_time = int(time.time() - band_start_time)
-        sark_dict['sec_per_band'].setText(str(band_time))
-        # for dynamic frequency window, this changes bandcenter on each loop
-        if sark_dict['dynamic_bc'].isChecked():
-            sark_dict['bc_fields'][str(n)].setValue(int(f0))
-
-    sark_dict['output_box'].append('Multi-band measurement complete.')
-    sark_dict['nth_qcm_loop'] += 1
-    sark_dict['sark_busy'] = False
-    sark_dict['measure_bands'].setEnabled(True)
-    sark_dict['find_resonances'].setEnabled(True)
-    sark_dict['actual_frequency'].setText('--')
-    sark_dict['qcm_rs'].setText('--')
-    sark_dict['qcm_xs'].setText('--')
+    try:
+        measure_time = time.strftime('%Y-%m-%d_%H-%M-%S_')
+
+        # fitting and saving of each band runs on a worker thread while the
+        # next band is measured, so the analyzer is not idle during disk I/O
+        saved = {}
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            # loop through each selected harmonic
+            for n in n_list:
+                band_start_time = time.time()
+                sark_dict['output_box'].append(
+                        'Measuring n='+str(n)+' band...')
+                bandcenter = int(sark_dict['bc_fields'][str(n)].value())
+                bandwidth = int(sark_dict['bw_fields'][str(n)].value())
+                spec = measure_selected_band(sark_dict, bandcenter, bandwidth)
+
+                # save QCM data to file, fit spectrum to Butterworth van Dyke
+                # circuit
+                saved[n] = pool.submit(
+                        save_qcm_data, sark_dict, measure_time, n, spec)
+                sark_dict['output_box'].append(
+                        'Measurement at n='+str(n)+' band complete.')
+                band_time = int(time.time() - band_start_time)
+                sark_dict['sec_per_band'].setText(str(band_time))
+
+        # update GUI displays when all bands are saved
+        for n in n_list:
+            f0, D = saved[n].result()
+            sark_dict['f0_displays'][str(n)].setText(str(int(f0)))
+            # for dynamic frequency window, this changes bandcenter on each
+            # loop
+            if sark_dict['dynamic_bc'].isChecked():
+                sark_dict['bc_fields'][str(n)].setValue(int(f0))
+
+        save_qcm_params(sark_dict)
+        sark_dict['output_box'].append('Multi-band measurement complete.')
+        sark_dict['nth_qcm_loop'] += 1
+    finally:
+        # the analyzer is free for the next measurement even if saving failed
+        sark_dict['sark_busy'] = False
+        sark_dict['measure_bands'].setEnabled(True)
+        sark_dict['find_resonances'].setEnabled(True)
+        sark_dict['actual_frequency'].setText('--')
+        sark_dict['qcm_rs'].setText('--')
+        sark_dict['qcm_xs'].setText('--')
     # view_qcm_data(sark_dict)
 
 
@@ -579,9 +782,149 @@ def perform_bvd_fit(freq, g, guess):
     return popt, fit
 
 
+# lock which prevents QCM data from being saved by two threads at once
+save_lock = threading.Lock()
+
+# record type of QCM spectrum files. frequency is saved as float64 because
+# float32 cannot resolve 1 Hz at the higher harmonics.
+qcm_spectrum_dtype = [('freq', '<f8'), ('rs', '<f4'), ('xs', '<f4')]
+# columns of the QCM params file
+qcm_params_columns = ['time'] + ['f_'+str(n) for n in range(1, 19, 2)] + [
+        'd_'+str(n) for n in range(1, 19, 2)]
+
+
+def new_qcm_data():
+    # Create dictionary to hold the spectrum store of each harmonic, the
+    # writer of the params file, and the params of the current QCM cycle.
+    return {'spectra': {}, 'params_writer': None, 'params': {}}
+
+
+def close_qcm_data(qcm_data):
+    # close all QCM data files
+    for store in qcm_data['spectra'].values():
+        store.close()
+    if qcm_data['params_writer'] is not None:
+        qcm_data['params_writer'].close()
+
+
+def get_spectrum_store(sark_dict, n):
+    # Get the append-only spectrum store of harmonic n. Each spectrum is
+    # saved as a block of (freq, rs, xs) records in the binary spectra
+    # file, with one row in the spectra index file.
+    spectra = sark_dict['qcm_data']['spectra']
+    if str(n) not in spectra:
+        spec_filename = sark_dict['save_file_dir']+'/'+sark_dict[
+                'start_date']+'_qcm_n='+str(n).zfill(1)+'_spectra.bin'
+        spectra[str(n)] = storage.RecordStore(
+                spec_filename, qcm_spectrum_dtype,
+                ['measure_time', 'f_start', 'f_end', 'f0', 'D'],
+                overwrite=True)
+    return spectra[str(n)]
+
+
+def save_qcm_params(sark_dict):
+    # Append delta F and delta D parameters of the current QCM cycle to
+    # the params file as a single row.
+    with save_lock:
+        qcm_data = sark_dict['qcm_data']
+        if len(qcm_data['params']) == 0:
+            return
+        if qcm_data['params_writer'] is None:
+            params_filename = sark_dict['save_file_dir']+'/'+sark_dict[
+                    'start_date']+'_qcm_params.csv'
+            qcm_data['params_writer'] = storage.AppendCSVWriter(
+                    params_filename, qcm_params_columns, overwrite=True)
+        row = [str(sark_dict['nth_qcm_loop'])] + [
+                qcm_data['params'].get(col, '')
+                for col in qcm_params_columns[1:]]
+        qcm_data['params_writer'].append([row])
+        qcm_data['params'] = {}
+
+
+class BvdFitter:
+    # Fits the conductance peak of QCM spectra to the Butterworth van Dyke
+    # model G = Gp + Gmax / (1 + x^2), where x = ((f/f0) - (f0/f)) / D.
+    # This is the real part of bvd_peak(). The susceptance offset Cp does
+    # not change the conductance, so it is not fitted.
+    # The Jacobian is calculated analytically, parameters are bounded to
+    # physical values, and each fit starts from the previous fit of the
+    # same harmonic, so fits of slowly changing peaks converge in a few
+    # iterations. Call reset() when starting a new experiment.
+
+    def __init__(self, max_nfev=100):
+        self.max_nfev = max_nfev
+        # most recent fit parameters (Gp, Gmax, D, f0) of each harmonic
+        self.last = {}
+        # number of function evaluations of the most recent fit
+        self.nfev = 0
+
+    def reset(self):
+        self.last = {}
+
+    @staticmethod
+    def model(params, freq):
+        gp, gmax, d, f0 = params
+        x = ((freq/f0) - (f0/freq)) / d
+        return gp + gmax / (1 + x**2)
+
+    @staticmethod
+    def jacobian(params, freq, g=None):
+        # derivatives of the model with respect to Gp, Gmax, D, and f0
+        gp, gmax, d, f0 = params
+        x = ((freq/f0) - (f0/freq)) / d
+        lor = 1 / (1 + x**2)
+        dg_dx = -2 * gmax * x * lor**2
+        jac = np.empty((len(freq), 4))
+        jac[:, 0] = 1
+        jac[:, 1] = lor
+        jac[:, 2] = dg_dx * (-x / d)
+        jac[:, 3] = dg_dx * (-(freq/f0**2) - (1/freq)) / d
+        return jac
+
+    @staticmethod
+    def guess(freq, g):
+        # estimate fit parameters from a spectrum of conductance
+        f0, fwhm = estimate_peak(freq, g)
+        return np.array([np.min(g), np.max(g) - np.min(g), fwhm/f0, f0])
+
+    def bounds(self, freq, g):
+        # lower and upper bounds of fit parameters
+        span = np.max(g) - np.min(g)
+        lower = [np.min(g) - span, 0, 1e-8, np.min(freq)]
+        upper = [np.max(g), 10*span, 1e-1, np.max(freq)]
+        return lower, upper
+
+    def fit(self, n, freq, g):
+        # fit the conductance spectrum g of harmonic n. returns the fit
+        # parameters (Gp, Gmax, D, f0) and the fitted spectrum.
+        freq = np.asarray(freq, dtype=float)
+        g = np.asarray(g, dtype=float)
+        lower, upper = self.bounds(freq, g)
+        guesses = [self.guess(freq, g)]
+        if n in self.last and lower[3] < self.last[n][3] < upper[3]:
+            guesses.insert(0, self.last[n])
+        for guess in guesses:
+            guess = np.clip(guess, lower, upper)
+            result = least_squares(
+                    lambda p: self.model(p, freq) - g, guess,
+                    jac=lambda p: self.jacobian(p, freq),
+                    bounds=(lower, upper), method='trf', x_scale='jac',
+                    max_nfev=self.max_nfev)
+            self.nfev = result.nfev
+            if result.success:
+                self.last[n] = result.x
+                return result.x, self.model(result.x, freq)
+        raise RuntimeError('BvD fit did not converge.')
+
+
 def save_qcm_data(sark_dict, measure_time, n, spec):
     # extract resonant frequency adn dissipation from spectrum and
     # save measured QCM data to dataframes and csv files
+    with save_lock:
+        return _save_qcm_data(sark_dict, measure_time, n, spec)
+
+
+def _save_qcm_data(sark_dict, measure_time, n, spec):
     freq = spec[:, 0]
     rs = spec[:, 1]
     xs = spec[:, 2]
@@ -589,60 +932,30 @@ def save_qcm_data(sark_dict, measure_time, n, spec):
 
     # resonant frequency
     f0 = freq[np.argmax(rs)]
-    # frequency of highest reactance value
-    f0_xs = freq[np.argmax(xs)]
-    # estimation FWHM of the resonant peak
-    fwhm = 2 * np.abs(f0 - f0_xs)
-    # create guess for dissipation
-    D_guess = fwhm / f0
-    # construct guess for peak fitting: [Gp, Cp, Gmax, D, f0]
-    guess = np.array([0, 0, np.amax(g), D_guess, f0])
-
-    try:  # attempt to perform fit
-        popt, fit = perform_bvd_fit(freq, g, guess)
-        # f0 = popt[4] #this gives wrong f0...
-        # must find out why by plotting BvD fit along with data
-        D = np.abs(popt[3])
+
+    try:  # attempt to perform fit, starting from previous fit of harmonic
+        popt, fit = sark_dict['bvd_fitter'].fit(n, freq, g)
+        D = popt[2]
         sark_dict['output_box'].append(
                 'Dissipation at n='+str(n)+' found: '+str(D))
-    except:  # if fit fails
+    except (RuntimeError, ValueError):  # if fit fails
         D = 0
         sark_dict['output_box'].append(
                 'Dissipation fit at n='+str(n)+' failed.')
 
-    # create empty columns to hold data
-    sark_dict['qcm_data'][str(n)][[
-            'freq__'+measure_time,
-            'rs__'+measure_time,
-            'xs__'+measure_time]] = pd.DataFrame(np.full((10000, 3), ''))
-    # append data to the empty columns
-    sark_dict['qcm_data'][str(n)][
-            'freq__'+measure_time].iloc[
-                    :len(spec)] = spec[:, 0].astype(str)
-    sark_dict['qcm_data'][str(n)][
-            'rs__'+measure_time].iloc[
-                    :len(spec)] = spec[:, 1].astype(str)
-    sark_dict['qcm_data'][str(n)][
-            'xs__'+measure_time].iloc[
-                    :len(spec)] = spec[:, 2].astype(str)
-
-    # save dataframe to file
-    spec_filename = sark_dict['save_file_dir']+'/'+sark_dict[
-                  'start_date']+'_qcm_n='+str(n).zfill(1)+'_spectra.csv'
-    sark_dict['qcm_data'][str(n)].to_csv(spec_filename, index=False)
-
-    # save delta F and delta D parameters from qcm spectra
-    sark_dict['qcm_data']['params']['f_'+str(n)].iloc[
-                            sark_dict['nth_qcm_loop']] = str(int(f0))
-    sark_dict['qcm_data']['params']['d_'+str(n)].iloc[
-                            sark_dict['nth_qcm_loop']] = str(float(D))
-    sark_dict['qcm_data']['params']['time'].iloc[
-                            sark_dict['nth_qcm_loop']] = str(
-            sark_dict['nth_qcm_loop'])
+    # append spectrum to the spectrum file of the harmonic
+    records = np.empty(len(spec), dtype=qcm_spectrum_dtype)
+    records['freq'] = spec[:, 0]
+    records['rs'] = spec[:, 1]
+    records['xs'] = spec[:, 2]
+    get_spectrum_store(sark_dict, n).append(
+            records, [measure_time, np.min(freq), np.max(freq),
+                      int(f0), float(D)])
 
-    params_filename = sark_dict['save_file_dir']+'/'+sark_dict[
-                  'start_date']+'_qcm_params.csv'
-    sark_dict['qcm_data']['params'].to_csv(params_filename, index=False)
+    # save delta F and delta D parameters from qcm spectra. they are
+    # written to file at the end of each QCM cycle by save_qcm_params()
+    sark_dict['qcm_data']['params']['f_'+str(n)] = str(int(f0))
+    sark_dict['qcm_data']['params']['d_'+str(n)] = str(float(D))
 
     return f0, D
 
@@ -688,7 +1001,7 @@ def plot_deltaf(sark_dict):
         plt.tight_layout()
         plt.draw()
 
-    except NameError:  # if qcm data file does not exist
+    except FileNotFoundError:  # if qcm data file does not exist
         sark_dict['output_box'].append('No QCM data file found.')
 
 
@@ -731,7 +1044,7 @@ def plot_deltad(sark_dict):
         plt.tight_layout()
         plt.draw()
 
-    except NameError:  # if qcm data file does not exist
+    except FileNotFoundError:  # if qcm data file does not exist
         sark_dict['output_box'].append('No QCM data file found.')
 
 
@@ -748,9 +1061,9 @@ def plot_qcm_spectra(sark_dict):
     for n_i, n in enumerate(n_list):
 
         # select data based on n
-        spec_df = sark_dict['qcm_data'][str(n)]
+        store = sark_dict['qcm_data']['spectra'].get(str(n))
         # get the number of spectra to plot
-        spec_num = int(len(list(spec_df))/3)
+        spec_num = 0 if store is None else len(store)
 
         # ax[n_i].set_xlabel('Frequency (MHz)', fontsize=8)
         # ax[n_i].set_ylabel('Rs (Ohm)', fontsize=8)
@@ -762,16 +1075,12 @@ def plot_qcm_spectra(sark_dict):
             plt.ion
 
             # loop over each spectrum in selected harmonic
-            for i in range(0, spec_num*3, 3):
-                # select columns
-                spec0 = spec_df.iloc[:, i:i+2]
-                # remove empty rows
-                spec0 = spec0[spec0 != '']
-                spec0 = spec0.values.astype(float)
+            for i in range(spec_num):
+                spec0 = store.read(i)
                 # plot Rs vs frequency
                 ax[n_i].plot(
-                        spec0[:, 0]/1e6, spec0[:, 1],
-                        lw=1, label=str(int(i/3)), c=colors[int(i/3)])
+                        spec0['freq']/1e6, spec0['rs'],
+                        lw=1, label=str(i), c=colors[i])
 
     fig.canvas.set_window_title('QCM spectra')
     plt.draw()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides a model of the sequence tables on the GUI, such as
+the RH and vacuum sequence tables. The model parses the text of the table
+cells into a Pandas dataframe once each time the table is edited or
+imported, and keeps the step durations and cumulative durations, so the
+main loop can show the sequence length and end time without reading the
+table. Edits of many cells at once, such as importing a sequence, are
+parsed once at the next iteration of the Qt event loop, after which the
+'changed' signal is emitted.
+
+Use it in the main GUI class like this:
+
+self.rh_dict['rh_seq_model'] = seqmodel.SequenceTableModel(
+        self.ui.rh_table, ['time', 'rh'], self)
+
+Packages required:
+numpy
+pandas
+PyQt5
+
+Created on Sat Oct 17 20:02:47 2026
+"""
+
+import numpy as np
+import pandas as pd
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+
+
+class SequenceTableModel(QObject):
+    # Parsed contents of a sequence table. The first column must hold the
+    # duration of each step in minutes, and rows with a duration of 0 are
+    # not part of the sequence. 'valid' is False if any cell could not be
+    # parsed as a number, in which case the sequence is empty.
+    changed = pyqtSignal()
+
+    def __init__(self, table, columns, parent=None):
+        super().__init__(parent)
+        self.table = table
+        self.columns = list(columns)
+        self.valid = False
+        self.df = pd.DataFrame(columns=self.columns, dtype=float)
+        # step durations and their cumulative sum, in minutes
+        self.times = np.empty(0)
+        self.cumulative = np.empty(0)
+        self.parses = 0
+        self.dirty = True
+        self.scheduled = False
+        table.itemChanged.connect(self.mark_dirty)
+        self.refresh()
+
+    @property
+    def total_time(self):
+        # total duration of the sequence in minutes
+        return float(self.cumulative[-1]) if len(self.cumulative) else 0.0
+
+    def mark_dirty(self, item=None):
+        # run when a cell of the table changes. parsing is deferred so
+        # that many changes in a row are parsed only once.
+        self.dirty = True
+        if not self.scheduled:
+            self.scheduled = True
+            QTimer.singleShot(0, self.refresh)
+
+    def refresh(self):
+        # parse the table if it changed, and emit the changed signal
+        self.scheduled = False
+        if self.dirty:
+            self.parse()
+            self.changed.emit()
+
+    def parse(self):
+        # read the cells of the table into a dataframe of floats
+        self.dirty = False
+        self.parses += 1
+        rows = []
+        try:
+            for rowi in range(self.table.rowCount()):
+                rows.append([float(self.table.item(rowi, colj).text())
+                             for colj in range(len(self.columns))])
+            df = pd.DataFrame(rows, columns=self.columns, dtype=float)
+            self.valid = True
+        except (AttributeError, ValueError):
+            # empty or non-numeric cells
+            df = pd.DataFrame(columns=self.columns, dtype=float)
+            self.valid = False
+        # delete empty rows
+        self.df = df[df['time'] != 0].reset_index(drop=True)
+        self.times = self.df['time'].values
+        self.cumulative = np.cumsum(self.times)
+
+    def dataframe(self):
+        # get a copy of the sequence as a dataframe. raises ValueError if
+        # the table holds cells which are not numbers.
+        if self.dirty:
+            self.refresh()
+        if not self.valid:
+            raise ValueError('Sequence table holds invalid entries.')
+        return self.df.copy()
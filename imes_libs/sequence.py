@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+This module runs timed sequences of setpoints for several channels at
+once, such as RH, pressure, MFC flow rates and Keithley bias. A timeline
+is a dictionary of a list of segments for each channel, for example:
+
+timeline = {'rh': [{'type': 'step', 'value': 5, 'duration': 600},
+                   {'type': 'linear', 'value': 90, 'duration': 3600},
+                   {'type': 'hold', 'duration': 600}],
+            'bias': [{'type': 'step', 'value': 0.5, 'duration': 4800}]}
+
+Durations are in seconds and the segments of each channel run one after
+another from the start of the sequence. Segment types are:
+
+step ----- change to 'value' and hold it for 'duration'
+hold ----- keep the previous value for 'duration'
+linear --- ramp linearly from the previous value (or 'start') to 'value'
+log ------ ramp geometrically from the previous value (or 'start') to
+           'value', for quantities such as pressure which span decades
+
+compile_timeline() turns a timeline into a Schedule of setpoint events,
+with ramps broken into steps every 'ramp_interval' seconds.
+SequenceRunner sends the events to setter functions of each channel from
+a single thread, sleeping until the time of each event instead of
+polling. dry_run() reports the duration and setpoint profile of a
+timeline without running it.
+
+Packages required:
+time
+threading
+numpy
+
+Created on Sat Oct 17 18:41:09 2026
+"""
+
+import time
+import threading
+import numpy as np
+
+segment_types = ('step', 'hold', 'linear', 'log')
+
+
+def table_segments(times, values):
+    # get a list of step segments from the columns of a sequence table on
+    # the GUI, with step durations in minutes
+    return [{'type': 'step', 'value': float(value), 'duration': 60*float(t)}
+            for t, value in zip(times, values)]
+
+
+def compile_channel(segments, ramp_interval=1.0, initial=None):
+    # get arrays of event times and values for the segments of a single
+    # channel, and the start time of each segment
+    times, values, starts = [], [], []
+    t = 0.0
+    value = initial
+    for i, segment in enumerate(segments):
+        kind = segment.get('type', 'step')
+        if kind not in segment_types:
+            raise ValueError('Unknown segment type: {}'.format(kind))
+        duration = float(segment.get('duration', 0))
+        if duration < 0:
+            raise ValueError('Segment {} has a negative duration.'.format(i))
+        starts.append(t)
+        if kind == 'step':
+            value = float(segment['value'])
+            times.append([t])
+            values.append([value])
+        elif kind in ('linear', 'log'):
+            start = float(segment.get('start', value if value is not None
+                                      else segment['value']))
+            end = float(segment['value'])
+            # one setpoint every ramp_interval, ending on the final value
+            n = max(1, int(np.ceil(duration / ramp_interval)))
+            ramp_t = t + np.arange(n+1) * (duration / n)
+            if kind == 'linear':
+                ramp_v = np.linspace(start, end, n+1)
+            else:
+                if start <= 0 or end <= 0:
+                    raise ValueError(
+                            'Log ramps need positive values (segment {}).'
+                            .format(i))
+                ramp_v = np.geomspace(start, end, n+1)
+            times.append(ramp_t)
+            values.append(ramp_v)
+            value = end
+        t += duration
+    if len(times) == 0:
+        return np.empty(0), np.empty(0), np.empty(0), t
+    times = np.concatenate(times)
+    values = np.concatenate(values)
+    # where a segment starts at the end of a ramp, keep only the new value
+    keep = np.ones(len(times), dtype=bool)
+    keep[:-1] = times[:-1] != times[1:]
+    times, values = times[keep], values[keep]
+    starts = np.array(starts)
+    # drop ramp events which do not change the setpoint, but keep the
+    # event at the start of each segment, so each step of a sequence has
+    # an event even when its value repeats the previous step
+    keep = np.ones(len(values), dtype=bool)
+    keep[1:] = (values[1:] != values[:-1]) | np.isin(times[1:], starts)
+    return times[keep], values[keep], starts, t
+
+
+class Schedule:
+    # Setpoint events of a compiled timeline, sorted by time. 'times',
+    # 'channels' and 'values' are arrays with one entry for each event.
+    # 'duration' is the length of the sequence in seconds, and 'starts'
+    # holds the start time of each segment of each channel.
+
+    def __init__(self, times, channels, values, duration, starts):
+        self.times = times
+        self.channels = channels
+        self.values = values
+        self.duration = duration
+        self.starts = starts
+
+    def __len__(self):
+        return len(self.times)
+
+    def profile(self, channel):
+        # get arrays of event times and setpoints of a channel, ending at
+        # the end of the sequence, for plotting as steps
+        mask = self.channels == channel
+        t = self.times[mask]
+        v = self.values[mask]
+        if len(t) > 0:
+            t = np.append(t, self.duration)
+            v = np.append(v, v[-1])
+        return t, v
+
+    def segment_index(self, channel, t):
+        # get the index of the segment of a channel which runs at time t
+        return max(0, int(np.searchsorted(
+                self.starts[channel], t, side='right')) - 1)
+
+
+def compile_timeline(timeline, ramp_interval=1.0, initial=None):
+    # compile a timeline into a Schedule of setpoint events. 'initial' is
+    # an optional dictionary of the value of each channel before the
+    # sequence starts, used as the start of ramps at the start of the
+    # sequence.
+    initial = {} if initial is None else initial
+    times, channels, values, starts = [], [], [], {}
+    duration = 0.0
+    for channel, segments in timeline.items():
+        t, v, seg_starts, channel_duration = compile_channel(
+                segments, ramp_interval, initial.get(channel))
+        times.append(t)
+        values.append(v)
+        channels.append(np.full(len(t), channel, dtype=object))
+        starts[channel] = seg_starts
+        duration = max(duration, channel_duration)
+    if len(times) == 0:
+        return Schedule(np.empty(0), np.empty(0, dtype=object),
+                        np.empty(0), 0.0, {})
+    times = np.concatenate(times)
+    channels = np.concatenate(channels)
+    values = np.concatenate(values)
+    # stable sort keeps events at the same time in channel order
+    order = np.argsort(times, kind='stable')
+    return Schedule(times[order], channels[order], values[order],
+                    duration, starts)
+
+
+def dry_run(timeline, ramp_interval=1.0, initial=None):
+    # compile a timeline without running it and return a summary with the
+    # total duration in seconds, the number of setpoint events, and the
+    # profile (times, setpoints) of each channel
+    schedule = compile_timeline(timeline, ramp_interval, initial)
+    return {'duration': schedule.duration,
+            'events': len(schedule),
+            'profile': {channel: schedule.profile(channel)
+                        for channel in timeline}}
+
+
+def setpoint_widgets(rh_dict=None, vac_dict=None, keith_dict=None):
+    # get the setpoint widget on the GUI of each channel, from which the
+    # main loop sends setpoints to the instruments
+    widgets = {}
+    if rh_dict is not None:
+        widgets['rh'] = rh_dict['set_rh']
+    if vac_dict is not None:
+        widgets['pressure'] = vac_dict['set_pressure']
+        widgets['mfc1'] = vac_dict['mfc1_sp']
+        widgets['mfc2'] = vac_dict['mfc2_sp']
+    if keith_dict is not None:
+        widgets['bias'] = keith_dict['set_bias']
+    return widgets
+
+
+def widget_setters(rh_dict=None, vac_dict=None, keith_dict=None):
+    # get setter functions of each channel which write setpoints to the
+    # setpoint widgets on the GUI
+    return {channel: widget.setValue for channel, widget in
+            setpoint_widgets(rh_dict, vac_dict, keith_dict).items()}
+
+
+class SequenceRunner(threading.Thread):
+    # Thread which sends the events of a Schedule to the setter function
+    # of each channel at the scheduled times. Between events the thread
+    # sleeps until the next event is due, and stop() wakes it at once.
+    # on_event(t, changes) is called after the events at time t have been
+    # sent, where changes is a dictionary of the new setpoints, and
+    # on_finish(completed) is called when the sequence ends or is stopped.
+    # Errors raised by setters are stored in 'error' and do not stop the
+    # sequence.
+
+    def __init__(self, schedule, setters, on_event=None, on_finish=None,
+                 name='sequence'):
+        super().__init__(name=name, daemon=True)
+        missing = set(schedule.channels) - set(setters)
+        if missing:
+            raise ValueError('No setter for channels: {}'.format(
+                    ', '.join(sorted(missing))))
+        self.schedule = schedule
+        self.setters = setters
+        self.on_event = on_event
+        self.on_finish = on_finish
+        self.error = None
+        self.completed = False
+        self.start_time = None
+        # largest delay of an event after its scheduled time in seconds
+        self.max_lag = 0.0
+        self._stop_event = threading.Event()
+
+    def elapsed(self):
+        # seconds since the sequence started
+        if self.start_time is None:
+            return 0.0
+        return min(time.monotonic() - self.start_time,
+                   self.schedule.duration)
+
+    def stop(self):
+        # stop the sequence before its next event
+        self._stop_event.set()
+
+    def wait_until(self, t):
+        # sleep until t seconds after the start, and return False if the
+        # sequence was stopped while waiting
+        delay = self.start_time + t - time.monotonic()
+        return not self._stop_event.wait(max(0, delay))
+
+    def run(self):
+        schedule = self.schedule
+        self.start_time = time.monotonic()
+        i = 0
+        running = True
+        while i < len(schedule) and running:
+            t = schedule.times[i]
+            running = self.wait_until(t)
+            if not running:
+                break
+            self.max_lag = max(self.max_lag, self.elapsed() - t)
+            # send all events which are due at this time
+            changes = {}
+            while i < len(schedule) and schedule.times[i] == t:
+                channel = schedule.channels[i]
+                changes[channel] = float(schedule.values[i])
+                try:
+                    self.setters[channel](changes[channel])
+                except Exception as e:
+                    self.error = e
+                i += 1
+            if self.on_event is not None:
+                self.on_event(t, changes)
+        if running:
+            running = self.wait_until(schedule.duration)
+        self.completed = running
+        if self.on_finish is not None:
+            self.on_finish(self.completed)
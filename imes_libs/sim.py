@@ -0,0 +1,751 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides simulated instruments which can be used in place of
+the lab hardware for testing and benchmarking on any PC. Each simulator
+mimics the interface which the driver modules use to talk to the real
+instrument, so it can be passed to the driver functions directly:
+
+SARK-110 antenna analyzer (pywinusb HID device) ------ SimSark110
+Solartron 1260 impedance analyzer (VISA resource) ---- SimSolartron1260
+MKS 651 pressure controller (VISA resource) ---------- SimMKS651
+Keithley 2400 source-measure unit (pymeasure) -------- SimKeithley2400
+Alicat mass flow controller (serial port) ------------ SimAlicat
+Leybold Turbovac 90i turbo pump (serial port) -------- SimTurbo
+RH-200 humidity generator (NI-DAQ persisted tasks) --- sim_rh200_tasks()
+Ocean Optics USB4000 spectrometer (seabreeze) -------- SimSpectrometer
+
+All simulators share a SimChamber, in which the RH and pressure relax
+toward their setpoints over time, so responses are physically plausible:
+for example the QCM resonance shifts down and the sample impedance drops
+as the simulated RH increases. Each simulator has a 'latency' dictionary
+of delays (in seconds) for each command, and a 'default_latency' for the
+rest, so the timing of the real instruments can be reproduced.
+
+Set the environment variable IMES_SIMULATE=1 before starting the GUI to
+connect to simulated instruments instead of the hardware.
+
+Packages required:
+os
+time
+struct
+threading
+numpy
+
+Created on Sat Oct 17 12:02:33 2026
+"""
+
+import os
+import time
+import struct
+import threading
+import numpy as np
+
+try:
+    from visa import VisaIOError as VisaError
+except ImportError:
+    class VisaError(Exception):
+        # raised by simulated VISA instruments when pyvisa is not installed
+        pass
+
+
+def enabled():
+    # check whether simulated instruments should be used
+    return os.environ.get('IMES_SIMULATE', '0') not in ('', '0')
+
+
+def open_visa(address, sim_class, **kwargs):
+    # open a VISA instrument, or a simulated one if simulation is enabled
+    if enabled():
+        return sim_class(**kwargs)
+    import visa
+    rm = visa.ResourceManager()
+    return rm.open_resource(address)
+
+
+def open_serial(address, baudrate, sim_class, timeout=1.0, **kwargs):
+    # open a serial instrument, or a simulated one if simulation is enabled
+    if enabled():
+        return sim_class(**kwargs)
+    import serial
+    return serial.Serial(address, baudrate, timeout=timeout)
+
+
+class SimChamber:
+    # Simulated measurement chamber shared by all simulated instruments.
+    # RH and pressure relax exponentially toward their setpoints with time
+    # constants rh_tau and pressure_tau in seconds. 'speed' is a factor by
+    # which simulated time runs faster than real time.
+
+    def __init__(self, rh=2.0, pressure=760.0, temp=22.0,
+                 rh_tau=60.0, pressure_tau=20.0, speed=1.0):
+        self.temp = temp
+        self.rh_tau = rh_tau
+        self.pressure_tau = pressure_tau
+        self.speed = speed
+        self.rh_setpoint = rh
+        self.pressure_setpoint = pressure
+        self._rh = rh
+        self._pressure = pressure
+        self._last_time = time.time()
+        self.lock = threading.Lock()
+
+    def update(self):
+        # advance the chamber state to the current time
+        with self.lock:
+            now = time.time()
+            dt = (now - self._last_time) * self.speed
+            self._last_time = now
+            self._rh += (self.rh_setpoint - self._rh) * (
+                    1 - np.exp(-dt/self.rh_tau))
+            self._pressure += (self.pressure_setpoint - self._pressure) * (
+                    1 - np.exp(-dt/self.pressure_tau))
+
+    @property
+    def rh(self):
+        self.update()
+        return self._rh
+
+    @property
+    def pressure(self):
+        self.update()
+        return self._pressure
+
+
+_chamber = None
+
+
+def default_chamber():
+    # get the chamber which is shared by simulated instruments by default
+    global _chamber
+    if _chamber is None:
+        _chamber = SimChamber()
+    return _chamber
+
+
+class SimDevice:
+    # Base class of simulated instruments with per-command latency and
+    # measurement noise. 'latency' maps command names to delays in
+    # seconds, and commands which are not listed use 'default_latency'.
+
+    def __init__(self, chamber=None, latency=None, default_latency=0.0,
+                 noise=1e-3, seed=None):
+        self.chamber = chamber if chamber is not None else default_chamber()
+        self.latency = dict(latency) if latency else {}
+        self.default_latency = default_latency
+        self.noise = noise
+        self.rng = np.random.RandomState(seed)
+        self.closed = False
+        self.commands_received = 0
+
+    def wait(self, command):
+        # simulate the time taken by the instrument to handle a command
+        self.commands_received += 1
+        delay = self.latency.get(command, self.default_latency)
+        if delay > 0:
+            time.sleep(delay)
+
+    def jitter(self, value, scale=1.0):
+        # add relative gaussian noise to a value
+        return value * (1 + self.noise * scale * self.rng.standard_normal(
+                np.shape(value)))
+
+    def close(self):
+        self.closed = True
+
+
+# %% ----------------- SARK-110 antenna analyzer -----------------------------
+
+class SimHidReport:
+    # Output report of a simulated HID device
+    def __init__(self, device):
+        self.device = device
+        self.data = [0] * 19
+
+    def set_raw_data(self, data):
+        self.data = [int(b) & 0xFF for b in data]
+
+    def send(self):
+        self.device.handle(self.data)
+
+
+class SimSark110(SimDevice):
+    # Simulated SARK-110 which speaks the HID report protocol used in
+    # sark.py. The connected QCM crystal is a Butterworth van Dyke circuit
+    # with fundamental frequency f1, motional resistance rm, dissipation d,
+    # and parallel capacitance c0. The resonance of harmonic n is at
+    # n*f1 - n*rh_shift*RH, and dissipation increases with RH.
+    # Commands: 1 = version, 2 = measure, 12 = fast measure, 50 = reset.
+
+    def __init__(self, chamber=None, latency=None, default_latency=0.004,
+                 noise=1e-3, f1=5e6, rm=50.0, d=2e-5, c0=20e-12,
+                 rh_shift=2.0, rh_d=1e-7, seed=None):
+        super().__init__(chamber, latency, default_latency, noise, seed)
+        self.f1 = f1
+        self.rm = rm
+        self.d = d
+        self.c0 = c0
+        self.rh_shift = rh_shift
+        self.rh_d = rh_d
+        self.handler = None
+        self.report = SimHidReport(self)
+
+    def open(self):
+        self.closed = False
+
+    def set_raw_data_handler(self, handler):
+        self.handler = handler
+
+    def find_output_reports(self):
+        return [self.report]
+
+    def impedance(self, freq):
+        # get series resistance and reactance of the crystal at each freq
+        freq = np.asarray(freq, dtype=float)
+        rh = self.chamber.rh
+        # harmonic closest to the measured frequencies
+        n = max(1, int(np.round(np.mean(freq) / self.f1)))
+        if n % 2 == 0:
+            n += 1
+        f0 = n*self.f1 - n*self.rh_shift*rh
+        d = self.d + self.rh_d*rh
+        zm = self.rm * np.sqrt(n) * (1 + (1j/d)*((freq/f0)-(f0/freq)))
+        y = 1/zm + 1j*2*np.pi*freq*self.c0
+        z = 1/y
+        return self.jitter(np.real(z)), self.jitter(np.imag(z))
+
+    def handle(self, snd):
+        # respond to a command sent in an output report
+        command = snd[1]
+        self.wait(command)
+        rcv = [0] * 19
+        rcv[1] = 79
+        if command == 1:
+            rcv[2:4] = [1, 0]
+            rcv[4:19] = list(b'SIM-SARK110\x00\x00\x00\x00')
+        elif command == 2:
+            freq = struct.unpack('<I', bytes(snd[2:6]))[0]
+            rs, xs = self.impedance([freq])
+            rcv[2:10] = list(struct.pack('<ff', rs[0], xs[0]))
+        elif command == 12:
+            freq = struct.unpack('<I', bytes(snd[2:6]))[0]
+            step = struct.unpack('<I', bytes(snd[8:12]))[0]
+            rs, xs = self.impedance(freq + step*np.arange(4))
+            vals = np.column_stack((rs, xs)).ravel().astype('<f2')
+            rcv[2:18] = list(vals.tobytes())
+        elif command != 50:
+            rcv[1] = 0
+        if self.handler is not None:
+            self.handler(rcv)
+
+
+# %% ----------------- Solartron 1260 impedance analyzer ---------------------
+
+class SimSolartron1260(SimDevice):
+    # Simulated Solartron 1260 VISA resource. The sample is a resistor rs
+    # in series with a parallel resistor rp and capacitor c, where rp
+    # decreases by a factor of 10 for every rh_decade % of RH.
+    # Each 'SI' measurement takes 'integration_cycles' cycles of the
+    # generator frequency plus 'si_overhead' seconds.
+
+    def __init__(self, chamber=None, latency=None, default_latency=0.002,
+                 noise=2e-3, rs=100.0, rp=1e6, c=1e-9, rh_decade=40.0,
+                 integration_cycles=1, si_overhead=0.02, seed=None):
+        super().__init__(chamber, latency, default_latency, noise, seed)
+        self.rs = rs
+        self.rp = rp
+        self.c = c
+        self.rh_decade = rh_decade
+        self.integration_cycles = integration_cycles
+        self.si_overhead = si_overhead
+        self.timeout = 10000
+        self.settings = {}
+        self.freq = 1000.0
+        self.output = []
+
+    def impedance(self, freq):
+        # get complex impedance of the sample at a frequency
+        rp = self.rp * 10**(-self.chamber.rh/self.rh_decade)
+        w = 2*np.pi*np.asarray(freq, dtype=float)
+        return self.rs + rp / (1 + 1j*w*rp*self.c)
+
+    def measure(self, freq):
+        # get a result string of frequency, |Z|, and phase in degrees
+        z = self.impedance(freq)
+        time.sleep(self.si_overhead + self.integration_cycles/freq)
+        # noise is larger at low frequency where fewer cycles are averaged
+        scale = 1 + 1/np.sqrt(max(freq, 1e-3))
+        mag = self.jitter(np.abs(z), scale)
+        phase = np.degrees(np.angle(z)) + 0.1*self.noise*scale*(
+                self.rng.standard_normal())*100
+        return '{:+.6E},{:+.6E},{:+.6E}'.format(freq, mag, phase)
+
+    def write(self, command):
+        command = command.strip()
+        name = command.split()[0] if command else ''
+        self.wait(name)
+        args = command[len(name):].strip()
+        if name == '*RST':
+            self.settings = {}
+        elif name == 'FR':
+            self.freq = float(args)
+        elif name == 'SI':
+            self.output.append(self.measure(self.freq))
+        else:
+            self.settings[name] = args
+
+    def read(self):
+        if len(self.output) == 0:
+            raise VisaError(-1073807339)
+        return self.output.pop(0)
+
+    def query(self, command):
+        if command.strip() == '*IDN?':
+            self.wait('*IDN?')
+            return 'SOLARTRON,1260,SIMULATED,0'
+        self.write(command)
+        return self.read()
+
+
+# %% ----------------- MKS 651 pressure controller --------------------------
+
+class SimMKS651(SimDevice):
+    # Simulated MKS 651 VISA resource with a 1000 Torr full-scale range.
+    # In pressure mode the chamber pressure approaches the setpoint, and in
+    # valve mode the pressure depends on the butterfly valve position.
+
+    def __init__(self, chamber=None, latency=None, default_latency=0.01,
+                 noise=1e-3, seed=None):
+        super().__init__(chamber, latency, default_latency, noise, seed)
+        self.mode = 1
+        self.valve_pos = 100.0
+        self.timeout = 2000
+
+    def write(self, command):
+        command = command.strip()
+        self.wait(command[:2])
+        if command.startswith('T3'):
+            self.mode = int(command[2:])
+        elif command.startswith('S3'):
+            value = float(command[2:])
+            if self.mode == 1:
+                # setpoint in % of full range
+                self.chamber.pressure_setpoint = value * 10
+                self.valve_pos = float(np.clip(100 - value, 0, 100))
+            else:
+                self.valve_pos = value
+                self.chamber.pressure_setpoint = 760 * (
+                        1 - self.valve_pos/100.) + 1e-3
+
+    def query(self, command):
+        command = command.strip()
+        self.wait(command)
+        if command == 'R5':
+            pressure = max(self.jitter(self.chamber.pressure), 0)
+            return 'P{:+.5f}\r\n'.format(pressure/10)
+        if command == 'R6':
+            return 'V{:+.1f}\r\n'.format(self.valve_pos)
+        return '\r\n'
+
+
+# %% ----------------- Keithley 2400 source-measure unit ---------------------
+
+class SimKeithley2400(SimDevice):
+    # Simulated pymeasure Keithley2400. The sample is a resistor r, which
+    # decreases by a factor of 10 for every rh_decade % of RH, in parallel
+    # with a capacitor c, so C-V loops have a rate-dependent area.
+    # Each current reading takes nplc power line cycles plus overhead.
+    # The SCPI commands used by keith.list_sweep() and keith.CurrentStream
+    # are also supported through write() and values(), so list sweeps and
+    # current logging are timed by the simulated instrument. Like the real
+    # instrument, each ':READ?' returns the data elements set by
+    # ':FORM:ELEM' for every reading of ':TRIG:COUN', and like pymeasure,
+    # 'current' is a list when the reading has more than one value.
+    all_elements = ['VOLT', 'CURR', 'RES', 'TIME', 'STAT']
+
+    def __init__(self, chamber=None, latency=None, default_latency=0.005,
+                 noise=1e-3, r=1e8, c=1e-9, rh_decade=40.0,
+                 line_freq=60.0, seed=None):
+        super().__init__(chamber, latency, default_latency, noise, seed)
+        self.r = r
+        self.c = c
+        self.rh_decade = rh_decade
+        self.line_freq = line_freq
+        self.nplc = 1.0
+        self.source_enabled = False
+        self._voltage = 0.0
+        self._last_voltage = 0.0
+        self._last_change = time.time()
+        self.source_list = []
+        self.list_mode = False
+        self.source_delay = 0.0
+        self.trigger_delay = 0.0
+        self.trigger_count = 1
+        self.elements = list(self.all_elements)
+        self.time_zero = time.time()
+
+    def reset(self):
+        self.wait('reset')
+        self.source_enabled = False
+        self._voltage = 0.0
+        self.list_mode = False
+        self.source_delay = 0.0
+        self.trigger_delay = 0.0
+        self.trigger_count = 1
+        self.elements = list(self.all_elements)
+
+    def use_front_terminals(self):
+        self.wait('use_front_terminals')
+
+    def measure_current(self, nplc=1, current=1.05e-4, auto_range=True):
+        self.wait('measure_current')
+        self.nplc = nplc
+        self.elements = ['CURR']
+
+    def enable_source(self):
+        self.wait('enable_source')
+        self.source_enabled = True
+
+    def disable_source(self):
+        self.wait('disable_source')
+        self.source_enabled = False
+
+    def apply_voltage(self, voltage_range=None, compliance_current=0.1):
+        self.wait('apply_voltage')
+
+    @property
+    def source_voltage(self):
+        return self._voltage
+
+    @source_voltage.setter
+    def source_voltage(self, voltage):
+        self.wait('source_voltage')
+        now = time.time()
+        self._last_voltage = self._voltage
+        self._voltage = float(voltage)
+        self._last_change = now
+
+    def sample_current(self, voltage, dvdt):
+        # get current through the sample at a voltage and sweep rate
+        if not self.source_enabled:
+            return 0.0
+        r = self.r * 10**(-self.chamber.rh/self.rh_decade)
+        return self.jitter(voltage/r + self.c*dvdt)
+
+    def format_reading(self, voltage, current):
+        # get the data elements of one reading, as set by ':FORM:ELEM'
+        values = {'VOLT': voltage, 'CURR': current,
+                  'RES': voltage/current if current else 9.91e37,
+                  'TIME': time.time() - self.time_zero, 'STAT': 0.0}
+        return [values[e] for e in self.elements]
+
+    @property
+    def current(self):
+        if (self.list_mode or self.trigger_count != 1 or
+                self.elements != ['CURR']):
+            readings = self.values(':READ?')
+            return readings[0] if len(readings) == 1 else readings
+        self.wait('current')
+        time.sleep(self.nplc/self.line_freq)
+        dt = max(time.time() - self._last_change, 1e-3)
+        dvdt = (self._voltage - self._last_voltage) / dt
+        return self.sample_current(self._voltage, dvdt)
+
+    def write(self, command):
+        command = command.strip()
+        name, _, args = command.partition(' ')
+        self.wait(name)
+        if name == ':SOUR:LIST:VOLT':
+            self.source_list = [float(v) for v in args.split(',')]
+        elif name == ':SOUR:VOLT:MODE':
+            self.list_mode = args == 'LIST'
+        elif name == ':SOUR:VOLT:LEV':
+            self._voltage = float(args)
+        elif name == ':SOUR:DEL':
+            self.source_delay = float(args)
+        elif name == ':SOUR:DEL:AUTO':
+            self.source_delay = 0.0
+        elif name == ':TRIG:DEL':
+            self.trigger_delay = float(args)
+        elif name == ':TRIG:COUN':
+            self.trigger_count = int(args)
+        elif name == ':FORM:ELEM':
+            self.elements = args.split(',')
+        elif name == ':SENS:CURR:NPLC':
+            self.nplc = float(args)
+        elif name == ':SYST:TIME:RES':
+            self.time_zero = time.time()
+        elif name == ':OUTP':
+            self.source_enabled = args == 'ON'
+
+    def values(self, command):
+        # run the trigger model and return the data elements of each
+        # reading. the voltage steps through the source list in list mode,
+        # and is constant otherwise.
+        self.wait(command.strip())
+        readings = []
+        point_time = (self.trigger_delay + self.source_delay +
+                      self.nplc/self.line_freq)
+        for i in range(self.trigger_count):
+            voltage = self._voltage
+            if self.list_mode:
+                voltage = self.source_list[i % len(self.source_list)]
+            dvdt = (voltage - self._voltage) / max(point_time, 1e-3)
+            time.sleep(point_time)
+            self._voltage = voltage
+            readings += self.format_reading(
+                    voltage, self.sample_current(voltage, dvdt))
+        # the next reading through 'current' sees no change of voltage
+        self._last_voltage = self._voltage
+        self._last_change = time.time()
+        return readings
+
+    def shutdown(self):
+        self.source_enabled = False
+        self.close()
+
+
+# %% ----------------- Alicat mass flow controller --------------------------
+
+class SimAlicat(SimDevice):
+    # Simulated Alicat MFC on a serial port. Each poll ('A') or setpoint
+    # ('AS') command is answered with a data frame of the form:
+    # A +014.70 +025.00 +010.00 +010.00 010.00 N2
+    # (pressure, temperature, volumetric flow, mass flow, setpoint, gas).
+    # The flow approaches the setpoint with time constant tau in seconds.
+    gas_types = ['Air', 'Ar', 'CH4', 'CO', 'CO2', 'C2H6', 'H2', 'He', 'N2',
+                 'N2O', 'Ne', 'O2', 'C3H8', 'n-C4H10', 'C2H2', 'C2H4',
+                 'i-C2H10', 'Kr', 'Xe', 'SF6', 'C-25', 'C-10', 'C-8', 'C-2',
+                 'C-75', 'A-75', 'A-25', 'A1025', 'Star29', 'P-5']
+
+    def __init__(self, chamber=None, latency=None, default_latency=0.01,
+                 noise=2e-3, gas='N2', tau=1.0, seed=None):
+        super().__init__(chamber, latency, default_latency, noise, seed)
+        self.gas = gas
+        self.tau = tau
+        self.setpoint = 0.0
+        self._flow = 0.0
+        self._last_time = time.time()
+        self.lines = []
+
+    def flow(self):
+        now = time.time()
+        self._flow += (self.setpoint - self._flow) * (
+                1 - np.exp(-(now - self._last_time)/self.tau))
+        self._last_time = now
+        return max(self.jitter(self._flow), 0)
+
+    def frame(self):
+        flow = self.flow()
+        return 'A +014.70 +025.00 {:+07.2f} {:+07.2f} {:06.2f} {}\r'.format(
+                flow, flow, self.setpoint, self.gas)
+
+    def write(self, data):
+        command = data.decode('ascii').strip()
+        self.wait(command[:3] if command[1:3] == '$$' else command[:2])
+        if command[1:3] == '$$':
+            self.gas = self.gas_types[int(command[3:])]
+        elif command[1:2] == 'S':
+            self.setpoint = float(command[2:])
+            self.lines.append(self.frame())
+        else:
+            self.lines.append(self.frame())
+        return len(data)
+
+    def readline(self):
+        if len(self.lines) == 0:
+            return b''
+        return self.lines.pop(0).encode('ascii')
+
+
+# %% ----------------- Leybold Turbovac 90i turbo pump -----------------------
+
+class SimTurbo(SimDevice):
+    # Simulated Leybold Turbovac on a serial port. If bit 10 of the control
+    # word (bytes 11-12 of the frame) is set, the pump is started or
+    # stopped by bit 0, otherwise the frame only polls the status. Each
+    # frame is answered
+    # with a 24-byte status frame which holds the rotor speed in Hz in
+    # bits 72-87. The rotor accelerates at 'accel' Hz per second.
+
+    def __init__(self, chamber=None, latency=None, default_latency=0.02,
+                 noise=0.0, max_speed=1500.0, accel=25.0, seed=None):
+        super().__init__(chamber, latency, default_latency, noise, seed)
+        self.max_speed = max_speed
+        self.accel = accel
+        self.running = False
+        self._speed = 0.0
+        self._last_time = time.time()
+        self.lines = []
+
+    def speed(self):
+        now = time.time()
+        change = self.accel * (now - self._last_time)
+        self._last_time = now
+        if self.running:
+            self._speed = min(self._speed + change, self.max_speed)
+        else:
+            self._speed = max(self._speed - change, 0.0)
+        return int(self._speed)
+
+    def write(self, data):
+        self.wait('frame')
+        if data[11] & 0x04:
+            self.running = bool(data[12] & 0x01)
+        self.lines.append((self.speed() << 72).to_bytes(24, 'big'))
+        return len(data)
+
+    def readline(self):
+        if len(self.lines) == 0:
+            return b''
+        return self.lines.pop(0)
+
+
+# %% ----------------- RH-200 humidity generator -----------------------------
+
+class SimDaqTiming:
+    # Timing settings of a simulated NI-DAQ task
+    def __init__(self):
+        self.rate = 1.0
+        self.samps_per_chan = 1
+        self.sample_mode = None
+
+    def cfg_samp_clk_timing(self, rate, source='', active_edge=None,
+                            sample_mode=None, samps_per_chan=1000):
+        self.rate = rate
+        self.samps_per_chan = samps_per_chan
+        self.sample_mode = sample_mode
+
+
+class SimDaqTask(SimDevice):
+    # Simulated NI-DAQ task of the RH-200. Writing to the analog output
+    # tasks sets the RH toward which the chamber relaxes, using the
+    # quadratic calibration rh = bi - b1*v + b2*v**2 of the wet MFC
+    # voltage v (plus 'calibration_error' in % RH), and reading the 'dp'
+    # task returns the dew point voltage for the current chamber RH. In
+    # continuous mode, reading all available samples returns the samples
+    # acquired at the sample rate since the task started or was last read.
+
+    def __init__(self, name, generator, chamber=None, latency=None,
+                 default_latency=0.002, noise=1e-3, seed=None):
+        super().__init__(chamber, latency, default_latency, noise, seed)
+        self.name = name
+        self.generator = generator
+        self.timing = SimDaqTiming()
+        self.running = False
+        self.starts = 0
+        self.writes = 0
+        self.committed = False
+        self._last_read = time.time()
+
+    def control(self, action):
+        self.wait('control')
+        self.committed = True
+
+    def start(self):
+        self.wait('start')
+        self.running = True
+        self.starts += 1
+        self._last_read = time.time()
+
+    def stop(self):
+        self.wait('stop')
+        self.running = False
+
+    def write(self, value, auto_start=True):
+        self.wait('write')
+        self.writes += 1
+        self.generator.outputs[self.name] = value
+        self.generator.update()
+
+    def dp_volts(self):
+        # dew point voltage of the analyzer at the current chamber RH
+        rh = max(self.chamber.rh, 1e-3)
+        temp = self.chamber.temp
+        gamma = np.log(rh/100) + 17.625*temp/(243.04+temp)
+        dp = 243.04*gamma/(17.625 - gamma)
+        return self.jitter((dp + 40)/20)
+
+    def read(self, number_of_samples_per_channel=None, timeout=10.0):
+        self.wait('read')
+        if number_of_samples_per_channel is None:
+            return float(self.dp_volts())
+        if number_of_samples_per_channel < 0:
+            # read all available samples of a continuous acquisition
+            if self.running and self.timing.sample_mode is not None:
+                now = time.time()
+                available = int((now - self._last_read)*self.timing.rate)
+                self._last_read += available / self.timing.rate
+                number_of_samples_per_channel = min(
+                        available, self.timing.samps_per_chan)
+            else:
+                number_of_samples_per_channel = max(1, int(self.timing.rate))
+        return [float(self.dp_volts())
+                for _ in range(number_of_samples_per_channel)]
+
+
+class SimRH200:
+    # Simulated RH-200 generator which holds the output values of its
+    # NI-DAQ tasks and sets the RH setpoint of the chamber from them.
+    bi = -0.4347
+    b1 = -48.3857
+    b2 = -1.74901
+
+    def __init__(self, chamber=None, calibration_error=0.0):
+        self.chamber = chamber if chamber is not None else default_chamber()
+        self.calibration_error = calibration_error
+        self.outputs = {'ao_wet': 0.0, 'ao_dry': 4.0, 'do_wet': False,
+                        'do_dry': False, 'do_gas': False}
+
+    def update(self):
+        # set the chamber RH setpoint from the MFC voltages
+        if self.outputs['do_gas'] and self.outputs['do_wet']:
+            v = float(self.outputs['ao_wet'])
+            rh = self.bi - self.b1*v + self.b2*v**2 + self.calibration_error
+            self.chamber.rh_setpoint = float(np.clip(rh, 0.5, 98))
+
+
+def sim_rh200_tasks(chamber=None, latency=None, calibration_error=0.0):
+    # get a dictionary of simulated NI-DAQ tasks for the RH-200, in the
+    # same form as returned by rh200.initialize()
+    generator = SimRH200(chamber, calibration_error=calibration_error)
+    return {name: SimDaqTask(name, generator, chamber=generator.chamber,
+                             latency=latency)
+            for name in ['dp', 'ao_wet', 'ao_dry',
+                         'do_wet', 'do_dry', 'do_gas']}
+
+
+# %% ----------------- Ocean Optics USB4000 spectrometer ---------------------
+
+class SimSpectrometer(SimDevice):
+    # Simulated seabreeze spectrometer with 3648 pixels from 200 to 1100 nm.
+    # The spectrum is a gaussian peak whose position shifts with RH, with
+    # intensity proportional to the integration time.
+
+    def __init__(self, chamber=None, latency=None, default_latency=0.005,
+                 noise=1e-2, pixels=3648, peak=650.0, rh_shift=0.2,
+                 seed=None):
+        super().__init__(chamber, latency, default_latency, noise, seed)
+        self.pixels = pixels
+        self.peak = peak
+        self.rh_shift = rh_shift
+        self.int_time = 1000
+
+    @classmethod
+    def from_serial_number(cls, serial=None):
+        return cls()
+
+    def integration_time_micros(self, int_time):
+        self.wait('integration_time_micros')
+        self.int_time = int(int_time)
+
+    def wavelengths(self):
+        return np.linspace(200, 1100, self.pixels)
+
+    def intensities(self, correct_dark_counts=False,
+                    correct_nonlinearity=False):
+        self.wait('intensities')
+        time.sleep(self.int_time / 1e6)
+        wl = self.wavelengths()
+        center = self.peak + self.rh_shift*self.chamber.rh
+        counts = 1000 + 20*self.int_time*np.exp(-((wl-center)/40)**2)
+        return np.clip(self.jitter(counts), 0, 65535)
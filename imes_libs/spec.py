@@ -14,7 +14,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib import cm
 # from scipy.signal import savgol_filter
-import seabreeze.spectrometers as sb
+from imes_libs import sim
 '''
 # manually fix pyUSB installation for import of Ocean Optics Spectometer
 # DO NOT CHANGE THE ORDER OF THE FOLLOWING LINES OR DEVICE WILL NOT BE FOUND
@@ -35,11 +35,19 @@ fontsize = 12
 def initialize_spectrometer(spec_dict):
     # connect to Ocean Optics USB4000 spectrometer
     # sm = sb.Spectrometer(sb.list_devices()[0])
-    sm = sb.Spectrometer.from_serial_number()
+    sm = open_spectrometer()
     # print(sm.pixels)
     return sm
 
 
+def open_spectrometer():
+    # connect to the spectrometer, or a simulated one if simulation is enabled
+    if sim.enabled():
+        return sim.SimSpectrometer()
+    import seabreeze.spectrometers as sb
+    return sb.Spectrometer.from_serial_number()
+
+
 def spec_checked(spec_dict):
     # run this when spectrometer checkbox on GUI is checked or unchecked
     # open spectrometer
@@ -47,7 +55,7 @@ def spec_checked(spec_dict):
 
         # try to connect to spectrometer
         try:
-            sm = sb.Spectrometer.from_serial_number()
+            sm = open_spectrometer()
             spec_dict['output_box'].append('Spectrometer connected.')
             spec_dict['optical_box'].setEnabled(True)
             sm.close()
@@ -68,7 +76,7 @@ def get_spec(spec_dict):
 
     spec_dict['measure_button'].setEnabled(False)
     # connect to Ocean Optics USB4000 spectrometer
-    sm = sb.Spectrometer.from_serial_number()
+    sm = open_spectrometer()
 
     spec_dict['output_box'].append('Measuring optical spectrum...')
     # set measurement integration time in microseconds
@@ -165,7 +173,7 @@ def optical_vac_seq(spec_dict):
 if __name__ == '__main__':
 
     # open connectino to device
-    sm = sb.Spectrometer.from_serial_number()
+    sm = open_spectrometer()
 
     # set measurement integration time in microseconds
     sm.integration_time_micros(1000)
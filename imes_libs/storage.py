@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides append-only file writers and growable in-memory
+buffers for saving data acquired during long experiments. Files are written
+incrementally, so the cost of each save depends only on the amount of new
+data and not on how long the experiment has been running.
+
+Packages required:
+os
+csv
+time
+numpy
+
+Created on Sat Oct 17 09:12:40 2026
+"""
+
+import os
+import csv
+import time
+import numpy as np
+
+
+class AppendCSVWriter:
+    # Append-only CSV file writer. The header is written once when the
+    # file is created, and each call to append() writes only new rows.
+    # Rows are flushed to the OS after every append, and the file is
+    # fsynced to disk every 'fsync_every' appends (0 to never fsync).
+    # If 'overwrite' is True, an existing file is replaced.
+
+    def __init__(self, filepath, columns, fsync_every=10, overwrite=False):
+        self.filepath = filepath
+        self.columns = list(columns)
+        self.fsync_every = int(fsync_every)
+        self.appends_since_sync = 0
+        self.rows_written = 0
+        # only write the header if the file is new or empty
+        new_file = (overwrite or not os.path.exists(filepath) or
+                    os.path.getsize(filepath) == 0)
+        self.file = open(filepath, 'w' if overwrite else 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow(self.columns)
+            self.file.flush()
+
+    def append(self, rows):
+        # append rows to the file, where rows is a list of lists of values
+        if len(rows) == 0:
+            return
+        self.writer.writerows(rows)
+        self.rows_written += len(rows)
+        self.file.flush()
+        self.appends_since_sync += 1
+        if self.fsync_every > 0:
+            if self.appends_since_sync >= self.fsync_every:
+                self.sync()
+
+    def sync(self):
+        # force the file contents to be written to disk
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.appends_since_sync = 0
+
+    def close(self):
+        # sync and close the file
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+
+class RecordStore:
+    # Append-only binary file of fixed-size records, such as measured
+    # spectra, with a CSV index. Each call to append() writes a block of
+    # records of the numpy dtype 'dtype' to the end of the binary file, and
+    # one row to the index file with the block number, the offset and
+    # number of records of the block, and the values of 'index_columns'.
+    # The index file has the same name as the binary file with '_index.csv'
+    # in place of the extension. read() reads a single block from disk.
+
+    def __init__(self, filepath, dtype, index_columns, fsync_every=10,
+                 overwrite=False):
+        self.filepath = filepath
+        self.dtype = np.dtype(dtype)
+        self.index_filepath = os.path.splitext(filepath)[0] + '_index.csv'
+        # offset and number of records of each block
+        self.blocks = []
+        if not overwrite and os.path.exists(self.index_filepath):
+            with open(self.index_filepath, newline='') as f:
+                for row in list(csv.reader(f))[1:]:
+                    self.blocks.append((int(row[1]), int(row[2])))
+        self.records = sum(count for _, count in self.blocks)
+        self.file = open(filepath, 'wb' if overwrite else 'ab')
+        self.index = AppendCSVWriter(
+                self.index_filepath, ['block', 'offset', 'records'] + list(
+                        index_columns), fsync_every=fsync_every,
+                overwrite=overwrite)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def append(self, records, index_values=()):
+        # append a block of records and return its block number
+        records = np.ascontiguousarray(records, dtype=self.dtype)
+        self.file.write(records.tobytes())
+        self.file.flush()
+        block = len(self.blocks)
+        self.blocks.append((self.records, len(records)))
+        # index is written after the data so it never points past the end
+        self.index.append([[block, self.records, len(records)] + list(
+                index_values)])
+        self.records += len(records)
+        return block
+
+    def read(self, block):
+        # read the records of a single block
+        offset, count = self.blocks[block]
+        with open(self.filepath, 'rb') as f:
+            f.seek(offset*self.dtype.itemsize)
+            return np.fromfile(f, dtype=self.dtype, count=count)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        self.index.close()
+
+
+class ChunkedArray:
+    # Growable 2D float64 array stored as a list of fixed-size chunks which
+    # are filled with NaN. Adding a row is O(1) and never copies existing
+    # data. If 'max_rows' is set, the oldest chunks are discarded once more
+    # than 'max_rows' rows are held, so memory stays bounded on long runs.
+    # Row indices keep counting from the start after chunks are discarded.
+
+    def __init__(self, ncols, chunk_rows=10000, max_rows=None):
+        self.ncols = int(ncols)
+        self.chunk_rows = int(chunk_rows)
+        self.max_rows = max_rows
+        self.chunks = []
+        # index of the oldest chunk which is still held in memory
+        self.first_chunk = 0
+        # total number of rows added since the array was created
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def first_row(self):
+        # index of the oldest row which is still held in memory
+        return self.first_chunk * self.chunk_rows
+
+    def add_row(self, values=None):
+        # add a new row of NaN (or of values) and return its index
+        if self.n == (self.first_chunk + len(self.chunks)) * self.chunk_rows:
+            self.chunks.append(
+                    np.full((self.chunk_rows, self.ncols), np.nan))
+            # discard oldest chunks if there are too many rows
+            if self.max_rows is not None:
+                while (len(self.chunks)-1) * self.chunk_rows >= self.max_rows:
+                    self.chunks.pop(0)
+                    self.first_chunk += 1
+        row = self.n
+        if values is not None:
+            self._chunk(row)[row % self.chunk_rows] = values
+        self.n += 1
+        return row
+
+    def _chunk(self, row):
+        # get the chunk which holds a row
+        return self.chunks[row // self.chunk_rows - self.first_chunk]
+
+    def set(self, row, col, value):
+        # write a single value. rows which were discarded are ignored.
+        if self.first_row <= row < self.n:
+            self._chunk(row)[row % self.chunk_rows, col] = value
+
+    def get(self, row, col):
+        # read a single value, or NaN if the row was discarded
+        if self.first_row <= row < self.n:
+            return self._chunk(row)[row % self.chunk_rows, col]
+        return np.nan
+
+    def rows(self, start=None, stop=None):
+        # get a 2D array of the rows from start to stop which are in memory
+        start = self.first_row if start is None else max(
+                start, self.first_row)
+        stop = self.n if stop is None else min(stop, self.n)
+        if stop <= start:
+            return np.empty((0, self.ncols))
+        c0 = start // self.chunk_rows
+        c1 = (stop - 1) // self.chunk_rows
+        parts = self.chunks[c0-self.first_chunk:c1-self.first_chunk+1]
+        data = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        offset = c0 * self.chunk_rows
+        return data[start-offset:stop-offset]
+
+
+class MasterBuffer:
+    # Typed columnar store for the master table of the GUI, which grows in
+    # chunks and is not limited to a fixed number of rows. Values are held
+    # as float64 with NaN for missing entries. The 'date' column holds unix
+    # timestamps, the 'save' column holds 1 for rows marked as saved, and
+    # the 'note' column is held separately as strings.
+    # Use set(column, value, row) to write a value. If row is not given,
+    # the value is written to the most recent row.
+
+    def __init__(self, columns, chunk_rows=10000, max_rows=None):
+        self.columns = list(columns)
+        self.num_columns = [col for col in self.columns if col != 'note']
+        self.col_index = {col: j for j, col in enumerate(self.num_columns)}
+        self.data = ChunkedArray(len(self.num_columns),
+                                 chunk_rows=chunk_rows, max_rows=max_rows)
+        self.notes = {}
+        # index of the most recent row
+        self.i = -1
+
+    def __len__(self):
+        return len(self.data)
+
+    def new_row(self):
+        # add an empty row to the end of the buffer and return its index
+        first_row = self.data.first_row
+        self.i = self.data.add_row()
+        # remove notes of rows which were discarded
+        if self.data.first_row != first_row:
+            for row in [r for r in self.notes if r < self.data.first_row]:
+                del self.notes[row]
+        return self.i
+
+    def set(self, column, value, row=None):
+        # write a single value to a column
+        row = self.i if row is None else row
+        if column == 'note':
+            self.notes[row] = str(value)
+        else:
+            self.data.set(row, self.col_index[column], value)
+
+    def get(self, column, row=None):
+        # read a single value from a column
+        row = self.i if row is None else row
+        if column == 'note':
+            return self.notes.get(row, '')
+        return self.data.get(row, self.col_index[column])
+
+    def select(self, key, *columns):
+        # get arrays of the columns at rows in which the key column
+        # has been written, for example:
+        # t, p = df.select('pressure', 'time', 'pressure')
+        data = self.data.rows()
+        mask = np.invert(np.isnan(data[:, self.col_index[key]]))
+        return [data[mask, self.col_index[col]] for col in columns]
+
+    @property
+    def save_columns(self):
+        # columns which are written to file
+        return [col for col in self.columns if col != 'save']
+
+    def saved_rows(self, start, stop):
+        # get rows from start to stop which are marked as saved, formatted
+        # as lists of strings in the order of 'save_columns'
+        start = max(start, self.data.first_row)
+        data = self.data.rows(start, stop)
+        saved = np.flatnonzero(data[:, self.col_index['save']] == 1)
+        rows = []
+        for k in saved:
+            row = []
+            for col in self.save_columns:
+                if col == 'note':
+                    row.append(self.notes.get(start+k, ''))
+                    continue
+                value = data[k, self.col_index[col]]
+                if np.isnan(value):
+                    row.append('')
+                elif col == 'date':
+                    row.append(time.strftime(
+                            '%Y-%m-%d_%H-%M-%S', time.localtime(value)))
+                else:
+                    row.append(str(float(value)))
+            rows.append(row)
+        return rows
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides a thread-safe bridge for updating Qt widgets from
+the worker threads which run measurements. Qt widgets may only be changed
+from the GUI thread, so calls such as setText(), setValue() and append()
+made from other threads are marshalled to the GUI thread through a queued
+signal. Updates are coalesced: within one refresh interval only the latest
+value for each widget and setter is applied, and lines appended to an
+output box are joined into a single append. This limits display updates
+to at most one repaint per widget per refresh, however fast the
+acquisition loops run.
+
+Use it in the main GUI class like this:
+
+self.ui_bridge = uibridge.UiDispatcher(self, interval_ms=50)
+uibridge.wrap_dict(self.sark_dict, self.ui_bridge)
+
+Packages required:
+threading
+PyQt5
+
+Created on Sat Oct 17 11:20:06 2026
+"""
+
+import threading
+from PyQt5.QtCore import QObject, QTimer, Qt, pyqtSignal
+from PyQt5.QtWidgets import QWidget, QAction
+
+
+class UiDispatcher(QObject):
+    # Dispatcher which applies widget updates in the GUI thread. It must
+    # be created in the GUI thread.
+    wake = pyqtSignal()
+
+    def __init__(self, parent=None, interval_ms=50):
+        super().__init__(parent)
+        self.interval_ms = interval_ms
+        self.gui_thread = threading.get_ident()
+        self.lock = threading.Lock()
+        # latest pending call for each widget and setter
+        self.pending = {}
+        # pending lines to append to each output box
+        self.appended = {}
+        self.scheduled = False
+        self.flushes = 0
+        self.wake.connect(self.schedule, Qt.QueuedConnection)
+
+    def in_gui_thread(self):
+        # check whether the calling thread is the GUI thread
+        return threading.get_ident() == self.gui_thread
+
+    def call(self, widget, method, *args):
+        # call widget.method(*args) in the GUI thread. calls made from the
+        # GUI thread run immediately, other calls are posted.
+        if self.in_gui_thread():
+            # remove older pending value so it does not overwrite this one
+            with self.lock:
+                self.pending.pop((id(widget), method), None)
+            getattr(widget, method)(*args)
+        else:
+            self.post(widget, method, *args)
+
+    def post(self, widget, method, *args):
+        # post a widget update to be applied at the next refresh. only the
+        # latest update for each widget and setter is kept.
+        with self.lock:
+            if method == 'append':
+                self.appended.setdefault(
+                        id(widget), (widget, []))[1].append(str(args[0]))
+            else:
+                self.pending[(id(widget), method)] = (widget, method, args)
+            wake = not self.scheduled
+            self.scheduled = True
+        if wake:
+            # queued signal is delivered in the GUI thread
+            self.wake.emit()
+
+    def schedule(self):
+        # runs in the GUI thread. wait for the rest of the refresh interval
+        # so that updates arriving during the interval are coalesced.
+        QTimer.singleShot(self.interval_ms, self.flush)
+
+    def flush(self):
+        # apply all pending widget updates in the GUI thread
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            appended, self.appended = self.appended, {}
+            self.scheduled = False
+        for widget, method, args in pending.values():
+            getattr(widget, method)(*args)
+        for widget, lines in appended.values():
+            widget.append('\n'.join(lines))
+        self.flushes += 1
+
+
+class WidgetProxy:
+    # Stand-in for a widget which routes setter calls through a dispatcher,
+    # so it can be used safely from any thread. All other attributes such
+    # as value(), text() and isChecked() are taken from the widget itself.
+    setters = ('setText', 'setValue', 'setEnabled', 'setChecked',
+               'setCurrentIndex', 'append')
+
+    def __init__(self, widget, dispatcher):
+        self.widget = widget
+        self.dispatcher = dispatcher
+
+    def __getattr__(self, name):
+        if name in WidgetProxy.setters:
+            return lambda *args: self.dispatcher.call(self.widget, name, *args)
+        return getattr(self.widget, name)
+
+
+def wrap_dict(widget_dict, dispatcher):
+    # replace each widget in a dictionary (including nested dictionaries)
+    # with a proxy which routes setter calls through the dispatcher
+    for key, value in widget_dict.items():
+        if isinstance(value, dict):
+            wrap_dict(value, dispatcher)
+        elif isinstance(value, (QWidget, QAction)):
+            widget_dict[key] = WidgetProxy(value, dispatcher)
+    return widget_dict
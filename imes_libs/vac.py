@@ -13,16 +13,21 @@ Created on Mon Apr 22 13:12:13 2019
 """
 
 import time
-import visa
-import serial
 import datetime
 import numpy as np
 import pandas as pd
 from PyQt5 import QtWidgets
 import matplotlib.pyplot as plt
+from imes_libs import workers
+from imes_libs import sequence
+from imes_libs import sim
 # instrument libraries
 # from alicat import FlowController
 
+# seconds after which unchanged setpoints are re-sent to the instruments,
+# or None to only send setpoints when they change
+setpoint_refresh = 60.0
+
 
 # %% ------ Funtions to control Leybold Turbovac 90i turbo pump--------------
 
@@ -30,10 +35,15 @@ def turbo_checked(vac_dict):
     # run this function when turbo pump checkbox is checked/unchecked on GUI
     if vac_dict['mks_on'].isChecked():
         if vac_dict['turbo_on'].isChecked():
-            vac_dict['turbo_dev'] = serial.Serial(
-                    vac_dict['turbo_address'].text(), 19200, timeout=1.0)
+            turbo = sim.open_serial(
+                    vac_dict['turbo_address'].text(), 19200, sim.SimTurbo)
+            vac_dict['turbo_dev'] = turbo
+            workers.start_worker(
+                    vac_dict['workers'], 'turbo',
+                    lambda run_pump: turbo_step(turbo, run_pump))
             vac_dict['output_box'].append('Turbo pump connected')
         if not vac_dict['turbo_on'].isChecked():
+            workers.stop_worker(vac_dict['workers'], 'turbo')
             vac_dict['turbo_dev'].close()
             vac_dict['output_box'].append('Turbo pump disconnected')
     else:
@@ -41,24 +51,46 @@ def turbo_checked(vac_dict):
                 'Pressure controller must be on to run turbo pump.')
         vac_dict['turbo_on'].setChecked(False)
 
-def operate_turbo(vac_dict, run_pump=False):
+def turbo_frame(control_word):
+    # build a frame for the turbo pump with a 16-bit control word. bit 10
+    # of the control word requests control by the serial interface and
+    # bit 0 starts the pump. the last byte is the XOR checksum of the
+    # frame, so the frames of control words 0x0401 and 0x0400 are the
+    # original on and off frames, which end in 0x19 and 0x18.
+    frame = bytes.fromhex('02 16 00 10 18 00 00 00 00 00 00')
+    frame += control_word.to_bytes(2, 'big') + bytes(10)
+    checksum = 0
+    for byte in frame:
+        checksum ^= byte
+    return frame + bytes([checksum])
+
+
+def read_turbo_speed(dev):
+    # read the pump rotor speed in Hz from the reply to the last frame
+    read_message = dev.readline().hex()
+    turbo_speed = ((int(read_message or '0', 16) &
+                    0xffff000000000000000000) >> 72)
+    return turbo_speed
+
+
+def operate_turbo(dev, run_pump=False):
     # turn trubo pump on/off and read pump rotor speed in Hz
-    first_half = '02 16 00 10 18 00 00 00 00 00 00 04 '
-    on_str = first_half + '01 00 00 00 00 00 00 00 00 00 00 19'
-    off_str = first_half + '00 00 00 00 00 00 00 00 00 00 00 18'
     if run_pump:
         # turn pump on
-        vac_dict['turbo_dev'].write(bytes.fromhex(on_str))
-
+        dev.write(turbo_frame(0x0401))
     else:
         # turn pump off
-        vac_dict['turbo_dev'].write(bytes.fromhex(off_str))
-    # read pump speed
-    read_message = vac_dict['turbo_dev'].readline().hex()
-    turbo_speed = ((eval("0x"+read_message) & 0xffff000000000000000000) >> 72)
-    # print(read_message)
-    # print(turbo_speed)
-    vac_dict['turbo_speed'].setText(str(turbo_speed))
+        dev.write(turbo_frame(0x0400))
+    return read_turbo_speed(dev)
+
+
+def turbo_step(dev, run_pump):
+    # operate the turbo pump from its worker thread. the speed is read
+    # from the reply to the on/off frame of the requested state, which is
+    # sent at every step. a frame which only reads the status is not used,
+    # because it has not been checked against the pump manual, and a
+    # frame which the pump reads as a command could stop the pump.
+    return {'speed': operate_turbo(dev, run_pump=run_pump)}
 
 
 # %% ------------ These functions control MKS 651 pressure controller
@@ -70,12 +102,16 @@ def mks_checked(vac_dict):
     # the MKS-651 pressure controller.
     if vac_dict['mks_on'].isChecked():
         try:
-            rm = visa.ResourceManager()
             # list all resources connected to PC
             # print(rm.list_resources())
             # create instance of MKS instrument
-            mks = rm.open_resource(vac_dict['mks_address'].text())
+            mks = sim.open_visa(vac_dict['mks_address'].text(),
+                                sim.SimMKS651)
             vac_dict['mks_dev'] = mks
+            cache = workers.SetpointCache(setpoint_refresh)
+            workers.start_worker(
+                    vac_dict['workers'], 'mks',
+                    lambda command: mks_step(mks, command, cache))
             vac_dict['output_box'].append('MKS-651 connected.')
             vac_dict['mks_address'].setEnabled(False)
             # vac_dict['menu_vacuum'].setEnabled(True)
@@ -86,6 +122,7 @@ def mks_checked(vac_dict):
             # vac_dict['menu_vacuum'].setEnabled(False)
     if not vac_dict['mks_on'].isChecked():
         vac_dict['mks_address'].setEnabled(True)
+        workers.stop_worker(vac_dict['workers'], 'mks')
         try:
             vac_dict['mks_dev'].close()
             vac_dict['output_box'].append('MKS-651 disconnected.')
@@ -127,6 +164,22 @@ def get_pressure(dev):
     press_str = dev.query('R5').rstrip()[1:]
     return np.round(float(press_str)*10, decimals=5)
 
+
+def mks_step(dev, command, cache):
+    # measure pressure and valve position, then set the pressure or valve
+    # position of the MKS 651. this runs in the MKS worker thread.
+    # command is a dictionary with keys 'mode', 'pressure_sp', 'valve_sp'.
+    # the setpoint is only sent when the mode or setpoint changes.
+    pressure = get_pressure(dev)
+    valve_pos = get_valve_pos(dev)
+    if command['mode'] == 'pressure':
+        cache.send('setpoint', ('pressure', command['pressure_sp']),
+                   lambda sp: set_pressure(dev, sp[1]))
+    if command['mode'] == 'valve':
+        cache.send('setpoint', ('valve', command['valve_sp']),
+                   lambda sp: set_valve_pos(dev, sp[1]))
+    return {'pressure': pressure, 'valve_pos': valve_pos}
+
 # %% ------ Funtions to control alicat mass flow controllers (MFCs) ---------
 
 
@@ -135,14 +188,19 @@ def mfc1_checked(vac_dict):
     if vac_dict['mfc1_on'].isChecked():
         try:
             # initialize MFC
-            mfc1 = serial.Serial(vac_dict['mfc1_address'].text(),
-                                 19200, timeout=1.0)
+            mfc1 = sim.open_serial(vac_dict['mfc1_address'].text(),
+                                   19200, sim.SimAlicat)
             vac_dict['mfc1_dev'] = mfc1
+            cache = workers.SetpointCache(setpoint_refresh)
+            workers.start_worker(
+                    vac_dict['workers'], 'mfc1',
+                    lambda setpoint: mfc_step(mfc1, setpoint, cache))
             vac_dict['output_box'].append('MFC-1 connected successfully.')
         except AttributeError:
             vac_dict['output_box'].append('MFC-1 could not connect.')
             vac_dict['mfc1_on'].setChecked(False)
     if not vac_dict['mfc1_on'].isChecked():
+        workers.stop_worker(vac_dict['workers'], 'mfc1')
         try:
             vac_dict['mfc1_dev'].close()
             vac_dict['output_box'].append('MFC-1 disconnected.')
@@ -155,14 +213,19 @@ def mfc2_checked(vac_dict):
     if vac_dict['mfc2_on'].isChecked():
         try:
             # initialize MFC
-            mfc2 = serial.Serial(vac_dict['mfc2_address'].text(),
-                                 19200, timeout=1.0)
+            mfc2 = sim.open_serial(vac_dict['mfc2_address'].text(),
+                                   19200, sim.SimAlicat)
             vac_dict['mfc2_dev'] = mfc2
+            cache = workers.SetpointCache(setpoint_refresh)
+            workers.start_worker(
+                    vac_dict['workers'], 'mfc2',
+                    lambda setpoint: mfc_step(mfc2, setpoint, cache))
             vac_dict['output_box'].append('MFC-2 connected successfully.')
         except AttributeError:
             vac_dict['output_box'].append('MFC-2 could not connect.')
             vac_dict['mfc2_on'].setChecked(False)
     if not vac_dict['mfc2_on'].isChecked():
+        workers.stop_worker(vac_dict['workers'], 'mfc2')
         try:
             vac_dict['mfc2_dev'].close()
             vac_dict['output_box'].append('MFC-2 disconnected.')
@@ -211,100 +274,108 @@ def set_gas(mfc, gas, address='A'):
     time.sleep(0.2)
 
 
+def mfc_step(mfc, setpoint, cache):
+    # set the flow rate of an MFC and read its flow parameters. this runs
+    # in the worker thread of the MFC. the setpoint is only sent when it
+    # changes, or when the MFC reports a different setpoint.
+    setpoint = float(setpoint)
+    cache.send('setpoint', setpoint, lambda sp: set_setpoint(mfc, sp))
+    flowrate, mfc_setpoint, gas = get_flow_params(mfc)
+    if abs(float(mfc_setpoint) - setpoint) > 0.005:
+        cache.invalidate('setpoint')
+    return {'flowrate': flowrate, 'gas': gas}
+
+
 # %% ------------- MAIN FUNCTION TO REPEAT EACH GUI ITERATION ---------------
 
 def vac_main(vac_dict, df, df_i):
     # control pressure and flow rates in vacuum chamber. this fucntion
     # should run every loop iteration of the GUI in order to update
     # GUI displays andm aintain appropriate pressure settings.
+    # it runs in the GUI thread: setpoints are sent to the instrument
+    # worker threads and the most recent readings are taken from their
+    # snapshots, so no device I/O happens here.
+    vac_workers = vac_dict['workers']
 
     # measure the current pressure and flow rates
-    if vac_dict['mks_on'].isChecked():
+    if vac_dict['mks_on'].isChecked() and 'mks' in vac_workers:
         # get pressure setpoint
         pressure_sp = vac_dict['set_pressure'].value()
         # get valve setpoint
         valve_sp = vac_dict['set_valve_pos'].value()
-        # measure pressure and valve position
-        pressure = get_pressure(vac_dict['mks_dev'])
-        valve_pos = get_valve_pos(vac_dict['mks_dev'])
-        vac_dict['current_pressure'] = pressure
-
-        # set the pressure or valve position
+        # send the pressure or valve position setpoint to the MKS worker
+        mode = None
         if vac_dict['pressure_mode'].isChecked():
-            set_pressure(vac_dict['mks_dev'], pressure_sp)
-
+            mode = 'pressure'
         if vac_dict['valve_mode'].isChecked():
-            set_valve_pos(vac_dict['mks_dev'], valve_sp)
-
-        # update GUI with current values
-        vac_dict['pressure_display'].setText(str(pressure))  # float(pressure))
-        vac_dict['valve_pos_display'].setText(str(float(valve_pos)))
+            mode = 'valve'
+        vac_workers['mks'].submit({'mode': mode,
+                                   'pressure_sp': pressure_sp,
+                                   'valve_sp': valve_sp})
+        # get most recent pressure and valve position. there is no
+        # reading if the last read failed.
+        workers.report_error(vac_workers['mks'], vac_dict['output_box'],
+                             'MKS-651')
+        reading = vac_workers['mks'].snapshot()
+        vac_dict['current_pressure'] = None
+        if reading is None:
+            vac_dict['pressure_display'].setText('--')
+        else:
+            pressure = reading['pressure']
+            vac_dict['current_pressure'] = pressure
+            # update GUI with current values
+            vac_dict['pressure_display'].setText(str(pressure))
+            vac_dict['valve_pos_display'].setText(
+                    str(float(reading['valve_pos'])))
 
-        df['pressure'].iloc[df_i] = str(pressure)
-        df['pressure_setpoint'].iloc[df_i] = str(pressure_sp)
+            df.set('pressure', pressure, df_i)
+            df.set('pressure_setpoint', pressure_sp, df_i)
 
     # control turbo pump
-    if vac_dict['turbo_on'].isChecked():
-        if pressure < 0.5:
+    if vac_dict['turbo_on'].isChecked() and 'turbo' in vac_workers:
+        pressure = vac_dict['current_pressure']
+        run_pump = False
+        if pressure is not None and pressure < 0.5:
             if vac_dict['run_turbo'].isChecked():
-                operate_turbo(vac_dict, run_pump=True)
+                run_pump = True
             elif vac_dict['turbo_auto_on'].isChecked():
-                operate_turbo(vac_dict, run_pump=True)
-            else:
-                operate_turbo(vac_dict, run_pump=False)
+                run_pump = True
+        vac_workers['turbo'].submit(run_pump)
+        workers.report_error(vac_workers['turbo'], vac_dict['output_box'],
+                             'Turbo pump')
+        reading = vac_workers['turbo'].snapshot()
+        if reading is None:
+            vac_dict['turbo_speed'].setText('--')
         else:
-            operate_turbo(vac_dict, run_pump=False)
+            vac_dict['turbo_speed'].setText(str(reading['speed']))
 
     # control MFCs
-    if vac_dict['mfc1_on'].isChecked():
-        # get MFC setpoint
-        mfc1_sp = vac_dict['mfc1_sp'].value()
-        # set the desired flow rate
-        set_setpoint(vac_dict['mfc1_dev'],
-                     float(mfc1_sp))
-        # change gas
-        # set_gas(mfc1, vac_dict['gas1'].currentText())
-        # get MFC parameters
-        flowrate1, setpoint1, gas1 = get_flow_params(vac_dict['mfc1_dev'])
-        # update GUI
-        vac_dict['mfc1_display'].setText(
-                str(np.round(float(flowrate1), decimals=2)))
-        # append values to main pressure file
-        df['mfc1'].iloc[df_i] = str(flowrate1)
-
-    if vac_dict['mfc2_on'].isChecked():
-        # get MFC setpoint
-        mfc2_sp = vac_dict['mfc2_sp'].value()
-        # set the desired flow rate
-        set_setpoint(vac_dict['mfc2_dev'],
-                     float(mfc2_sp))
-        # change gas
-        # set_gas(mfc1, vac_dict['gas1'].currentText())
-        # get MFC parameters
-        flowrate2, setpoint2, gas2 = get_flow_params(vac_dict['mfc2_dev'])
-        # update GUI
-        vac_dict['mfc2_display'].setText(
-                str(np.round(float(flowrate2), decimals=2)))
-        # append values to main pressure file
-        df['mfc2'].iloc[df_i] = str(flowrate2)
-
-        '''
-        print('flowrate = '+str(flowrate))
-        print('setpoint = '+str(setpoint))
-        print('gas = '+str(gas))
-        '''
-
-    # update vacuum sequence duration on GUI
-    vac_df = vac_table_to_df(vac_dict)
-    seq_time = vac_df['time'].sum()
-    vac_dict['tot_vac_seq_time'].setText(
-            str(np.round(int(seq_time)/60, decimals=2)))
-
-    # display estimated sequence end time on the GUI
-    if not vac_dict['vac_seq_running']:
-        tot_seq_min = vac_df['time'].sum()
+    for mfc in ['mfc1', 'mfc2']:
+        if vac_dict[mfc+'_on'].isChecked() and mfc in vac_workers:
+            # send the MFC setpoint to the MFC worker
+            vac_workers[mfc].submit(float(vac_dict[mfc+'_sp'].value()))
+            # change gas
+            # set_gas(mfc1, vac_dict['gas1'].currentText())
+            # get most recent MFC parameters
+            workers.report_error(vac_workers[mfc], vac_dict['output_box'],
+                                 mfc.upper())
+            reading = vac_workers[mfc].snapshot()
+            if reading is None:
+                vac_dict[mfc+'_display'].setText('--')
+            else:
+                # update GUI
+                vac_dict[mfc+'_display'].setText(
+                        str(np.round(float(reading['flowrate']), decimals=2)))
+                # append values to main pressure file
+                df.set(mfc, reading['flowrate'], df_i)
+
+    # display estimated sequence end time on the GUI, using the sequence
+    # duration which was parsed when the sequence table last changed
+    if vac_dict['vac_seq_model'] is not None and (
+            not vac_dict['vac_seq_running']):
         seq_start_date = datetime.datetime.now()
-        seq_end_date = seq_start_date + datetime.timedelta(minutes=tot_seq_min)
+        seq_end_date = seq_start_date + datetime.timedelta(
+                minutes=vac_dict['vac_seq_model'].total_time)
         vac_dict['vac_seq_end_time_display'].setText(
                seq_end_date.strftime('%m-%d %H:%M:%S'))
 
@@ -313,21 +384,16 @@ def vac_main(vac_dict, df, df_i):
 
 
 def vac_table_to_df(vac_dict):
-    # Convert vacuum sequence table on GUI to a Pandas dataframe
-    # create empty dataframe
-    vac_df = pd.DataFrame(
-            columns=['time', 'pressure', 'mfc1', 'mfc2'],
-            index=range(vac_dict['vac_table'].rowCount()))
+    # Get the vacuum sequence table on GUI as a Pandas dataframe. The
+    # table is parsed by the sequence model only when it changes.
+    return vac_dict['vac_seq_model'].dataframe()
 
-    # loop over table entries
-    for rowi in range(vac_dict['vac_table'].rowCount()):
-        for colj in range(vac_dict['vac_table'].columnCount()):
-            # populate dataframe with table entries
-            new_entry = vac_dict['vac_table'].item(rowi, colj).text()
-            vac_df.iloc[rowi, colj] = new_entry
-    # delete empty rows
-    vac_df = vac_df[vac_df['time'] != '0']
-    return vac_df.astype(float)
+
+def show_vac_seq_total(vac_dict):
+    # update vacuum sequence duration on GUI. runs when the table changes.
+    seq_time = vac_dict['vac_seq_model'].total_time
+    vac_dict['tot_vac_seq_time'].setText(
+            str(np.round(int(seq_time)/60, decimals=2)))
 
 
 def import_vac_seq(vac_dict, seq_name):
@@ -400,10 +466,8 @@ def plot_vac_seq(vac_dict):
 
 def plot_pressure(df, df_i):
     # Plot the RH over time
-    vac_df = df[df['pressure'] != '']
-    setpoint = vac_df['pressure_setpoint'].astype(float)
-    pressure = vac_df['pressure'].astype(float)
-    pressure_time = vac_df['time'].astype(float)
+    pressure_time, pressure, setpoint = df.select(
+            'pressure', 'time', 'pressure', 'pressure_setpoint')
     fig_seq = plt.figure(20)
     plt.cla()
     plt.ion()
@@ -418,7 +482,8 @@ def plot_pressure(df, df_i):
 
 
 def run_vac_seq(vac_dict):
-    # run RH sequence
+    # run vacuum sequence. the setpoints are sent by a sequence runner
+    # thread at the times of each step, and this function returns at once.
     vac_dict['output_box'].append('Vacuum sequence initiated.')
     vac_dict['vac_seq_running'] = True
     vac_dict['run_vac_seq'].setEnabled(False)
@@ -433,62 +498,50 @@ def run_vac_seq(vac_dict):
     vac_dict['pressure_mode'].setChecked(True)
     vac_dict['valve_mode'].setChecked(False)
     vac_df = vac_table_to_df(vac_dict)
-    tot_seq_time = vac_df['time'].sum()
-    tot_time_disp = str(np.round(tot_seq_time, decimals=1))
-    # set up timers and counters
-    elapsed_seq_time = 0
-    seq_start_time = time.time()
+    schedule = sequence.compile_timeline(
+            {channel: sequence.table_segments(vac_df['time'], vac_df[channel])
+             for channel in ['pressure', 'mfc1', 'mfc2']})
 
-    tot_seq_min = vac_df['time'].sum()
     seq_start_date = datetime.datetime.now()
     seq_end_date = seq_start_date + datetime.timedelta(
-                                               minutes=tot_seq_min)
+            seconds=schedule.duration)
     vac_dict['vac_seq_end_time_display'].setText(
            seq_end_date.strftime('%m-%d %H:%M:%S'))
 
-    step_num = 0
-    # loop over each step in sequence
-    for step in range(len(vac_df)):
-
-        if vac_dict['vac_seq_running']:
-            step_start_time = time.time()
-            elapsed_step_time = 0
-            step_dur = vac_df['time'].iloc[step]*60
-        else:
-            break
-        # repeat until step duration has elapsed
-        while elapsed_step_time < step_dur:
-
-            if vac_dict['vac_seq_running']:
-                elapsed_step_time = time.time() - step_start_time
-                elapsed_seq_time = time.time() - seq_start_time
+    def show_step(t, changes):
+        # update the sequence step on the GUI
+        step = schedule.segment_index('pressure', t)
+        vac_dict['vac_seq_step'].setText(
+                str(int(step+1))+'/'+str(len(vac_df)))
 
-                # update fields on GUI
-                if step_num % 5 == 0:
-                    vac_dict['save_data_now'].setChecked(True)
-                    vac_dict['vac_seq_step'].setText(
-                            str(int(step+1))+'/'+str(len(vac_df)))
+    runner = sequence.SequenceRunner(
+            schedule, sequence.widget_setters(vac_dict=vac_dict),
+            on_event=show_step,
+            on_finish=lambda completed: finish_vac_seq(vac_dict),
+            name='vac_sequence')
+    vac_dict['vac_seq_runner'] = runner
+    runner.start()
 
-                    vac_dict['set_pressure'].setValue(
-                            float(vac_df['pressure'].iloc[step]))
 
-                    vac_dict['mfc1_sp'].setValue(
-                            float(vac_df['mfc1'].iloc[step]))
+def show_vac_seq_time(vac_dict):
+    # show the elapsed time of the running vacuum sequence on the GUI
+    runner = vac_dict['vac_seq_runner']
+    if runner is not None:
+        vac_dict['elapsed_vac_seq_time'].setText(
+                str(np.round(runner.elapsed()/60, decimals=2)) + '/' +
+                str(np.round(runner.schedule.duration/60, decimals=1)))
 
-                    vac_dict['mfc2_sp'].setValue(
-                            float(vac_df['mfc2'].iloc[step]))
 
-                    elasped_time_disp = str(
-                            np.round(elapsed_seq_time/60, decimals=2))
-
-                    vac_dict['elapsed_vac_seq_time'].setText(
-                            elasped_time_disp + '/' + tot_time_disp)
+def stop_vac_seq(vac_dict):
+    # stop the vacuum sequence. the GUI is reset when the runner finishes.
+    vac_dict['vac_seq_running'] = False
+    if vac_dict['vac_seq_runner'] is not None:
+        vac_dict['vac_seq_runner'].stop()
 
-                time.sleep(.5)
-                step_num += 1
-            else:
-                break
 
+def finish_vac_seq(vac_dict):
+    # reset the GUI after the vacuum sequence completes or is stopped
+    vac_dict['vac_seq_runner'] = None
     # reset pressure back to zero
     vac_dict['mfc1_sp'].setValue(float(0))
     vac_dict['mfc2_sp'].setValue(float(0))
@@ -516,6 +569,9 @@ def run_vac_seq(vac_dict):
 
 if __name__ == '__main__':
 
+    import visa
+    import serial
+
     mks_on = True
     if mks_on:
         rm = visa.ResourceManager()
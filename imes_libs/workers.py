@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides persistent worker threads which own the I/O of a
+single instrument. Each worker has a bounded command queue and keeps a
+snapshot of the most recent instrument readings, so the main GUI loop only
+enqueues setpoints and reads snapshots, and never waits on device I/O.
+Because each instrument has exactly one worker, commands to the same
+serial port or DAQ task can never overlap. A SetpointCache lets a worker
+skip setpoint commands when the requested value has not changed.
+
+Packages required:
+time
+queue
+threading
+
+Created on Sat Oct 17 10:04:51 2026
+"""
+
+import time
+import queue
+import threading
+
+
+class InstrumentWorker(threading.Thread):
+    # Persistent worker thread for a single instrument. The worker calls
+    # step(command) with the most recent command whenever a new command
+    # arrives, or every 'period' seconds if no new command arrives, and
+    # stores the value returned by step() as the latest snapshot. If
+    # step() raises, the snapshot is cleared so old readings are not
+    # saved as new ones, and the exception is kept in 'error' until a
+    # step succeeds.
+    # Commands which have not been processed yet are dropped when a newer
+    # command arrives, because only the most recent setpoint matters.
+
+    def __init__(self, name, step, period=1.0, maxsize=8):
+        super().__init__(name=name, daemon=True)
+        self.step = step
+        self.period = period
+        self.commands = queue.Queue(maxsize=maxsize)
+        self.command = None
+        self.error = None
+        self.steps = 0
+        self._snapshot = None
+        # error which has not been reported to the user yet
+        self._new_error = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def submit(self, command):
+        # add a command to the queue. if the queue is full, drop the oldest
+        # command to make room for the new one.
+        while True:
+            try:
+                self.commands.put_nowait(command)
+                return
+            except queue.Full:
+                try:
+                    self.commands.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def snapshot(self):
+        # get the most recent result of step(), or None if there is none
+        with self._lock:
+            return self._snapshot
+
+    def take_error(self):
+        # get the error which made the worker stop getting readings, once.
+        # returns None if there is no error or it was already taken, so
+        # each failure is reported only once.
+        with self._lock:
+            error = self._new_error
+            self._new_error = None
+            return error
+
+    def stop(self):
+        # signal the worker to stop after its current step
+        self._stop_event.set()
+        try:
+            self.commands.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def run(self):
+        next_step_time = time.time()
+        while not self._stop_event.is_set():
+            # wait for a new command or until the next periodic step
+            try:
+                command = self.commands.get(
+                        timeout=max(0, next_step_time - time.time()))
+                if command is not None:
+                    self.command = command
+            except queue.Empty:
+                pass
+            # skip ahead to the most recent command in the queue
+            while True:
+                try:
+                    command = self.commands.get_nowait()
+                    if command is not None:
+                        self.command = command
+                except queue.Empty:
+                    break
+            if self._stop_event.is_set():
+                break
+            next_step_time = time.time() + self.period
+            if self.command is None:
+                continue
+            # run instrument I/O and save the result
+            try:
+                result = self.step(self.command)
+                with self._lock:
+                    self._snapshot = result
+                self.error = None
+            except Exception as e:
+                with self._lock:
+                    self._snapshot = None
+                    if self.error is None:
+                        self._new_error = e
+                self.error = e
+            self.steps += 1
+
+
+def start_worker(worker_dict, name, step, period=1.0):
+    # start a new worker for an instrument and store it in worker_dict.
+    # any existing worker with the same name is stopped first.
+    stop_worker(worker_dict, name)
+    worker = InstrumentWorker(name, step, period=period)
+    worker.start()
+    worker_dict[name] = worker
+    return worker
+
+
+def report_error(worker, output_box, label):
+    # show a new error of a worker in the output box of the GUI
+    error = worker.take_error()
+    if error is not None:
+        output_box.append('{} reading failed: {}'.format(label, error))
+
+
+def stop_worker(worker_dict, name, timeout=5):
+    # stop the worker of an instrument and wait for it to finish, so that
+    # the instrument can be closed safely afterwards
+    worker = worker_dict.pop(name, None)
+    if worker is not None:
+        worker.stop()
+        worker.join(timeout)
+
+
+def stop_all(worker_dict, timeout=5):
+    # stop all workers in worker_dict
+    for name in list(worker_dict):
+        stop_worker(worker_dict, name, timeout=timeout)
+
+
+class SetpointCache:
+    # Cache of the setpoints which were last sent to an instrument, so that
+    # a worker only sends a setpoint command when the requested value has
+    # changed. If 'refresh' is a number of seconds, each setpoint is also
+    # re-sent once it is older than 'refresh', which restores setpoints
+    # changed at the instrument front panel or lost on a power cycle.
+    # Each worker should have its own cache, created when the instrument
+    # is connected, so the first setpoint after connecting is always sent.
+
+    def __init__(self, refresh=None):
+        self.refresh = refresh
+        # last value sent and time it was sent for each setpoint key
+        self.values = {}
+        self.sent_times = {}
+        self.sends = 0
+        self.skips = 0
+
+    def needs_send(self, key, value):
+        # check whether a setpoint should be sent to the instrument
+        if key not in self.values or self.values[key] != value:
+            return True
+        if self.refresh is not None:
+            return time.time() - self.sent_times[key] >= self.refresh
+        return False
+
+    def sent(self, key, value):
+        # record that a setpoint was sent to the instrument
+        self.values[key] = value
+        self.sent_times[key] = time.time()
+        self.sends += 1
+
+    def send(self, key, value, write):
+        # call write(value) if the setpoint needs to be sent, and return
+        # True if it was sent. the value is only cached if write() succeeds.
+        if not self.needs_send(key, value):
+            self.skips += 1
+            return False
+        write(value)
+        self.sent(key, value)
+        return True
+
+    def invalidate(self, key=None):
+        # forget a cached setpoint (or all of them if key is None), so it
+        # is sent again on the next step
+        if key is None:
+            self.values.clear()
+            self.sent_times.clear()
+        else:
+            self.values.pop(key, None)
+            self.sent_times.pop(key, None)
@@ -318,6 +318,14 @@ for file in file_dict:
             PyOrigin.LT_execute('layer -g')
 
         elif file == 'bs':
+            # the file holds the readings of all bias sequences, one row
+            # per reading. put the time, bias, and current of each
+            # sequence in its own three columns.
+            bs_data = pd.read_csv(file_dict[file])
+            data = pd.concat(
+                    [seq[['time', 'bias', 'current']].reset_index(drop=True)
+                     for _, seq in bs_data.groupby('sequence', sort=False)],
+                    axis=1).values
             # change units
             for i in range(0, len(data[0]), 3):
                 data[:, i+2] = data[:, i+2] * 1e9
@@ -366,6 +374,11 @@ for file in file_dict:
 
         elif file == 'eis':
 
+            # skip uncertainty columns, so each spectrum has five columns:
+            # frequency, Z, phase, Re(Z), and Im(Z)
+            data = data[:, [i for i, h in enumerate(headers) if not
+                            h.startswith(('z_err_', 'phase_err_'))]]
+
             # only select data columns corresponding to Bode Z data
             data_bd_z = np.empty((len(data), 0))
             for i in range(0, len(data[0]), 5):